@@ -0,0 +1,155 @@
+"""
+Benchmark suite for HW5 solutions, that repeatedly transfers files over a
+matrix of simulated network conditions and file sizes, and reports
+throughput, completion time and retransmission statistics for each.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import logging
+import utils.congestion
+import utils.harness
+import utils.logging
+import utils.packet
+import utils.utils
+import utils.wire
+
+DESC = sys.modules[globals()['__name__']].__doc__
+PARSER = argparse.ArgumentParser(description=DESC)
+PARSER.add_argument('-p', '--port', type=int, default=9999,
+                    help="The port to simulate the lossy wire on (defaults to "
+                         "9999).")
+PARSER.add_argument('-l', '--loss', type=float, nargs='+', default=[0.0, 0.05],
+                    help="The packet loss rates to test.")
+PARSER.add_argument('-d', '--delay', type=float, nargs='+', default=[0.0, 0.05],
+                    help="The network delays, in seconds, to test.")
+PARSER.add_argument('-b', '--buffer', type=int, nargs='+', default=[50],
+                    help="The network buffer sizes, in packets, to test.")
+PARSER.add_argument('-z', '--size', type=int, nargs='+', default=[100000],
+                    help="The sizes, in bytes, of the files to transfer.")
+PARSER.add_argument('-n', '--repeat', type=int, default=3,
+                    help="How many times to repeat each combination.")
+PARSER.add_argument('-c', '--congestion', default="reno",
+                    choices=sorted(utils.congestion.CONTROLLERS),
+                    help="The congestion control algorithm the sender should "
+                         "use (defaults to reno).")
+PARSER.add_argument('-k', '--checksum', default="crc32",
+                    choices=sorted(utils.packet.CHECKSUMS),
+                    help="The checksum algorithm the sender should protect "
+                         "packets with (defaults to crc32).")
+PARSER.add_argument('--seed', type=int, default=None,
+                    help="Seed the simulated network, differently but "
+                         "reproducibly for each repetition.")
+PARSER.add_argument('--replay-trace', default=None,
+                    help="Replay the losses and delays of a trace recorded "
+                         "by the simulated network in every run, so that "
+                         "results can be compared exactly between builds.")
+PARSER.add_argument('-t', '--timeout', type=float, default=300.0,
+                    help="The most seconds a single transfer may take.")
+PARSER.add_argument('--in-process', action="store_true",
+                    help="Run the wire, receiver and sender on threads of "
+                         "this process, instead of as separate processes.")
+PARSER.add_argument('--format', choices=("json", "csv"), default="json",
+                    help="The format to write the results in.")
+PARSER.add_argument('-o', '--output', default=None,
+                    help="The path to write the results to (defaults to "
+                         "STDOUT).")
+PARSER.add_argument('-v', '--verbose', action="store_true",
+                    help="Enable extra verbose mode.")
+ARGS = PARSER.parse_args()
+
+LOGGER = utils.logging.get_logger("hw5-bench")
+if ARGS.verbose:
+    LOGGER.setLevel(logging.DEBUG)
+
+SENDER_ARGS = ["--congestion", ARGS.congestion, "--checksum", ARGS.checksum]
+
+# Random data, which none of the protocol can take shortcuts with, of each
+# size being tested.
+INPUT_DIR = tempfile.TemporaryDirectory()
+INPUT_PATHS = {}
+for A_SIZE in ARGS.size:
+    INPUT_PATHS[A_SIZE] = os.path.join(INPUT_DIR.name, "{}.bin".format(A_SIZE))
+    with open(INPUT_PATHS[A_SIZE], 'wb') as HANDLE:
+        HANDLE.write(os.urandom(A_SIZE))
+
+RUNS = []
+CELLS = []
+for LOSS, DELAY, BUFFER, SIZE in itertools.product(ARGS.loss, ARGS.delay,
+                                                   ARGS.buffer, ARGS.size):
+    CELL_RUNS = []
+    for REPETITION in range(ARGS.repeat):
+        SERVER_ARGS = []
+        if ARGS.seed is not None:
+            SERVER_ARGS = ["--seed", str(ARGS.seed + REPETITION)]
+        if ARGS.replay_trace:
+            SERVER_ARGS.extend(["--replay-trace", ARGS.replay_trace])
+        if ARGS.in_process:
+            RESULT = utils.harness.run_in_process(
+                INPUT_PATHS[SIZE], LOSS, DELAY, BUFFER,
+                impairments=utils.wire.Impairments(
+                    seed=None if ARGS.seed is None else ARGS.seed + REPETITION),
+                send_kwargs=dict(congestion=ARGS.congestion, checksum=ARGS.checksum),
+                timeout=ARGS.timeout, replay_trace=ARGS.replay_trace)
+            RESULT.pop("receiver")
+        else:
+            RESULT = utils.harness.run_transfer(
+                INPUT_PATHS[SIZE], ARGS.port, LOSS, DELAY, BUFFER,
+                sender_args=SENDER_ARGS, server_args=SERVER_ARGS,
+                timeout=ARGS.timeout)
+        SENDER_STATS = RESULT.pop("sender")
+        SENDER_COUNTERS = SENDER_STATS["counters"] if SENDER_STATS else {}
+        if SENDER_COUNTERS.get("packets"):
+            RESULT["retransmission_ratio"] = (SENDER_COUNTERS.get("retransmissions", 0) /
+                                              SENDER_COUNTERS["packets"])
+        else:
+            RESULT["retransmission_ratio"] = None
+        RESULT.update(loss=LOSS, delay=DELAY, buffer=BUFFER, size=SIZE,
+                      repetition=REPETITION)
+        LOGGER.debug("Run: %s", RESULT)
+        CELL_RUNS.append(RESULT)
+    RUNS.extend(CELL_RUNS)
+
+    THROUGHPUTS = [a_run["throughput"] for a_run in CELL_RUNS]
+    TIMES = [a_run["completion_time"] for a_run in CELL_RUNS]
+    RATIOS = [a_run["retransmission_ratio"] for a_run in CELL_RUNS
+              if a_run["retransmission_ratio"] is not None]
+    CELL = {
+        "loss": LOSS,
+        "delay": DELAY,
+        "buffer": BUFFER,
+        "size": SIZE,
+        "runs": len(CELL_RUNS),
+        "successes": sum(a_run["success"] for a_run in CELL_RUNS),
+        "throughput_median": statistics.median(THROUGHPUTS),
+        "throughput_p95": utils.utils.percentile(THROUGHPUTS, 95),
+        "completion_time_median": statistics.median(TIMES),
+        "completion_time_p95": utils.utils.percentile(TIMES, 95),
+        "retransmission_ratio_median": statistics.median(RATIOS) if RATIOS else None,
+    }
+    LOGGER.info("loss=%s delay=%s buffer=%s size=%s: %d/%d ok, "
+                "median %.2f kB/s, p95 completion %.2fs", LOSS, DELAY, BUFFER,
+                SIZE, CELL["successes"], CELL["runs"],
+                CELL["throughput_median"], CELL["completion_time_p95"])
+    CELLS.append(CELL)
+
+INPUT_DIR.cleanup()
+
+OUTPUT = open(ARGS.output, 'w', newline='') if ARGS.output else sys.stdout
+if ARGS.format == "json":
+    json.dump({"congestion": ARGS.congestion, "checksum": ARGS.checksum,
+               "cells": CELLS, "runs": RUNS}, OUTPUT, indent=2)
+    OUTPUT.write("\n")
+else:
+    WRITER = csv.DictWriter(OUTPUT, fieldnames=list(CELLS[0]))
+    WRITER.writeheader()
+    WRITER.writerows(CELLS)
+if ARGS.output:
+    OUTPUT.close()
+
+sys.exit(0 if all(a_cell["successes"] == a_cell["runs"] for a_cell in CELLS) else 1)
@@ -3,16 +3,408 @@ Where solution code to HW5 should be written.  No other files should
 be modified.
 """
 
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
 import socket
 import io
+import logging
+import os
+import random
+import threading
 import time
 import typing
-import struct
 import utils
+import utils.batch
+import utils.compress
+import utils.congestion
+import utils.delta
+import utils.demux
+import utils.fec
 import utils.logging
+import utils.packet
+import utils.resume
+import utils.stats
+import utils.stream
 
 
-def send(sock: socket.socket, data: bytes):
+# The largest payload that fits in a packet alongside its header.
+CHUNK_SIZE = utils.MAX_PACKET - utils.packet.HEADER.size
+
+# Number of out-of-order packets, beyond the cumulative ACK point, that the
+# receiver can report in the selective acknowledgment (SACK) bitmap of each
+# ACK.  It covers the largest window the congestion controllers allow, so
+# that every packet in flight can be selectively acknowledged; the sender
+# never lets more than one more than this many packets be outstanding.
+SACK_BITS = 1024
+
+# Bounds on the retransmission timeout, in seconds, and on how many times it
+# is doubled by consecutive timeouts.
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+MAX_BACKOFF = 64
+
+# How many later packets must be acknowledged, or duplicate ACKs received,
+# before a packet is fast retransmitted.
+DUP_THRESH = 3
+
+# How many times a SYN or FIN is sent, waiting twice as long for a reply
+# each time (up to MAX_HANDSHAKE_TIMEOUT seconds), before giving up.
+HANDSHAKE_ATTEMPTS = 10
+INITIAL_HANDSHAKE_TIMEOUT = 1.0
+MAX_HANDSHAKE_TIMEOUT = 8.0
+
+# The largest payload that fits in a parity packet, and so the largest data
+# packet that can be protected by forward error correction.
+FEC_CHUNK_SIZE = CHUNK_SIZE - utils.fec.OVERHEAD
+
+# How many pages of a paged reply the sender asks for at once.
+PAGE_WINDOW = 32
+
+# The largest initial window the receiver will grant.
+MAX_INITIAL_WINDOW = 16
+
+# How many seconds the receiver waits for a packet, while data it received is
+# still batched in memory, before writing the batch out anyway, so that a
+# pause in the transfer never leaves received data unwritten.
+WRITE_FLUSH_TIMEOUT = 0.5
+
+# How many of the sender's retransmission timeouts the receiver lingers for
+# after acknowledging the FIN, to answer the FIN again if the FIN_ACK is lost.
+LINGER_RTOS = 3
+
+
+def make_ack(expected_seq: int, received_packets: typing.Iterable[int],
+             checksum: utils.packet.Checksum, conn_id: int = 0) -> bytes:
+    """Builds a selective acknowledgment for the receiver's current state.
+
+    Args:
+        expected_seq -- The lowest sequence number not yet received; every
+                        packet before it has been received.
+        received_packets -- The sequence numbers being held out-of-order.
+        checksum -- The checksum algorithm to protect the ACK with.
+        conn_id -- The ID of the connection.
+
+    Return:
+        An ACK packet, whose sequence number is the cumulative ACK point, and
+        whose payload is a little-endian bitmap, only as long as it needs to
+        be, where bit i is set if packet expected_seq + 1 + i has been
+        received.
+    """
+    bitmap = 0
+    for seq_num in received_packets:
+        offset = seq_num - expected_seq - 1
+        if 0 <= offset < SACK_BITS:
+            bitmap |= 1 << offset
+    return utils.packet.build(utils.packet.ACK, expected_seq,
+                              bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'),
+                              checksum, conn_id=conn_id)
+
+
+def parse_ack(header: utils.packet.Header,
+              ack: bytes) -> typing.Tuple[int, int]:
+    """Unpacks an ACK built by make_ack.
+
+    Args:
+        header -- The verified header of the ACK.
+        ack -- The raw bytes of the ACK.
+
+    Return:
+        Two values, first the cumulative ACK point (all packets before it have
+        been received), and second the SACK bitmap, where bit i is set if
+        packet cum_ack + 1 + i has been received.
+    """
+    return header.seq_num, int.from_bytes(
+        ack[utils.packet.HEADER.size:utils.packet.HEADER.size + header.length], 'little')
+
+
+def wait_for(sock: socket.socket, ptype: int, timeout: float,
+             conn_id: int = 0) -> typing.Optional[typing.Tuple[utils.packet.Header, bytes]]:
+    """Waits for a valid packet of the given type and connection, discarding
+    any others.
+
+    Args:
+        sock -- The socket to receive from.
+        ptype -- The packet type to wait for, for example utils.packet.SYN_ACK.
+        timeout -- The number of seconds to wait before giving up.
+        conn_id -- The ID of the connection the packet must belong to.
+
+    Return:
+        The header and raw bytes of the packet, or None if none arrived in
+        time.
+    """
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        sock.settimeout(remaining)
+        try:
+            packet = sock.recv(utils.MAX_PACKET)
+        except socket.timeout:
+            return None
+        header = utils.packet.unpack_from(packet, len(packet))
+        if header is not None and header.ptype == ptype and header.conn_id == conn_id:
+            return header, packet
+
+
+def connect(sock: socket.socket, proposed: utils.packet.Params,
+            conn_id: int = 0) -> typing.Tuple[utils.packet.Params, float]:
+    """Performs the sender's side of the handshake, sending a SYN with the
+    proposed connection parameters until the receiver answers with a SYN_ACK.
+
+    Args:
+        sock -- The socket connected to the receiver.
+        proposed -- The connection parameters the sender would like to use.
+        conn_id -- The ID the sender chose for the connection.
+
+    Return:
+        Two values, first the parameters accepted by the receiver, and second
+        the round trip time of the successful exchange.
+    """
+    syn = utils.packet.build(utils.packet.SYN, 0, proposed.pack(),
+                             utils.packet.DEFAULT_CHECKSUM, conn_id=conn_id)
+    timeout = INITIAL_HANDSHAKE_TIMEOUT
+    for _ in range(HANDSHAKE_ATTEMPTS):
+        sent_time = time.time()
+        sock.send(syn)
+        reply = wait_for(sock, utils.packet.SYN_ACK, timeout, conn_id)
+        if reply is not None:
+            return utils.packet.Params.unpack_from(reply[1]), time.time() - sent_time
+        timeout = min(timeout * 2, MAX_HANDSHAKE_TIMEOUT)
+    raise ConnectionError("The receiver never answered the handshake.")
+
+
+def fetch_pages(sock: socket.socket, request_type: int, reply_type: int,
+                checksum: utils.packet.Checksum, conn_id: int = 0) -> typing.List[bytes]:
+    """Fetches a reply from the receiver that is split over several pages,
+    asking for up to PAGE_WINDOW missing pages at a time until all of them
+    have arrived.
+
+    Args:
+        sock -- The socket connected to the receiver.
+        request_type -- The type of packet asking for a page, for example
+                        utils.packet.RESUME_REQUEST.
+        reply_type -- The type of packet answering with a page, for example
+                      utils.packet.RESUME.
+        checksum -- The negotiated checksum algorithm.
+        conn_id -- The ID of the connection.
+
+    Return:
+        The pages, in order, each without its page count.
+    """
+    pages = {}
+    num_pages = None  # Known once the first page arrives
+    timeout = INITIAL_HANDSHAKE_TIMEOUT
+    attempts = 0
+    while num_pages is None or len(pages) < num_pages:
+        if num_pages is None:
+            wanted = [0]
+        else:
+            wanted = [page for page in range(num_pages) if page not in pages][:PAGE_WINDOW]
+        for page in wanted:
+            sock.send(utils.packet.build(request_type, page, b'', checksum, conn_id=conn_id))
+        deadline = time.time() + timeout
+        progress = False
+        while any(page not in pages for page in wanted):
+            reply = wait_for(sock, reply_type, deadline - time.time(), conn_id)
+            if reply is None:
+                break
+            header, packet = reply
+            num_pages, = utils.packet.PAGE.unpack_from(packet, utils.packet.HEADER.size)
+            if header.seq_num < num_pages and header.seq_num not in pages:
+                pages[header.seq_num] = packet[utils.packet.HEADER.size + utils.packet.PAGE.size:]
+                progress = True
+        if progress:
+            attempts = 0
+        else:
+            attempts += 1
+            if attempts >= HANDSHAKE_ATTEMPTS:
+                raise ConnectionError("The receiver never answered a paged request.")
+            timeout = min(timeout * 2, MAX_HANDSHAKE_TIMEOUT)
+    return [pages[page] for page in range(num_pages)]
+
+
+def negotiate(proposed: utils.packet.Params) -> utils.packet.Params:
+    """Returns the connection parameters the receiver accepts, given those
+    proposed in the sender's SYN.
+    """
+    checksum_id = proposed.checksum_id
+    if checksum_id not in utils.packet.CHECKSUMS_BY_ID:
+        checksum_id = utils.packet.DEFAULT_CHECKSUM.ident
+    features = proposed.features & utils.packet.SUPPORTED_FEATURES
+    chunk_size = min(proposed.chunk_size, CHUNK_SIZE)
+    fec_block, fec_parity = proposed.fec_block, proposed.fec_parity
+    if (features & utils.packet.FEATURE_FEC and fec_block > 0 and fec_parity > 0 and
+            fec_block + fec_parity <= utils.fec.MAX_SYMBOLS):
+        chunk_size = min(chunk_size, FEC_CHUNK_SIZE)
+    else:
+        features &= ~utils.packet.FEATURE_FEC
+        fec_block, fec_parity = 0, 0
+    compression = proposed.compression
+    if compression not in utils.compress.CODECS_BY_ID:
+        compression = 0
+    return utils.packet.Params(
+        chunk_size=chunk_size,
+        initial_window=min(proposed.initial_window, MAX_INITIAL_WINDOW),
+        checksum_id=checksum_id,
+        features=features,
+        fec_block=fec_block,
+        fec_parity=fec_parity,
+        compression=compression,
+        resume_id=proposed.resume_id,
+        offset=proposed.offset)
+
+
+def accept_resume(params: utils.packet.Params, dest: typing.BinaryIO,
+                  journal: typing.Optional[str]) -> typing.Tuple[utils.packet.Params,
+                                                                 typing.Optional[utils.resume.Journal]]:
+    """Decides whether the receiver can resume a transfer the sender asked to
+    be resumable.
+
+    Args:
+        params -- The connection parameters accepted so far.
+        dest -- The file object the data is written to.
+        journal -- The path of the journal kept for the destination, if the
+                   receiver keeps one.
+
+    Return:
+        Two values, first the connection parameters, without FEATURE_RESUME
+        if the transfer cannot be resumable, and with the chunk size of the
+        earlier attempt if it is being resumed; and second the journal of the
+        earlier attempt to pick up from, or None to start from scratch.
+    """
+    if not params.features & utils.packet.FEATURE_RESUME:
+        return params, None
+    # Compressed data and deltas are unpacked in order, so out-of-order
+    # chunks are only ever held in memory, and could not be recorded as
+    # written.
+    if (journal is None or params.compression or not dest.seekable() or
+            params.features & utils.packet.FEATURE_DELTA):
+        return params._replace(features=params.features & ~utils.packet.FEATURE_RESUME), None
+    previous = utils.resume.Journal.load(journal)
+    if previous is None:
+        return params, None
+    if previous.resume_id != params.resume_id or previous.chunk_size > params.chunk_size:
+        # The journal is for other data, or chunks too large to resume, so
+        # none of what it records can be used.
+        os.remove(journal)
+        return params, None
+    params = params._replace(chunk_size=previous.chunk_size)
+    if params.features & utils.packet.FEATURE_FEC and (previous.expected_seq or previous.held):
+        # Parity covers whole blocks, and the chunks received earlier are not
+        # part of the decoder's sums, so parity could not be trusted.
+        params = params._replace(features=params.features & ~utils.packet.FEATURE_FEC,
+                                 fec_block=0, fec_parity=0)
+    return params, previous
+
+
+def close(sock: socket.socket, seq_num: int, checksum: utils.packet.Checksum,
+          rto: float, digest: bytes, conn_id: int = 0) -> typing.Optional[int]:
+    """Performs the sender's side of the teardown, once all data has been
+    acknowledged, sending a FIN until the receiver answers with a FIN_ACK.
+
+    Args:
+        sock -- The socket connected to the receiver.
+        seq_num -- The number of data packets sent.
+        checksum -- The negotiated checksum algorithm.
+        rto -- The current retransmission timeout, in seconds.
+        digest -- The SHA-256 digest of the data sent.
+        conn_id -- The ID of the connection.
+
+    Return:
+        The flags of the receiver's FIN_ACK, or None if it never
+        acknowledged the FIN.
+    """
+    payload = utils.packet.FIN_PAYLOAD.pack(int(rto * 1000), digest)
+    fin = utils.packet.build(utils.packet.FIN, seq_num, payload, checksum, conn_id=conn_id)
+    for _ in range(HANDSHAKE_ATTEMPTS):
+        sock.send(fin)
+        reply = wait_for(sock, utils.packet.FIN_ACK, rto, conn_id)
+        if reply is not None:
+            return reply[0].flags
+        rto = min(rto * 2, MAX_HANDSHAKE_TIMEOUT)
+    return None
+
+
+def send_parity(sock: socket.socket, block_num: int, parity: typing.List[bytes],
+                checksum: utils.packet.Checksum, conn_id: int = 0):
+    """Sends the parity packets computed for a block of data packets.
+
+    Args:
+        sock -- The socket connected to the receiver.
+        block_num -- The number of the block the parity packets protect.
+        parity -- The payloads of the parity packets, from utils.fec.Encoder.
+        checksum -- The negotiated checksum algorithm.
+        conn_id -- The ID of the connection.
+    """
+    for payload in parity:
+        sock.send(utils.packet.build(utils.packet.PARITY, block_num, payload, checksum,
+                                     conn_id=conn_id))
+
+
+def rebuilt_packets(pool: utils.stream.BufferPool,
+                    recovered: typing.List[typing.Tuple[int, bytes]]) -> typing.List[tuple]:
+    """Copies data packets rebuilt by forward error correction into pooled
+    buffers, laid out as if they had been received.
+
+    Args:
+        pool -- The pool of receive buffers.
+        recovered -- The (sequence number, payload) pairs from
+                     utils.fec.Decoder.
+
+    Return:
+        A list of (sequence number, buffer, length, rebuilt) tuples, with
+        rebuilt always True.
+    """
+    packets = []
+    for seq_num, payload in recovered:
+        buffer = pool.get()
+        end = utils.packet.HEADER.size + len(payload)
+        buffer[utils.packet.HEADER.size:end] = payload
+        packets.append((seq_num, buffer, end, True))
+    return packets
+
+
+def read_packet(reader: typing.BinaryIO, buffer: bytearray, seq_num: int,
+                checksum: utils.packet.Checksum, conn_id: int = 0) -> int:
+    """Reads the next chunk of data from the reader directly into the payload
+    of the given packet buffer, and fills in the packet's header.
+
+    Args:
+        reader -- A readable file object, with the data being sent.
+        buffer -- A buffer of utils.MAX_PACKET bytes to build the packet in.
+        seq_num -- The sequence number of the packet.
+        checksum -- The checksum algorithm to protect the packet with.
+        conn_id -- The ID of the connection.
+
+    Return:
+        The length of the packet in the buffer, or 0 if the reader has no
+        more data.
+    """
+    with memoryview(buffer) as view:
+        length = utils.stream.readinto_full(reader, view[utils.packet.HEADER.size:])
+    if not length:
+        return 0
+    return utils.packet.pack_into(buffer, utils.packet.DATA, seq_num, length, checksum,
+                                  conn_id=conn_id)
+
+
+def send(sock: socket.socket, data: utils.stream.Source, congestion: str = "reno",
+         checksum: str = "crc32", chunk_size: int = CHUNK_SIZE,
+         initial_window: int = 4,
+         fec: typing.Optional[typing.Tuple[int, int]] = None,
+         compression: typing.Optional[str] = None,
+         resume: bool = False,
+         delta: bool = False,
+         offset: int = 0,
+         conn_id: typing.Optional[int] = None,
+         batched: bool = False,
+         stats: typing.Optional[utils.stats.TransferStats] = None,
+         tracer: typing.Optional[utils.logging.Tracer] = None) -> utils.stats.TransferStats:
     """
     Implementation of the sending logic for sending data over a slow,
     lossy, constrained network.
@@ -20,91 +412,432 @@ def send(sock: socket.socket, data: bytes):
     Args:
         sock -- A socket object, constructed and initialized to communicate
                 over a simulated lossy network.
-        data -- A bytes object, containing the data to send over the network.
-    """
-    # Naive implementation where we chunk the data to be sent into
-    # packets as large as the network will allow, and then send them
-    # over the network, pausing half a second between sends to let the
-    # network "rest" :)
-    logger = homework5.logging.get_logger("hw5-sender")
-    chunk_size = homework5.MAX_PACKET - 8  # Reserve 4 bytes for header and 4 for checksum
-    packets = []
-    ack_times = {}  # Track packet sending times for RTT calculation
+        data -- The data to send over the network; a bytes object, a path to
+                a file, a binary file object, or an iterable of bytes.  It is
+                read lazily, so only the current window is held in memory.
+        congestion -- The name of the congestion control algorithm to use,
+                      one of the keys of utils.congestion.CONTROLLERS.
+        checksum -- The name of the checksum algorithm to protect packets
+                    with, one of the keys of utils.packet.CHECKSUMS.
+        chunk_size -- The number of bytes of data to propose sending in each
+                      packet; the receiver may lower it.
+        initial_window -- The initial congestion window to propose; the
+                          receiver may lower it.
+        fec -- If given, the number of data packets per block, and the
+               number of parity packets to send for each block, so the
+               receiver can rebuild up to that many lost packets per block
+               without waiting for them to be retransmitted.
+        compression -- If given, the name of the compression algorithm to
+                       propose, one of the keys of utils.compress.CODECS.
+                       Blocks that do not compress are sent as they are.
+        resume -- Whether to ask the receiver to make the transfer
+                  resumable, and to skip any chunks it already holds from an
+                  earlier attempt at sending the same data.  Only paths and
+                  bytes can be resumed.
+        delta -- Whether to ask the receiver for the signatures of its copy
+                 of the file, if it has one, and send only the data that
+                 differs from it.
+        offset -- The position in the receiver's file to write the data at,
+                  when the data is one range of a file being sent over
+                  several connections; see send_parallel.
+        conn_id -- The ID of the connection, which tells it apart from other
+                   connections to a receiver serving many at once; a random
+                   one is chosen if not given.
+        batched -- Whether to send each run of packets the window allows
+                   with one system call, where the socket supports it; see
+                   utils.batch.  The pacer then releases packets in runs of
+                   up to utils.batch.MAX_SEGMENTS.
+        stats -- Statistics to record the transfer in; a new instance is
+                 created if not given.
+        tracer -- A tracer to record every packet sent, ACK received and
+                  loss detected in, if given.
+
+    Return:
+        The statistics describing the transfer.  Its "verified" note says
+        whether the receiver confirmed that what it wrote matches the digest
+        of the data sent, or is None if it never answered the FIN.
+    """
+    # We chunk the data to be sent into packets as large as the network
+    # will allow, and send them using selective repeat: only the packets the
+    # receiver has not acknowledged, cumulatively or selectively, are ever
+    # retransmitted.  Packets are read from the source only as the window
+    # reaches them, into buffers that are recycled once acknowledged.
+    logger = utils.logging.get_logger("hw5-sender")
+    # Per-packet messages are only formatted if they will be shown, since at
+    # high packet rates formatting them would cost more than sending.
+    log_packets = logger.isEnabledFor(logging.DEBUG)
+    if stats is None:
+        stats = utils.stats.TransferStats()
+
+    # Agree on the connection parameters with the receiver first; the
+    # exchange also gives us a first sample of the round trip time.
+    features = utils.packet.SUPPORTED_FEATURES
+    resume_id = utils.resume.source_id(data) if resume else 0
+    if not resume_id:
+        features &= ~utils.packet.FEATURE_RESUME
+    if not delta:
+        features &= ~utils.packet.FEATURE_DELTA
+    fec_block, fec_parity = fec or (0, 0)
+    if fec is None:
+        features &= ~utils.packet.FEATURE_FEC
+    else:
+        chunk_size = min(chunk_size, FEC_CHUNK_SIZE)
+    proposed = utils.packet.Params(
+        chunk_size=min(chunk_size, CHUNK_SIZE),
+        initial_window=initial_window,
+        checksum_id=utils.packet.get_checksum(checksum).ident,
+        features=features,
+        fec_block=fec_block,
+        fec_parity=fec_parity,
+        compression=utils.compress.get_codec(compression).ident if compression else 0,
+        resume_id=resume_id,
+        offset=offset)
+    if conn_id is None:
+        conn_id = random.getrandbits(32)
+    params, rtt_sample = connect(sock, proposed, conn_id)
+    stats.sample("rtt", rtt_sample)
+    logger.info("Connected with %s", params)
+    packet_checksum = utils.packet.CHECKSUMS_BY_ID[params.checksum_id]
 
-    # Prepare packets
-    for i in range(0, len(data), chunk_size):
-        seq_num = i // chunk_size
-        header = struct.pack('!I', seq_num)
-        payload = data[i:i + chunk_size]
-        checksum = sum(header + payload) & 0xFFFFFFFF  # Simple checksum
-        packets.append(header + struct.pack('!I', checksum) + payload)
+    # When resuming, start from the receiver's cumulative point, and never
+    # send the chunks it holds beyond that.
+    resume_point = 0
+    held = set()  # Chunks after 'base' the receiver held before we started
+    if params.features & utils.packet.FEATURE_RESUME:
+        resume_point, held = utils.resume.parse_resume(fetch_pages(
+            sock, utils.packet.RESUME_REQUEST, utils.packet.RESUME, packet_checksum, conn_id))
+        stats.count("resumed_chunks", resume_point + len(held))
+        if resume_point or held:
+            logger.info("Resuming from packet %d, skipping %d more.",
+                        resume_point, len(held))
 
-    logger.info(f"Sending {len(packets)} packets.")
+    # For a delta, learn which blocks the receiver's copy of the file has.
+    signatures = None
+    if params.features & utils.packet.FEATURE_DELTA:
+        block_size, signatures = utils.delta.parse_signatures(fetch_pages(
+            sock, utils.packet.SIGNATURE_REQUEST, utils.packet.SIGNATURES, packet_checksum,
+            conn_id))
+        logger.info("Received signatures of %d distinct blocks of %d bytes.",
+                    len(signatures), block_size)
+
+    pool = utils.stream.BufferPool(utils.packet.HEADER.size + params.chunk_size)
+    batch = utils.batch.BatchSender(sock, batched)  # Sends data and parity packets
+    # Packets the pacer releases at once.  When sends are batched, a whole
+    # run of them is released per pacing tick, spaced out as far as that
+    # many packets would be, so that the run goes out in one system call.
+    quantum = utils.batch.MAX_SEGMENTS if batch.batching else 1
+    packets = {}  # Every unacknowledged packet that has been sent, by sequence number
+    ack_times = {}  # Send times of every unacknowledged packet that has been sent
 
     # We keep track of the 'base' sequence number and the 'next_seq'
     # sequence number.  The 'base' sequence number is the sequence number
-    # of the first packet in the window, and the 'next_seq' sequence number
-    # is the sequence number of the next packet to be sent.  The window
-    # starts at 'base' and ends at 'next_seq'.
-    base = 0
-    next_seq = 0
-    window_size = 2
-    estimated_rtt = 0.5 # Estimated round trip time.
-    dev_rtt = 0.1 # Deviation of round trip time.
+    # of the first unacknowledged packet, and the 'next_seq' sequence number
+    # is the sequence number of the next packet to be sent for the first
+    # time.  How many packets may be outstanding between the two, and how
+    # quickly they are sent, is decided by the congestion controller.
+    base = resume_point
+    next_seq = resume_point
+    controller = utils.congestion.get_controller(
+        congestion, initial_window=params.initial_window)
+    # Packets further past 'base' than an ACK can selectively acknowledge
+    # could only ever be acknowledged by their timers expiring.
+    max_outstanding = min(controller.max_window, SACK_BITS + 1)
+    encoder = None  # Computes parity packets, if the receiver accepted them
+    if params.features & utils.packet.FEATURE_FEC:
+        encoder = utils.fec.Encoder(params.fec_block, params.fec_parity, params.chunk_size)
+    next_send_time = 0.0  # Earliest time the pacer allows the next send
+    estimated_rtt = rtt_sample # Estimated round trip time.
+    dev_rtt = rtt_sample / 2 # Deviation of round trip time.
     alpha, beta = 0.125, 0.25 # The alpha and beta parameters for the EWMA algorithm.
-    acked = set() # Set of packets that have been acknowledged.
+    backoff = 1 # Multiplier applied to the RTO, doubled on every timeout.
+    # Packets at or after 'base' that have been selectively acknowledged, as
+    # a bitmap where bit i stands for packet base + i, so that each ACK costs
+    # only as much Python work as it acknowledges new packets.
+    acked_bits = 0
+    loss_scan = base # Holes before this have already been checked for loss.
+    lost = set() # Packets deemed lost, and waiting to be retransmitted.
+    lost_order = [] # Heap of the packets in 'lost', and some no longer in it.
+    retransmitted = set() # Packets sent more than once, which give no RTT samples.
+    fast_retransmitted = set() # Packets already resent without waiting for a timeout.
+    timers = [] # Heap of (deadline, sequence number, send time) retransmission timers.
+    dup_acks = 0 # Number of ACKs in a row that did not advance 'base'.
+    recovery_point = 0 # Losses before this packet belong to the last recovery episode.
+    last_timeout = 0.0 # When the retransmission timer last expired.
+    eof = False # Whether every packet has been read from the source.
 
-    while base < len(packets):
-        while next_seq < base + window_size and next_seq < len(packets):
-            if next_seq not in acked:
-                sock.send(packets[next_seq])
-                ack_times[next_seq] = time.time()
-                logger.info(f"Sent packet {next_seq}")
-            next_seq += 1
+    with contextlib.ExitStack() as stack:
+        reader = stack.enter_context(utils.stream.open_source(data))
+        # The digest covers the data itself, before any delta or compression,
+        # so the receiver's check covers undoing them too.
+        reader = hashing_reader = stack.enter_context(
+            utils.stream.HashingReader(reader, hashlib.sha256()))
+        if signatures is not None:
+            reader = delta_reader = stack.enter_context(
+                utils.delta.DeltaReader(reader, block_size, signatures))
+        if params.compression:
+            codec = utils.compress.CODECS_BY_ID[params.compression]
+            reader = stack.enter_context(utils.compress.CompressingReader(reader, codec))
+        utils.stream.skip(reader, resume_point * params.chunk_size)
+        while not eof or base < next_seq:
+            now = time.time()
+            in_flight = len(ack_times) - len(lost)
+            released = 0  # Packets sent since the pacer last allowed a send
+            while in_flight < controller.window and (now >= next_send_time or
+                                                     0 < released < quantum):
+                parity = []  # Parity packets to follow this packet
+                if lost:
+                    seq = heapq.heappop(lost_order)
+                    while seq not in lost:
+                        seq = heapq.heappop(lost_order)
+                    lost.remove(seq)
+                    retransmitted.add(seq)
+                    stats.count("retransmissions")
+                    if log_packets:
+                        logger.debug("Retransmitting packet %d", seq)
+                    if tracer is not None:
+                        tracer.record(utils.logging.RETRANSMIT, seq)
+                elif not eof and next_seq < base + max_outstanding:
+                    while next_seq in held:
+                        utils.stream.skip(reader, params.chunk_size)
+                        next_seq += 1
+                    buffer = pool.get()
+                    length = read_packet(reader, buffer, next_seq, packet_checksum, conn_id)
+                    if not length:
+                        pool.put(buffer)
+                        eof = True
+                        if encoder is not None:
+                            # The last block is cut short by the end of the data.
+                            parity = encoder.flush()
+                            send_parity(batch, (next_seq - 1) // params.fec_block,
+                                        parity, packet_checksum, conn_id)
+                            stats.count("parity_packets", len(parity))
+                            if tracer is not None and parity:
+                                tracer.record(utils.logging.PARITY,
+                                              (next_seq - 1) // params.fec_block, len(parity))
+                        break
+                    seq = next_seq
+                    packets[seq] = memoryview(buffer)[:length]
+                    if encoder is not None:
+                        parity = encoder.add(packets[seq][utils.packet.HEADER.size:])
+                    stats.count("packets")
+                    stats.count("bytes", length - utils.packet.HEADER.size)
+                    next_seq += 1
+                    if log_packets:
+                        logger.debug("Sending packet %d", seq)
+                    if tracer is not None:
+                        tracer.record(utils.logging.SEND, seq)
+                else:
+                    break
+                batch.send(packets[seq])
+                stats.count("transmissions")
+                ack_times[seq] = now
+                rto = max(estimated_rtt + 4 * dev_rtt, MIN_RTO) * backoff
+                heapq.heappush(timers, (now + min(rto, MAX_RTO), seq, now))
+                in_flight += 1
+                released += 1
+                next_send_time = max(next_send_time, now) + controller.pacing_interval(estimated_rtt)
+                if parity:
+                    # Parity packets are never acknowledged or resent, so they
+                    # only count against the pacer, not the window.
+                    send_parity(batch, seq // params.fec_block, parity, packet_checksum, conn_id)
+                    stats.count("parity_packets", len(parity))
+                    if tracer is not None:
+                        tracer.record(utils.logging.PARITY, seq // params.fec_block, len(parity))
+                    next_send_time += len(parity) * controller.pacing_interval(estimated_rtt)
+                now = time.time()
+            batch.flush()
+            if eof and base == next_seq:
+                break  # The end of the source was only just found
 
-        try:
-            # Set the socket timeout to the estimated RTT + 4 * deviation
-            # to ensure that we wait long enough for the packets to be
-            # acknowledged.
-            timeout = estimated_rtt + 4 * dev_rtt
-            sock.settimeout(timeout)
-            ack = sock.recv(4)
-            logger.info(f"Received ACK: {ack}")
-            ack_seq = struct.unpack('!I', ack)[0]
-            logger.info(f"Received ACK for {ack_seq}")
-
-            if ack_seq >= base:
-                # If we received an ACK for a packet that is in our window,
-                # slide the window forward and update the base.
-                prev_ack = all(seq in acked for seq in range(base, ack_seq))
-                if prev_ack:
-                  acked.add(ack_seq)
-                  base = ack_seq + 1
-
-            if ack_seq in ack_times:
-                # Calculate the RTT sample and update the estimated RTT and
-                # deviation.
-                rtt_sample = time.time() - ack_times[ack_seq]
-                estimated_rtt = (1 - alpha) * estimated_rtt + alpha * rtt_sample
-                dev_rtt = (1 - beta) * dev_rtt + beta * abs(rtt_sample - estimated_rtt)
+            # Timers are never removed from the heap when their packet is
+            # acknowledged or resent, so skip past any that no longer apply.
+            while timers and (timers[0][1] in lost or
+                              ack_times.get(timers[0][1]) != timers[0][2]):
+                heapq.heappop(timers)
 
-        except socket.timeout:
-            logger.warning("Timeout occurred. Retransmitting.")
-            # If a timeout occurs, increase the estimated RTT
-            # so that we wait longer for the packets to be acknowledged.
-            # estimated_rtt += 0.5
-            # Go back to the base of the window and start again.
-            next_seq = base
-            # Remove any packets that have already been acknowledged after the base
-            logger.info(f"**** Acked: {acked}, base: {base} ****")
-            acked = {seq for seq in acked if seq < next_seq}
+            # Wait for an ACK until either the pacer lets us send again, or the
+            # earliest retransmission timer expires.
+            rto_deadline = timers[0][0] if timers else float('inf')
+            wake_time = rto_deadline
+            if (lost or not eof) and in_flight < controller.window:
+                wake_time = min(wake_time, next_send_time)
+            timeout = max(wake_time - now, 0.0005)
+
+            try:
+                sock.settimeout(timeout)
+                ack = sock.recv(utils.MAX_PACKET)
+                header = utils.packet.unpack_from(ack, len(ack))
+                if header is None or header.ptype != utils.packet.ACK:
+                    logger.debug("Dropping corrupt ACK.")
+                    if tracer is not None:
+                        tracer.record(utils.logging.CORRUPT, 0)
+                    stats.count("corrupt_acks")
+                    continue
+                if header.conn_id != conn_id:
+                    # Meant for another connection sharing the receiver.
+                    stats.count("foreign_packets")
+                    continue
+                cum_ack, sack_bits = parse_ack(header, ack)
+                stats.count("acks")
+                if log_packets:
+                    logger.debug("Received ACK for %d, SACK %x", cum_ack, sack_bits)
+                if tracer is not None:
+                    tracer.record(utils.logging.ACK, cum_ack, bin(sack_bits).count("1"))
+
+                # Line the SACK bitmap up with ours, which starts at 'base',
+                # and keep only the packets sent and not yet acknowledged.
+                shift = cum_ack + 1 - base
+                sack_bits = sack_bits << shift if shift >= 0 else sack_bits >> -shift
+                sack_bits &= ~acked_bits & ((1 << (next_seq - base)) - 1)
+                acked_bits |= sack_bits
+                newly_acked = []
+                while sack_bits:
+                    lowest = sack_bits & -sack_bits
+                    sack_bits ^= lowest
+                    seq = base + lowest.bit_length() - 1
+                    if seq in ack_times:  # Not one held before we started
+                        newly_acked.append(seq)
+                if cum_ack > base:
+                    # Everything before the cumulative ACK point has arrived, so
+                    # slide the window forward.  Packets already acknowledged
+                    # are no longer in ack_times.
+                    new_base = min(cum_ack, next_seq)
+                    newly_acked.extend(seq for seq in range(base, new_base) if seq in ack_times)
+                    acked_bits >>= new_base - base
+                    base = new_base
+                    loss_scan = max(loss_scan, base)
+                    dup_acks = 0
+                else:
+                    dup_acks += 1
 
-    final_packet = struct.pack('!I', 2**32 - 1) + struct.pack('!I', 0)
-    sock.send(final_packet)
-    logger.info("Sent final packet to signal completion.")
+                now = time.time()
+                for seq in newly_acked:
+                    sent_time = ack_times.pop(seq)
+                    lost.discard(seq)
+                    fast_retransmitted.discard(seq)
+                    pool.put(packets.pop(seq).obj)
+                    if seq in retransmitted:
+                        # Karn's rule: we cannot tell which transmission this
+                        # ACK is for, so the sample would be ambiguous.
+                        retransmitted.remove(seq)
+                        continue
+                    # Calculate the RTT sample and update the estimated RTT and
+                    # deviation.
+                    rtt_sample = now - sent_time
+                    estimated_rtt = (1 - alpha) * estimated_rtt + alpha * rtt_sample
+                    dev_rtt = (1 - beta) * dev_rtt + beta * abs(rtt_sample - estimated_rtt)
+                    stats.sample("rtt", rtt_sample)
+                    backoff = 1
+                if newly_acked:
+                    controller.on_ack(len(newly_acked), now, estimated_rtt)
+                    stats.sample("cwnd", controller.cwnd)
+                    stats.sample("estimated_rtt", estimated_rtt)
+                else:
+                    stats.count("duplicate_acks")
 
+                # Fast retransmit: a packet is presumed lost, without waiting
+                # for its timer, once DUP_THRESH packets sent after it have
+                # been selectively acknowledged, or DUP_THRESH duplicate ACKs
+                # have arrived while it is the oldest unacknowledged packet.
+                # Every hole before the DUP_THRESH-th highest packet
+                # selectively acknowledged qualifies, and holes are only
+                # checked the first time that point moves past them.
+                newly_lost = []
+                if dup_acks >= DUP_THRESH and base in ack_times:
+                    newly_lost.append(base)
+                threshold = acked_bits
+                for _ in range(DUP_THRESH - 1):
+                    if not threshold:
+                        break
+                    threshold ^= 1 << (threshold.bit_length() - 1)
+                if threshold:
+                    threshold_seq = base + threshold.bit_length() - 1
+                    newly_lost.extend(seq for seq in range(loss_scan, threshold_seq)
+                                      if seq in ack_times)
+                    loss_scan = max(loss_scan, threshold_seq)
+                newly_lost = {seq for seq in newly_lost if seq in ack_times and
+                              seq not in lost and seq not in fast_retransmitted}
+                if newly_lost:
+                    if log_packets:
+                        logger.debug("Fast retransmitting %s", sorted(newly_lost))
+                    if tracer is not None:
+                        for seq in newly_lost:
+                            tracer.record(utils.logging.FAST_RETRANSMIT, seq)
+                    stats.count("fast_retransmits", len(newly_lost))
+                    if base >= recovery_point:
+                        # Only back off once per window of losses.
+                        controller.on_loss(in_flight, now)
+                        stats.sample("cwnd", controller.cwnd)
+                        recovery_point = next_seq
+                    lost.update(newly_lost)
+                    for seq in newly_lost:
+                        heapq.heappush(lost_order, seq)
+                    fast_retransmitted.update(newly_lost)
 
-def recv(sock: socket.socket, dest: io.BufferedIOBase) -> int:
+            except socket.timeout:
+                now = time.time()
+                expired = []
+                while timers and timers[0][0] <= now:
+                    _, seq, sent_time = heapq.heappop(timers)
+                    if seq not in lost and ack_times.get(seq) == sent_time:
+                        expired.append((seq, sent_time))
+                if expired:
+                    # Only the holes in the window are resent; packets the
+                    # receiver already holds are never sent again.
+                    logger.info("Timeout occurred. Retransmitting %d packets.", len(expired))
+                    if tracer is not None:
+                        tracer.record(utils.logging.TIMEOUT, base, len(expired))
+                    stats.count("timeouts")
+                    if log_packets:
+                        logger.debug("**** Acked: %x, base: %d ****", acked_bits, base)
+                    if max(sent_time for _, sent_time in expired) > last_timeout:
+                        # Packets sent before the previous timeout were part
+                        # of the window it already backed off for.
+                        controller.on_timeout(in_flight, now)
+                        stats.sample("cwnd", controller.cwnd)
+                        stats.count("timeout_episodes")
+                        backoff = min(backoff * 2, MAX_BACKOFF)
+                        recovery_point = next_seq
+                        last_timeout = now
+                    lost.update(seq for seq, _ in expired)
+                    for seq, _ in expired:
+                        heapq.heappush(lost_order, seq)
+                    fast_retransmitted.difference_update(seq for seq, _ in expired)
+
+        if signatures is not None:
+            stats.count("literal_bytes", delta_reader.literal_bytes)
+            stats.count("copied_bytes", delta_reader.copied_bytes)
+        if params.compression:
+            stats.count("raw_bytes", reader.raw_bytes)
+            stats.count("compressed_blocks", reader.compressed_blocks)
+            stats.count("stored_blocks", reader.stored_blocks)
+    stats.count("send_calls", batch.calls)
+
+    digest = hashing_reader.hasher.digest()
+    stats.note("digest", digest.hex())
+    stats.note("size", hashing_reader.num_bytes)
+    rto = min(max(estimated_rtt + 4 * dev_rtt, MIN_RTO) * backoff, MAX_RTO)
+    fin_flags = close(sock, next_seq, packet_checksum, rto, digest, conn_id)
+    if fin_flags is None:
+        logger.warning("The receiver never acknowledged the FIN. Closing anyway.")
+        stats.note("verified", None)
+    elif fin_flags & utils.packet.FLAG_DIGEST_MISMATCH:
+        logger.error("The receiver's copy of the data does not match what was sent.")
+        stats.note("verified", False)
+    else:
+        logger.info("Connection closed, after %d packets.", next_seq)
+        stats.note("verified", True)
+
+    stats.finish()
+    return stats
+
+
+def recv(sock: socket.socket, dest: io.BufferedIOBase,
+         stats: typing.Optional[utils.stats.TransferStats] = None,
+         tracer: typing.Optional[utils.logging.Tracer] = None,
+         journal: typing.Optional[str] = None,
+         basis: typing.Optional[typing.BinaryIO] = None,
+         batched: bool = False) -> int:
     """
     Implementation of the receiving logic for receiving data over a slow,
     lossy, constrained network.
@@ -112,67 +845,556 @@ def recv(sock: socket.socket, dest: io.BufferedIOBase) -> int:
     Args:
         sock -- A socket object, constructed and initialized to communicate
                 over a simulated lossy network.
+        dest -- A binary file object to write the received data to.  If it
+                is seekable, out-of-order data is written directly at its
+                offset instead of being held in memory.
+        stats -- Statistics to record the transfer in, if given.
+        tracer -- A tracer to record every packet received in, if given.
+        journal -- If given, the path to keep a journal of the chunks
+                   written at, so that if the transfer is interrupted, a
+                   resumable transfer of the same data can pick up where
+                   this one left off.  The destination must then be seekable,
+                   and opened without truncating it.
+        basis -- If given, an earlier version of the data, open for reading,
+                 which the sender may send just the differences from.
+        batched -- Whether to receive runs of datagrams the kernel coalesces
+                   with one system call, and send the ACKs for them with
+                   one, where the socket supports it; see utils.batch.
 
     Return:
-        The number of bytes written to the destination.
+        The number of bytes written to the destination.  Whether they match
+        the digest the sender sent with its FIN is recorded in the
+        "verified" note of the statistics.
     """
-    logger = homework5.logging.get_logger("hw5-receiver")
-    received_packets = {}  # Dictionary to store packets by their sequence number
+    logger = utils.logging.get_logger("hw5-receiver")
+    log_packets = logger.isEnabledFor(logging.DEBUG)
+    if stats is None:
+        stats = utils.stats.TransferStats()
+    pool = utils.stream.BufferPool(utils.MAX_PACKET)
+    receiver = utils.batch.BatchReceiver(sock, pool, batched)
+    acks = utils.batch.BatchSender(sock, batched)
+    params = None  # The connection parameters, once the sender's SYN arrives
+    conn_id = None  # The sender's ID for the connection, from its SYN
+    writer = None  # Created once the handshake has settled the chunk size
+    decompressor = None  # Unpacks compressed data, if the sender compresses it
+    patcher = None  # Applies a delta to the basis, if the sender sends one
+    decoder = None  # Rebuilds lost packets, if the sender sends parity packets
+    checksum = utils.packet.DEFAULT_CHECKSUM
+    received_packets = set()  # Sequence numbers of packets received out-of-order
     expected_seq = 0  # The next expected sequence number
-    num_bytes = 0  # Total number of bytes written to the destination
+    linger = None  # How long to keep answering FINs after the connection closes
+    digest = None  # The sender's digest of the data, from its FIN
+    hasher = hashlib.sha256()  # Digests the data as it is written
+    resumable = False  # Whether a journal is being kept
+    paged_replies = {}  # Replies split into pages, and their type, by request type
+    since_journal = 0  # Data packets received since the journal was last saved
+    previous_timeout = sock.gettimeout()
+    flush_timeout = WRITE_FLUSH_TIMEOUT  # Bounds waits while the writer batches data
+    if previous_timeout is not None:
+        flush_timeout = min(flush_timeout, previous_timeout)
+    flushing = False  # Whether waits are bounded by flush_timeout
 
     while True:
         try:
-            # Receive a packet from the socket
-            packet = sock.recv(homework5.MAX_PACKET)
-            if not packet:
+            # Send the ACKs held back while handing out a run of coalesced
+            # packets, before waiting for more.
+            if not receiver.pending:
+                acks.flush()
+            # Wait only so long while data is batched in memory, so that it
+            # is written out, on timeout, if the sender goes quiet.
+            if (writer is not None and writer.buffered > 0) != flushing:
+                flushing = not flushing
+                sock.settimeout(flush_timeout if flushing else previous_timeout)
+            # Receive a packet from the socket, into a pooled buffer
+            buffer, length = receiver.receive()
+            if not length:
                 break  # Exit if no more data is received
+            stats.count("datagrams")
 
-            # Extract sequence number, checksum, and payload from the packet
-            seq_num = struct.unpack('!I', packet[:4])[0]
-            checksum = struct.unpack('!I', packet[4:8])[0]
-            payload = packet[8:]
+            # Parse the header, verifying the checksum to ensure packet
+            # integrity
+            header = utils.packet.unpack_from(buffer, length)
+            if header is None:
+                logger.debug("Malformed packet or checksum mismatch. Dropping packet.")
+                if tracer is not None:
+                    tracer.record(utils.logging.CORRUPT, 0, length)
+                stats.count("checksum_failures")
+                pool.put(buffer)
+                continue  # Drop the packet if checksum doesn't match
 
-            # Check for the final packet, which signals completion
-            if seq_num == 2**32 - 1:
-                logger.info("Received final packet. Ending reception.")
-                break
+            if conn_id is not None and header.conn_id != conn_id:
+                # Meant for another connection sharing the socket.
+                stats.count("foreign_packets")
+                pool.put(buffer)
+                continue
 
-            # Verify the checksum to ensure packet integrity
-            calculated_checksum = sum(packet[:4] + payload) & 0xFFFFFFFF
-            if checksum != calculated_checksum:
-                logger.warning(f"Checksum mismatch for packet {seq_num}. Dropping packet.")
-                continue  # Drop the packet if checksum doesn't match
+            if header.ptype == utils.packet.SYN:
+                # The sender resends its SYN until our SYN_ACK gets through,
+                # so every copy is answered with the same parameters.
+                if params is None:
+                    conn_id = header.conn_id
+                    params = negotiate(utils.packet.Params.unpack_from(buffer))
+                    if basis is None:
+                        params = params._replace(
+                            features=params.features & ~utils.packet.FEATURE_DELTA)
+                    params, previous = accept_resume(params, dest, journal)
+                    if previous is not None:
+                        expected_seq = previous.expected_seq
+                        received_packets = set(previous.held)
+                        logger.info("Resuming from packet %d, holding %d more.",
+                                    expected_seq, len(received_packets))
+                    elif params.features & utils.packet.FEATURE_RESUME:
+                        # Whatever is in the file is not part of this data.
+                        dest.seek(0)
+                        dest.truncate()
+                    if params.offset:
+                        # This connection carries one range of a file sent
+                        # in parallel; see recv_parallel.
+                        dest.seek(params.offset)
+                    if params.features & utils.packet.FEATURE_RESUME:
+                        resumable = True
+                        paged_replies[utils.packet.RESUME_REQUEST] = (
+                            utils.packet.RESUME,
+                            utils.resume.resume_pages(expected_seq, received_packets,
+                                                      CHUNK_SIZE))
+                    checksum = utils.packet.CHECKSUMS_BY_ID[params.checksum_id]
+                    # Deltas and the frames of compressed data can only be
+                    # unpacked in order, so the writer is then handed a
+                    # destination it cannot seek, and the data they unpack
+                    # to is hashed on its way to the file.  Otherwise the
+                    # writer hashes the chunks itself, in order.
+                    output = dest
+                    chunk_hasher = hasher
+                    if params.features & utils.packet.FEATURE_DELTA or params.compression:
+                        output = utils.stream.HashingWriter(dest, hasher)
+                        chunk_hasher = None
+                    if params.features & utils.packet.FEATURE_DELTA:
+                        output = patcher = utils.delta.DeltaWriter(output, basis)
+                        paged_replies[utils.packet.SIGNATURE_REQUEST] = (
+                            utils.packet.SIGNATURES,
+                            utils.delta.signature_pages(basis, patcher.block_size,
+                                                        CHUNK_SIZE))
+                    if params.compression:
+                        output = decompressor = utils.compress.DecompressingWriter(output)
+                    writer = utils.stream.ChunkWriter(output, params.chunk_size, pool,
+                                                      hasher=chunk_hasher)
+                    if previous is not None:
+                        writer.resume(previous.expected_seq, previous.held)
+                    if params.features & utils.packet.FEATURE_FEC:
+                        decoder = utils.fec.Decoder(params.fec_block, params.fec_parity,
+                                                    params.chunk_size)
+                    logger.info("Accepted connection with %s", params)
+                pool.put(buffer)
+                sock.send(utils.packet.build(utils.packet.SYN_ACK, 0, params.pack(),
+                                             utils.packet.DEFAULT_CHECKSUM, conn_id=conn_id))
+                continue
+
+            if header.ptype in paged_replies:
+                pool.put(buffer)
+                reply_type, pages = paged_replies[header.ptype]
+                if header.seq_num < len(pages):
+                    sock.send(utils.packet.build(reply_type, header.seq_num,
+                                                 pages[header.seq_num], checksum,
+                                                 conn_id=conn_id))
+                continue
+
+            if writer is None or header.ptype not in (utils.packet.DATA, utils.packet.FIN,
+                                                      utils.packet.PARITY):
+                pool.put(buffer)
+                continue
 
-            # Store the packet if it's not already received
-            if seq_num not in received_packets:
-                received_packets[seq_num] = payload
+            # Check for the final packet, which signals completion once every
+            # packet before it has arrived
+            if header.ptype == utils.packet.FIN:
+                rto_ms, fin_digest = utils.packet.FIN_PAYLOAD.unpack_from(
+                    buffer, utils.packet.HEADER.size)
+                pool.put(buffer)
+                if header.seq_num == expected_seq:
+                    logger.info("Received final packet. Ending reception.")
+                    linger = LINGER_RTOS * rto_ms / 1000
+                    digest = fin_digest
+                    break
+                continue
+
+            # Parity packets are only acknowledged if they let us rebuild
+            # some lost data packets, since an ACK that acknowledges nothing
+            # new would look like a duplicate ACK to the sender.
+            if header.ptype == utils.packet.PARITY:
+                arrivals = []
+                if decoder is not None and (header.seq_num + 1) * params.fec_block > expected_seq:
+                    decoder.discard_before(expected_seq)
+                    with memoryview(buffer) as view:
+                        recovered = decoder.add_parity(
+                            header.seq_num, bytes(view[utils.packet.HEADER.size:length]))
+                    arrivals = rebuilt_packets(pool, recovered)
+                pool.put(buffer)
+                if not arrivals:
+                    continue
             else:
-                logger.warning(f"Duplicate packet {seq_num}. Dropping packet.")
-                # Send acknowledgment for the duplicate packet
-                ack = struct.pack('!I', seq_num)
-                sock.send(ack)
-                logger.info(f"Sent ACK for packet {seq_num}")
-                continue  # Drop the packet if it's a duplicate
-
-            # Write sequential packets to the destination
-            while expected_seq in received_packets:
-                logger.info(f"Reconstructed packet for {expected_seq}")
-                # Send acknowledgment for the received packet
-                ack = struct.pack('!I', expected_seq)
-                sock.send(ack)
-                logger.info(f"Sent ACK for packet {expected_seq}")
-                # Write the payload to the destination
-                dest.write(received_packets[expected_seq])
-                num_bytes += len(received_packets[expected_seq])
-                dest.flush()  # Ensure data is written out immediately
-                # Remove the packet from the dictionary and update the expected sequence number
-                del received_packets[expected_seq]
-                expected_seq += 1
+                arrivals = [(header.seq_num, buffer, length, False)]
+
+            # Hand each payload to the writer if it's not already received.
+            # Duplicates are still acknowledged, since the sender may have
+            # missed our ACK.
+            while arrivals:
+                seq_num, buffer, length, rebuilt = arrivals.pop()
+                if seq_num < expected_seq or seq_num in received_packets:
+                    if not rebuilt:
+                        if log_packets:
+                            logger.debug("Duplicate packet %d. Dropping packet.", seq_num)
+                        if tracer is not None:
+                            tracer.record(utils.logging.DUPLICATE, seq_num)
+                        stats.count("duplicates")
+                    pool.put(buffer)
+                    continue
+                if rebuilt:
+                    if log_packets:
+                        logger.debug("Rebuilt lost packet %d from parity.", seq_num)
+                    if tracer is not None:
+                        tracer.record(utils.logging.RECOVER, seq_num, expected_seq)
+                    stats.count("fec_recovered")
+                elif decoder is not None:
+                    with memoryview(buffer) as view:
+                        recovered = decoder.add_data(
+                            seq_num, view[utils.packet.HEADER.size:length])
+                    arrivals.extend(rebuilt_packets(pool, recovered))
+                writer.write(seq_num, buffer, utils.packet.HEADER.size, length)
+                stats.count("packets")
+                if tracer is not None and not rebuilt:
+                    tracer.record(utils.logging.RECEIVE, seq_num, expected_seq)
+                if seq_num != expected_seq:
+                    stats.count("out_of_order")
+                received_packets.add(seq_num)
+                while expected_seq in received_packets:
+                    received_packets.remove(expected_seq)
+                    expected_seq += 1
+                since_journal += 1
+
+            if resumable and since_journal >= utils.resume.JOURNAL_PACKETS:
+                # Only chunks already written out may be recorded as written.
+                writer.flush()
+                utils.resume.Journal(params.resume_id, params.chunk_size, expected_seq,
+                                     sorted(received_packets)).save(journal)
+                since_journal = 0
+
+            # Acknowledge everything before expected_seq, plus whichever
+            # out-of-order packets we are holding.
+            acks.send(make_ack(expected_seq, received_packets, checksum, conn_id))
+            stats.count("acks")
+            stats.sample("held_out_of_order", len(received_packets))
+            if log_packets:
+                logger.debug("Sent ACK for %d", expected_seq)
 
         except socket.timeout:
-            logger.warning("Timeout occurred while waiting for a packet.")
+            logger.debug("Timeout occurred while waiting for a packet.")
+            if writer is not None:
+                writer.flush()
+                if resumable and since_journal:
+                    utils.resume.Journal(params.resume_id, params.chunk_size, expected_seq,
+                                         sorted(received_packets)).save(journal)
+                    since_journal = 0
             continue  # Continue to the next iteration on timeout
 
+    acks.flush()
+    sock.settimeout(previous_timeout)
+    stats.count("recv_calls", receiver.calls)
+    stats.finish()
+    if writer is None:
+        return 0
+    writer.close()
+    if resumable and linger is not None:
+        # The transfer is complete, so there is nothing left to resume.
+        try:
+            os.remove(journal)
+        except FileNotFoundError:
+            pass
+    elif resumable:
+        utils.resume.Journal(params.resume_id, params.chunk_size, expected_seq,
+                             sorted(received_packets)).save(journal)
+    num_bytes = writer.num_bytes
+    if decompressor is not None:
+        if decompressor.pending:
+            logger.warning("The data ended part way through a compressed block.")
+        stats.count("compressed_bytes", num_bytes)
+        num_bytes = decompressor.num_bytes
+    if patcher is not None:
+        if patcher.pending:
+            logger.warning("The data ended part way through a delta operation.")
+        stats.count("delta_bytes", num_bytes)
+        stats.count("copied_bytes", patcher.copied_bytes)
+        num_bytes = patcher.num_bytes
+    stats.count("bytes", num_bytes)
+
+    # Check what was written against the digest the sender sent with its FIN,
+    # and tell the sender if they differ.
+    fin_flags = 0
+    if digest is not None:
+        stats.note("digest", hasher.hexdigest())
+        stats.note("verified", hasher.digest() == digest)
+        if hasher.digest() != digest:
+            logger.error("The data received does not match the sender's digest.")
+            stats.count("digest_mismatches")
+            fin_flags |= utils.packet.FLAG_DIGEST_MISMATCH
+
+    # Acknowledge the FIN, and keep acknowledging it for as long as the sender
+    # might still be retransmitting it.
+    fin_ack = utils.packet.build(utils.packet.FIN_ACK, expected_seq, b'', checksum,
+                                 fin_flags, conn_id)
+    if linger is not None:
+        sock.send(fin_ack)
+        while wait_for(sock, utils.packet.FIN, linger, conn_id) is not None:
+            sock.send(fin_ack)
+        sock.settimeout(previous_timeout)
+
     return num_bytes
 
+
+def split_ranges(size: int, flows: int) -> typing.List[typing.Tuple[int, int]]:
+    """Splits data of the given size into one contiguous range per flow, as
+    evenly as possible.
+
+    Return:
+        The offset and length of each range, in order.
+    """
+    share, extra = divmod(size, flows)
+    ranges = []
+    offset = 0
+    for flow in range(flows):
+        length = share + (1 if flow < extra else 0)
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
+
+def combine_verified(notes: typing.Iterable[typing.Dict[str, typing.Any]]) -> typing.Optional[bool]:
+    """Combines the "verified" notes of several flows: False if any flow's
+    data did not match, None if any flow never finished, and True only if
+    every flow's data matched.
+    """
+    verified = [a_note.get("verified") for a_note in notes]
+    if False in verified:
+        return False
+    if None in verified:
+        return None
+    return True
+
+
+def send_parallel(socks: typing.Sequence[socket.socket], data: utils.stream.Source,
+                  stats: typing.Optional[utils.stats.TransferStats] = None,
+                  **kwargs) -> utils.stats.TransferStats:
+    """Sends data over several connections at once, each carrying one range
+    of it from its own thread, so the transfer is not limited by a single
+    connection's window.  The receiver must call recv_parallel with its ends
+    of the same connections, in the same order.
+
+    Args:
+        socks -- The sockets to send over, one per flow.
+        data -- The data to send; a path to a file, or a bytes-like object,
+                since each flow must be able to read its range on its own.
+        stats -- Statistics to record the combined transfer in; a new
+                 instance is created if not given.
+        kwargs -- Any other arguments to send, which apply to every flow.
+                  Resuming, deltas and tracing are not supported.
+
+    Return:
+        The statistics describing the transfer.  Its "flows" note holds the
+        notes of each flow, and its "verified" note combines theirs.
+    """
+    if stats is None:
+        stats = utils.stats.TransferStats()
+    if isinstance(data, (str, os.PathLike)):
+        ranges = split_ranges(os.path.getsize(data), len(socks))
+        sources = [utils.stream.FileRange(data, offset, length) for offset, length in ranges]
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        view = memoryview(data).cast('B')
+        ranges = split_ranges(len(view), len(socks))
+        sources = [view[offset:offset + length] for offset, length in ranges]
+    else:
+        raise ValueError("Only paths and bytes-like objects can be sent in parallel.")
+
+    flow_stats = [utils.stats.TransferStats(record_series=stats.record_series)
+                  for _ in socks]
+    with contextlib.ExitStack() as stack:
+        for a_source in sources:
+            if isinstance(a_source, io.IOBase):
+                stack.callback(a_source.close)
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(len(socks)))
+        futures = [executor.submit(send, a_sock, a_source, offset=offset, stats=a_stats,
+                                   **kwargs)
+                   for a_sock, a_source, (offset, _), a_stats
+                   in zip(socks, sources, ranges, flow_stats)]
+        for a_future in futures:
+            a_future.result()
+
+    for a_stats in flow_stats:
+        stats.merge(a_stats)
+    stats.note("flows", [a_stats.notes for a_stats in flow_stats])
+    stats.note("size", sum(length for _, length in ranges))
+    stats.note("verified", combine_verified(a_stats.notes for a_stats in flow_stats))
+    return stats
+
+
+def recv_parallel(socks: typing.Sequence[socket.socket], path: str,
+                  stats: typing.Optional[utils.stats.TransferStats] = None,
+                  batched: bool = False) -> int:
+    """Receives data sent by send_parallel, each connection from its own
+    thread, writing each range at its offset in the file through a file
+    object of its own.  It returns once every flow has finished.
+
+    Args:
+        socks -- The sockets to receive from, one per flow, in the order the
+                 sender gave its ends of the connections.
+        path -- The path of the file to write the data to, which is created
+                or truncated first.
+        stats -- Statistics to record the combined transfer in, if given.
+        batched -- Whether each flow batches its I/O; see recv.
+
+    Return:
+        The number of bytes written to the file.
+    """
+    logger = utils.logging.get_logger("hw5-receiver")
+    if stats is None:
+        stats = utils.stats.TransferStats()
+    open(path, 'wb').close()
+    flow_stats = [utils.stats.TransferStats(record_series=stats.record_series)
+                  for _ in socks]
+    with contextlib.ExitStack() as stack:
+        dests = [stack.enter_context(open(path, 'r+b')) for _ in socks]
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(len(socks)))
+        futures = [executor.submit(recv, a_sock, a_dest, stats=a_stats, batched=batched)
+                   for a_sock, a_dest, a_stats in zip(socks, dests, flow_stats)]
+        num_bytes = sum(a_future.result() for a_future in futures)
+
+    for a_stats in flow_stats:
+        stats.merge(a_stats)
+    stats.note("flows", [a_stats.notes for a_stats in flow_stats])
+    stats.note("verified", combine_verified(a_stats.notes for a_stats in flow_stats))
+    if not stats.notes["verified"]:
+        logger.error("Not every flow's data arrived intact.")
+    return num_bytes
+
+
+async def send_async(sock: socket.socket, data: utils.stream.Source,
+                     executor: typing.Optional[concurrent.futures.Executor] = None,
+                     **kwargs) -> utils.stats.TransferStats:
+    """A coroutine running send in a thread, so a transfer does not block
+    the event loop.
+
+    Args:
+        sock -- The socket to send over.
+        data -- The data to send.
+        executor -- The executor to run send in.  If not given, it runs in a
+                    thread of its own, rather than the event loop's default
+                    executor, whose few threads would leave transfers beyond
+                    them waiting long enough for their handshakes to fail.
+                    Cancelling the coroutine then returns at once, leaving
+                    the thread to finish, or fail, on its own.
+        kwargs -- Any other arguments to send.
+
+    Return:
+        The statistics describing the transfer.
+    """
+    return await _run_blocking(executor, functools.partial(send, sock, data, **kwargs))
+
+
+async def recv_async(sock: socket.socket, dest: io.BufferedIOBase,
+                     executor: typing.Optional[concurrent.futures.Executor] = None,
+                     **kwargs) -> int:
+    """A coroutine running recv in a thread, so a transfer does not block
+    the event loop.
+
+    Args:
+        sock -- The socket to receive from; a socket, or a channel of a
+                socket shared by many connections, from utils.demux.
+        dest -- The binary file object to write the received data to.
+        executor -- The executor to run recv in; as for send_async.
+        kwargs -- Any other arguments to recv.
+
+    Return:
+        The number of bytes written to the destination.
+    """
+    return await _run_blocking(executor, functools.partial(recv, sock, dest, **kwargs))
+
+
+async def _run_blocking(executor: typing.Optional[concurrent.futures.Executor],
+                        function: typing.Callable[[], typing.Any]) -> typing.Any:
+    if executor is not None:
+        return await asyncio.get_running_loop().run_in_executor(executor, function)
+    # A daemon thread, rather than an executor of its own, since shutting an
+    # executor down on cancellation would block the loop until the call
+    # finished, and leave the interpreter waiting for it at exit.
+    result = concurrent.futures.Future()
+
+    def run():
+        if not result.set_running_or_notify_cancel():
+            return
+        try:
+            result.set_result(function())
+        except BaseException as error:
+            result.set_exception(error)
+
+    threading.Thread(target=run, daemon=True).start()
+    return await asyncio.wrap_future(result)
+
+
+async def serve(sock: socket.socket,
+                open_dest: typing.Callable[[int], typing.BinaryIO],
+                max_transfers: int = 256,
+                on_done: typing.Optional[typing.Callable[[int, int, utils.stats.TransferStats],
+                                                         None]] = None):
+    """Receives any number of transfers at once over one socket, telling
+    them apart by their connection IDs, until cancelled.
+
+    Each transfer is received by recv, in a thread of its own, through a
+    channel of the socket that is fed the transfer's packets by a
+    utils.demux.Demultiplexer.
+
+    Args:
+        sock -- The socket to receive on.  Replies go to the address each
+                transfer's SYN came from.
+        open_dest -- A function given the ID of a new connection, returning
+                     the binary file object to write its data to, which is
+                     closed once the transfer is done.
+        max_transfers -- The most transfers received at once.  The SYNs of
+                         any more are ignored until one finishes, so their
+                         senders keep retrying.
+        on_done -- If given, called with the ID of each connection, the
+                   number of bytes written, and the transfer's statistics,
+                   once it is done.
+    """
+    logger = utils.logging.get_logger("hw5-receiver")
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_transfers)
+    transfers = set()  # Tasks receiving the transfers in progress
+
+    async def receive(channel: utils.demux.Channel):
+        stats = utils.stats.TransferStats()
+        try:
+            with open_dest(channel.conn_id) as dest:
+                num_bytes = await loop.run_in_executor(
+                    executor, functools.partial(recv, channel, dest, stats=stats))
+        except Exception:
+            logger.exception("Receiving connection %08x failed.", channel.conn_id)
+            return
+        finally:
+            demultiplexer.finish(channel)
+        logger.info("Connection %08x done, %d bytes.", channel.conn_id, num_bytes)
+        if on_done is not None:
+            on_done(channel.conn_id, num_bytes, stats)
+
+    def accept(channel: utils.demux.Channel) -> bool:
+        if len(transfers) >= max_transfers:
+            return False
+        logger.info("New connection %08x.", channel.conn_id)
+        task = loop.create_task(receive(channel))
+        transfers.add(task)
+        task.add_done_callback(transfers.discard)
+        return True
+
+    _, demultiplexer = await loop.create_datagram_endpoint(
+        lambda: utils.demux.Demultiplexer(loop, accept), sock=sock)
+    try:
+        await asyncio.Future()  # Serve until cancelled
+    finally:
+        demultiplexer.close()
+        executor.shutdown(wait=False)
@@ -0,0 +1,77 @@
+"""
+Microbenchmarks of the protocol's hot paths: packetizing, checksumming, ACK
+handling, reassembly and forward error correction, each in isolation, and a
+whole transfer through a simulated wire in this process.  Results can be
+saved, and compared against saved results to catch regressions.
+"""
+import argparse
+import json
+import sys
+import logging
+import utils.logging
+import utils.microbench
+
+DESC = sys.modules[globals()['__name__']].__doc__
+PARSER = argparse.ArgumentParser(description=DESC)
+PARSER.add_argument('names', nargs='*',
+                    help="The benchmarks to run, or prefixes of their names "
+                         "(defaults to all of them).")
+PARSER.add_argument('-n', '--repeat', type=int, default=5,
+                    help="How many measurements to take the best of.")
+PARSER.add_argument('--min-time', type=float, default=0.2,
+                    help="The least number of seconds each measurement "
+                         "should take.")
+PARSER.add_argument('-o', '--output', default=None,
+                    help="A path to save the results to, as JSON.")
+PARSER.add_argument('--baseline', default=None,
+                    help="A path of saved results to compare against.")
+PARSER.add_argument('--tolerance', type=float, default=0.25,
+                    help="How much slower, as a fraction, a benchmark may "
+                         "be than the baseline before it is a regression "
+                         "(defaults to 0.25).")
+PARSER.add_argument('-l', '--list', action="store_true",
+                    help="List the benchmarks, and exit.")
+PARSER.add_argument('-v', '--verbose', action="store_true",
+                    help="Enable extra verbose mode.")
+ARGS = PARSER.parse_args()
+
+LOGGER = utils.logging.get_logger("hw5-microbench")
+if ARGS.verbose:
+    LOGGER.setLevel(logging.DEBUG)
+
+if ARGS.list:
+    for A_NAME in utils.microbench.BENCHMARKS:
+        print(A_NAME)
+    sys.exit(0)
+
+NAMES = [a_name for a_name in utils.microbench.BENCHMARKS
+         if not ARGS.names or any(a_name.startswith(a_prefix) for a_prefix in ARGS.names)]
+if not NAMES:
+    PARSER.error("No benchmarks match: {}".format(" ".join(ARGS.names)))
+
+BASELINE = {}
+if ARGS.baseline:
+    with open(ARGS.baseline) as BASELINE_HANDLE:
+        BASELINE = json.load(BASELINE_HANDLE)["results"]
+
+RESULTS = {}
+for A_NAME in NAMES:
+    LOGGER.debug("Running %s", A_NAME)
+    RESULTS[A_NAME] = utils.microbench.run_benchmark(A_NAME, ARGS.repeat, ARGS.min_time)
+
+COMPARISONS = {a_name: (a_ratio, a_regressed) for a_name, a_ratio, a_regressed
+               in utils.microbench.compare(RESULTS, BASELINE, ARGS.tolerance)}
+for A_NAME, A_RESULT in RESULTS.items():
+    LINE = "{:<24} {:>12.1f} ns/item {:>14,.0f} items/s".format(
+        A_NAME, A_RESULT["ns_per_item"], A_RESULT["items_per_second"])
+    if A_NAME in COMPARISONS:
+        A_RATIO, A_REGRESSED = COMPARISONS[A_NAME]
+        LINE += "  {:+.1%}{}".format(A_RATIO - 1, "  REGRESSION" if A_REGRESSED else "")
+    print(LINE)
+
+if ARGS.output:
+    with open(ARGS.output, 'w') as OUTPUT_HANDLE:
+        json.dump({"python": sys.version, "results": RESULTS}, OUTPUT_HANDLE, indent=2)
+        OUTPUT_HANDLE.write("\n")
+
+sys.exit(1 if any(a_regressed for _, a_regressed in COMPARISONS.values()) else 0)
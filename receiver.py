@@ -5,8 +5,16 @@ to STDOUT.
 """
 
 import argparse
+import asyncio
+import os
+import shutil
 import sys
+import tempfile
 import logging
+import utils.logging
+import utils.resume
+import utils.stats
+import utils.utils
 import utils.wire
 import hw5
 
@@ -18,6 +26,39 @@ PARSER.add_argument("-p", "--port", type=int, default=9999,
 PARSER.add_argument("-f", "--file", type=str,
                     help="The path to write the data recorded over the buffer "
                          "to (default=STDOUT).")
+PARSER.add_argument("--resume", action="store_true",
+                    help="Keep a journal of the chunks written next to the "
+                         "file, so that if the transfer is interrupted, a "
+                         "resumed transfer of the same data picks up where "
+                         "it left off.  Requires --file.")
+PARSER.add_argument("--delta", action="store_true",
+                    help="Let the sender send only the differences from the "
+                         "existing contents of the file, which are replaced "
+                         "once the transfer is done.  Requires --file.")
+PARSER.add_argument("--flows", type=int, default=1,
+                    help="The number of connections the sender sends the "
+                         "data over in parallel, on consecutive ports "
+                         "starting from --port.  Requires --file.")
+PARSER.add_argument("--serve", type=str, metavar="DIRECTORY",
+                    help="Keep receiving any number of transfers at once, "
+                         "writing each to a file in DIRECTORY named after "
+                         "its connection ID, until interrupted.")
+PARSER.add_argument("--batch", action="store_true",
+                    help="Receive runs of datagrams the kernel coalesces, "
+                         "and send the ACKs for them, with one system call, "
+                         "where the system supports it.")
+PARSER.add_argument("--ready-fd", type=int, default=None,
+                    help="A file descriptor to write to once connected to "
+                         "the simulated network.")
+PARSER.add_argument("--stats", type=str,
+                    help="A path to write statistics describing the transfer "
+                         "to, as JSON.")
+PARSER.add_argument("--series", action="store_true",
+                    help="Include the time series of sampled values in the "
+                         "statistics.")
+PARSER.add_argument("--trace", type=str,
+                    help="A path to write a binary trace of every packet "
+                         "event to, once the transfer is done.")
 PARSER.add_argument('-v', '--verbose', action="store_true",
                     help="Enable extra verbose mode.")
 ARGS = PARSER.parse_args()
@@ -25,11 +66,82 @@ ARGS = PARSER.parse_args()
 if ARGS.verbose:
     logging.getLogger('hw5-receiver').setLevel(logging.DEBUG)
 
-OUTPUT = open(ARGS.file, 'wb') if ARGS.file else sys.stdout.buffer
+if (ARGS.resume or ARGS.delta) and not ARGS.file:
+    PARSER.error("--resume and --delta require --file")
+if ARGS.resume and ARGS.delta:
+    PARSER.error("--resume and --delta cannot be combined")
+if ARGS.flows < 1:
+    PARSER.error("--flows must be at least 1")
+if ARGS.flows > 1 and not ARGS.file:
+    PARSER.error("--flows requires --file")
+if ARGS.flows > 1 and (ARGS.resume or ARGS.delta or ARGS.trace):
+    PARSER.error("--flows cannot be combined with --resume, --delta or --trace")
+if ARGS.serve and (ARGS.file or ARGS.resume or ARGS.delta or ARGS.flows > 1 or
+                   ARGS.trace or ARGS.stats):
+    PARSER.error("--serve cannot be combined with --file, --resume, --delta, "
+                 "--flows, --trace or --stats")
 
-SOC = homework5.wire.bad_socket(ARGS.port)
+JOURNAL = None
+BASIS = None
+OUTPUT = None
+if ARGS.serve:
+    os.makedirs(ARGS.serve, exist_ok=True)
+elif ARGS.flows > 1:
+    pass  # Each flow opens the file for itself
+elif ARGS.delta:
+    # The new version is written alongside the existing file, which it is
+    # built from, and then replaces it.
+    if os.path.exists(ARGS.file):
+        BASIS = open(ARGS.file, 'rb')
+    OUTPUT = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(ARGS.file)),
+                                         delete=False)
+elif ARGS.resume:
+    # The file is opened without truncating it, since it may hold the data
+    # of an interrupted transfer to resume.
+    JOURNAL = ARGS.file + utils.resume.JOURNAL_SUFFIX
+    OUTPUT = open(ARGS.file, 'r+b' if os.path.exists(ARGS.file) else 'w+b')
+elif ARGS.file:
+    OUTPUT = open(ARGS.file, 'wb')
+else:
+    OUTPUT = sys.stdout.buffer
 
-hw5.recv(SOC, OUTPUT)
+SOCKS = [utils.wire.bad_socket(ARGS.port + a_flow) for a_flow in range(ARGS.flows)]
+utils.utils.signal_ready(ARGS.ready_fd)
 
-SOC.close()
-OUTPUT.close()
+STATS = utils.stats.TransferStats(record_series=ARGS.series)
+TRACER = utils.logging.Tracer() if ARGS.trace else None
+if ARGS.serve:
+    def open_upload(conn_id):
+        return open(os.path.join(ARGS.serve, "{:08x}".format(conn_id)), 'wb')
+    try:
+        asyncio.run(hw5.serve(SOCKS[0], open_upload))
+    except KeyboardInterrupt:
+        pass
+elif ARGS.flows > 1:
+    hw5.recv_parallel(SOCKS, ARGS.file, stats=STATS, batched=ARGS.batch)
+else:
+    hw5.recv(SOCKS[0], OUTPUT, stats=STATS, tracer=TRACER, journal=JOURNAL, basis=BASIS,
+             batched=ARGS.batch)
+
+for A_SOCK in SOCKS:
+    A_SOCK.close()
+if OUTPUT is not None:
+    OUTPUT.close()
+if ARGS.delta:
+    if BASIS is not None:
+        BASIS.close()
+    # The existing file is only replaced by a new version known to be
+    # intact, which keeps its permissions.
+    if STATS.notes.get("verified"):
+        if BASIS is not None:
+            shutil.copymode(ARGS.file, OUTPUT.name)
+        os.replace(OUTPUT.name, ARGS.file)
+    else:
+        utils.logging.get_logger("hw5-receiver").error(
+            "The new version was not verified, so %s was left as it was.", ARGS.file)
+        os.remove(OUTPUT.name)
+
+if ARGS.stats:
+    STATS.dump(ARGS.stats)
+if TRACER is not None:
+    TRACER.dump(ARGS.trace)
@@ -5,6 +5,12 @@ Client that sends STDIN, over a simulated faulty network connection.
 
 import argparse
 import logging
+import sys
+import utils.compress
+import utils.congestion
+import utils.logging
+import utils.packet
+import utils.stats
 import utils.wire
 import hw5
 
@@ -15,6 +21,47 @@ PARSER.add_argument("-p", "--port", type=int, default=9999,
                     help="The port to connect to the simulated network over.")
 PARSER.add_argument("-f", "--file", required=True,
                     help="The file to send over the simulated network.")
+PARSER.add_argument("-c", "--congestion", default="reno",
+                    choices=sorted(utils.congestion.CONTROLLERS),
+                    help="The congestion control algorithm to use (defaults "
+                         "to reno).")
+PARSER.add_argument("-k", "--checksum", default="crc32",
+                    choices=sorted(utils.packet.CHECKSUMS),
+                    help="The checksum algorithm to protect packets with "
+                         "(defaults to crc32).")
+PARSER.add_argument("--fec", type=int, nargs=2, metavar=("BLOCK", "PARITY"),
+                    help="Protect every BLOCK data packets with PARITY parity "
+                         "packets, from which the receiver can rebuild up to "
+                         "PARITY lost packets per block without waiting for "
+                         "them to be retransmitted.")
+PARSER.add_argument("-z", "--compression", default=None,
+                    choices=sorted(utils.compress.CODECS),
+                    help="Compress the data with the given algorithm, if the "
+                         "receiver supports it (defaults to none).")
+PARSER.add_argument("--resume", action="store_true",
+                    help="Make the transfer resumable, and skip whatever the "
+                         "receiver already holds from an interrupted transfer "
+                         "of the same file.")
+PARSER.add_argument("--delta", action="store_true",
+                    help="Send only the differences from the receiver's "
+                         "existing copy of the file, if it has one.")
+PARSER.add_argument("--flows", type=int, default=1,
+                    help="Split the file into this many ranges, and send "
+                         "them over as many connections in parallel, on "
+                         "consecutive ports starting from --port.")
+PARSER.add_argument("--batch", action="store_true",
+                    help="Send each run of packets with one system call, "
+                         "using UDP segmentation offload where the system "
+                         "supports it.")
+PARSER.add_argument("--stats", type=str,
+                    help="A path to write statistics describing the transfer "
+                         "to, as JSON.")
+PARSER.add_argument("--series", action="store_true",
+                    help="Include the time series of sampled values, such as "
+                         "the RTT and congestion window, in the statistics.")
+PARSER.add_argument("--trace", type=str,
+                    help="A path to write a binary trace of every packet "
+                         "event to, once the transfer is done.")
 PARSER.add_argument('-v', '--verbose', action="store_true",
                     help="Enable extra verbose mode.")
 ARGS = PARSER.parse_args()
@@ -22,9 +69,33 @@ ARGS = PARSER.parse_args()
 if ARGS.verbose:
     logging.getLogger('hw5-sender').setLevel(logging.DEBUG)
 
-DATA = open(ARGS.file, 'rb').read()
-SOC = homework5.wire.bad_socket(ARGS.port)
+if ARGS.flows < 1:
+    PARSER.error("--flows must be at least 1")
+if ARGS.flows > 1 and (ARGS.resume or ARGS.delta or ARGS.trace):
+    PARSER.error("--flows cannot be combined with --resume, --delta or --trace")
 
-hw5.send(SOC, DATA)
+SOCKS = [utils.wire.bad_socket(ARGS.port + a_flow) for a_flow in range(ARGS.flows)]
 
-SOC.close()
+STATS = utils.stats.TransferStats(record_series=ARGS.series)
+TRACER = utils.logging.Tracer() if ARGS.trace else None
+if ARGS.flows > 1:
+    hw5.send_parallel(SOCKS, ARGS.file, congestion=ARGS.congestion,
+                      checksum=ARGS.checksum, fec=ARGS.fec,
+                      compression=ARGS.compression, batched=ARGS.batch, stats=STATS)
+else:
+    hw5.send(SOCKS[0], ARGS.file, congestion=ARGS.congestion, checksum=ARGS.checksum,
+             fec=ARGS.fec, compression=ARGS.compression,
+             resume=ARGS.resume, delta=ARGS.delta, batched=ARGS.batch,
+             stats=STATS, tracer=TRACER)
+
+for A_SOCK in SOCKS:
+    A_SOCK.close()
+
+if ARGS.stats:
+    STATS.dump(ARGS.stats)
+if TRACER is not None:
+    TRACER.dump(ARGS.trace)
+
+# Fail if the receiver found that what it wrote does not match what was sent.
+if STATS.notes.get("verified") is False:
+    sys.exit(1)
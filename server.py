@@ -5,8 +5,10 @@ socket connections.
 import sys
 import argparse
 import logging
+import signal
 import utils.wire
 import utils.logging
+import utils.utils
 
 # Grab the dockblock of the current module, to avoid redundantly describing
 # what this program does.
@@ -22,6 +24,51 @@ PARSER.add_argument('-d', '--delay', type=float, default=0.0,
                          "forwarding a packet on.")
 PARSER.add_argument('-b', '--buffer', type=int, default=100000,
                     help="The size of the buffer to simulate.")
+PARSER.add_argument('--bandwidth', type=float, default=0.0,
+                    help="The bandwidth of the simulated link, in bytes per "
+                         "second (defaults to unlimited).")
+PARSER.add_argument('--queue', type=int, default=0,
+                    help="The number of bytes that may queue waiting for the "
+                         "link, when its bandwidth is limited (defaults to "
+                         "unlimited).")
+PARSER.add_argument('--jitter', type=float, default=0.0,
+                    help="Up to this many extra seconds, chosen at random, "
+                         "are added to each packet's delay.")
+PARSER.add_argument('--reorder', action="store_true",
+                    help="Allow jitter to reorder packets.")
+PARSER.add_argument('--burst-enter', type=float, default=0.0,
+                    help="The per packet probability of entering a burst of "
+                         "loss (Gilbert-Elliott model; defaults to no "
+                         "bursts).")
+PARSER.add_argument('--burst-exit', type=float, default=1.0,
+                    help="The per packet probability of leaving a burst of "
+                         "loss.")
+PARSER.add_argument('--burst-loss', type=float, default=1.0,
+                    help="The percentage of packets to drop during a burst.")
+PARSER.add_argument('--corrupt', type=float, default=0.0,
+                    help="The percentage of packets to flip a bit in.")
+PARSER.add_argument('--duplicate', type=float, default=0.0,
+                    help="The percentage of packets to deliver twice.")
+PARSER.add_argument('--seed', type=int, default=None,
+                    help="Seed for the simulated network's random decisions, "
+                         "to make runs reproducible.")
+PARSER.add_argument('--flows', type=int, default=1,
+                    help="The number of independent wires to simulate, on "
+                         "consecutive ports starting from --port, for "
+                         "transfers over several connections in parallel.")
+PARSER.add_argument('--record-trace', default=None,
+                    help="A path to record the fate of every datagram to, "
+                         "so the same losses and delays can be replayed "
+                         "with --replay-trace.  With several flows, each "
+                         "wire's trace is written to the path with the "
+                         "flow's number appended.")
+PARSER.add_argument('--replay-trace', default=None,
+                    help="A trace recorded with --record-trace to replay, "
+                         "in place of deciding losses, corruption, "
+                         "duplicates and delays at random.")
+PARSER.add_argument('--ready-fd', type=int, default=None,
+                    help="A file descriptor to write to once the simulated "
+                         "network is listening.")
 PARSER.add_argument('-v', '--verbose', action="store_true",
                     help="Enable extra verbose mode.")
 ARGS = PARSER.parse_args()
@@ -29,13 +76,47 @@ ARGS = PARSER.parse_args()
 if ARGS.verbose:
     logging.getLogger('hw5-wire').setLevel(logging.DEBUG)
 
-TRANSPORT, LOOP = homework5.wire.create_server(ARGS.port, ARGS.loss,
-                                               ARGS.delay, ARGS.buffer)
+IMPAIRMENTS = utils.wire.Impairments(
+    bandwidth=ARGS.bandwidth, queue_bytes=ARGS.queue, jitter=ARGS.jitter,
+    reorder=ARGS.reorder, burst_enter=ARGS.burst_enter,
+    burst_exit=ARGS.burst_exit, burst_loss=ARGS.burst_loss,
+    corrupt=ARGS.corrupt, duplicate=ARGS.duplicate, seed=ARGS.seed)
+
+# Each flow gets a wire of its own, since a wire forwards every datagram to
+# every other peer connected to it.  Seeded wires get different seeds, so
+# they do not all drop the same packets.
+def trace_path(path: str, flow: int) -> str:
+    return path if ARGS.flows == 1 else "{}.{}".format(path, flow)
+
+
+TRANSPORTS = []
+RECORDERS = []
+for A_FLOW in range(ARGS.flows):
+    A_SEED = None if ARGS.seed is None else ARGS.seed + A_FLOW
+    A_RECORDER = A_REPLAYER = None
+    if ARGS.record_trace:
+        A_RECORDER = utils.wire.TraceRecorder(trace_path(ARGS.record_trace, A_FLOW))
+        RECORDERS.append(A_RECORDER)
+    if ARGS.replay_trace:
+        A_REPLAYER = utils.wire.TraceReplayer(trace_path(ARGS.replay_trace, A_FLOW))
+    A_TRANSPORT, LOOP = utils.wire.create_server(ARGS.port + A_FLOW, ARGS.loss,
+                                                 ARGS.delay, ARGS.buffer,
+                                                 IMPAIRMENTS._replace(seed=A_SEED),
+                                                 A_RECORDER, A_REPLAYER)
+    TRANSPORTS.append(A_TRANSPORT)
+
+# Being terminated stops the wire as an interrupt does, so that recorded
+# traces are written out in full.
+LOOP.add_signal_handler(signal.SIGTERM, LOOP.stop)
+utils.utils.signal_ready(ARGS.ready_fd)
 
 try:
     LOOP.run_forever()
 except KeyboardInterrupt:
     pass
 
-TRANSPORT.close()
+for A_TRANSPORT in TRANSPORTS:
+    A_TRANSPORT.close()
+for A_RECORDER in RECORDERS:
+    A_RECORDER.close()
 LOOP.close()
@@ -3,6 +3,7 @@ Utility script for testing HW5 solutions under user set conditions.
 """
 import time
 import argparse
+import json
 import subprocess
 import hashlib
 import pathlib
@@ -11,7 +12,13 @@ import os
 import tempfile
 import signal
 import logging
+import utils.compress
+import utils.harness
+import utils.congestion
+import utils.packet
 import utils.logging
+import utils.profiling
+import utils.resume
 import utils.utils
 
 DESC = sys.modules[globals()['__name__']].__doc__
@@ -27,12 +34,99 @@ PARSER.add_argument('-d', '--delay', type=float, default=0.0,
 PARSER.add_argument('-b', '--buffer', type=int, default=2,
                     help="The size of the buffer to simulate (defaults to "
                          "2 packets).")
+PARSER.add_argument('--bandwidth', type=float, default=0.0,
+                    help="The bandwidth of the simulated link, in bytes per "
+                         "second (defaults to unlimited).")
+PARSER.add_argument('--queue', type=int, default=0,
+                    help="The number of bytes that may queue waiting for the "
+                         "link, when its bandwidth is limited (defaults to "
+                         "unlimited).")
+PARSER.add_argument('--jitter', type=float, default=0.0,
+                    help="Up to this many extra seconds, chosen at random, "
+                         "are added to each packet's delay.")
+PARSER.add_argument('--reorder', action="store_true",
+                    help="Allow jitter to reorder packets.")
+PARSER.add_argument('--burst-enter', type=float, default=0.0,
+                    help="The per packet probability of entering a burst of "
+                         "loss (defaults to no bursts).")
+PARSER.add_argument('--burst-exit', type=float, default=1.0,
+                    help="The per packet probability of leaving a burst of "
+                         "loss.")
+PARSER.add_argument('--burst-loss', type=float, default=1.0,
+                    help="The percentage of packets to drop during a burst.")
+PARSER.add_argument('--corrupt', type=float, default=0.0,
+                    help="The percentage of packets to flip a bit in.")
+PARSER.add_argument('--duplicate', type=float, default=0.0,
+                    help="The percentage of packets to deliver twice.")
+PARSER.add_argument('--seed', type=int, default=None,
+                    help="Seed for the simulated network's random decisions, "
+                         "to make runs reproducible.")
+PARSER.add_argument('--record-trace', default=None,
+                    help="A path to record the simulated network's losses "
+                         "and delays to, to replay with --replay-trace.")
+PARSER.add_argument('--replay-trace', default=None,
+                    help="Replay the losses and delays recorded in a trace, "
+                         "instead of choosing them at random, so different "
+                         "builds of the protocol can be compared under "
+                         "exactly the same conditions.")
 PARSER.add_argument('-f', '--file', required=True,
                     help="The file to send over the wire.")
 PARSER.add_argument('-r', '--receive', default=None,
                     help="The path to write the received file to.  If not "
                          "provided, the results will be written to a temp "
                          "file.")
+PARSER.add_argument('-c', '--congestion', default="reno",
+                    choices=sorted(utils.congestion.CONTROLLERS),
+                    help="The congestion control algorithm the sender should "
+                         "use (defaults to reno).")
+PARSER.add_argument('-k', '--checksum', default="crc32",
+                    choices=sorted(utils.packet.CHECKSUMS),
+                    help="The checksum algorithm the sender should protect "
+                         "packets with (defaults to crc32).")
+PARSER.add_argument('--fec', type=int, nargs=2, metavar=("BLOCK", "PARITY"),
+                    help="Have the sender protect every BLOCK data packets "
+                         "with PARITY forward error correction packets.")
+PARSER.add_argument('-z', '--compression', default=None,
+                    choices=sorted(utils.compress.CODECS),
+                    help="The compression algorithm the sender should "
+                         "compress the data with (defaults to none).")
+PARSER.add_argument('--resume', action="store_true",
+                    help="Make the transfer resumable, so rerunning with the "
+                         "same --receive path after an interruption picks up "
+                         "where it left off.")
+PARSER.add_argument('--stale-resume', action="store_true",
+                    help="Check that a resumable transfer starts over, "
+                         "rather than resuming, when the journal at the "
+                         "--receive path is for different data, by leaving "
+                         "a changed copy of the file and its journal there "
+                         "first.  Requires --resume.")
+PARSER.add_argument('--async-cancel', action="store_true",
+                    help="Also check that cancelling an async transfer whose "
+                         "peer never answers returns at once, without "
+                         "blocking the event loop.")
+PARSER.add_argument('--delta', action="store_true",
+                    help="Send only the differences from the existing file "
+                         "at the --receive path.")
+PARSER.add_argument('--flows', type=int, default=1,
+                    help="Send the file over this many connections in "
+                         "parallel, each through its own simulated wire on "
+                         "consecutive ports from --port.")
+PARSER.add_argument('--batch', action="store_true",
+                    help="Have the sender and receiver batch their socket "
+                         "I/O, where the system supports it.")
+PARSER.add_argument('--stats', default=None,
+                    help="A path to write the statistics reported by the "
+                         "sender and receiver to, as JSON.")
+PARSER.add_argument('--series', action="store_true",
+                    help="Include the time series of sampled values, such as "
+                         "the RTT and congestion window, in the statistics.")
+PARSER.add_argument('--profile', action="store_true",
+                    help="Run the wire, sender and receiver under cProfile, "
+                         "and report the CPU time and packet rate of each, "
+                         "and the functions they spent the most time in.")
+PARSER.add_argument('--profile-top', type=int, default=20,
+                    help="The number of functions to list in the --profile "
+                         "report (defaults to 20).")
 PARSER.add_argument('-s', '--summary', action="store_true",
                     help="Print a one line summary of whether the "
                          "transaction was successful, instead of a more "
@@ -41,20 +135,44 @@ PARSER.add_argument('-v', '--verbose', action="store_true",
                     help="Enable extra verbose mode.")
 ARGS = PARSER.parse_args()
 
-LOGGER = homework5.logging.get_logger("hw5-tester")
+if ARGS.stale_resume and not ARGS.resume:
+    PARSER.error("--stale-resume requires --resume")
+
+LOGGER = utils.logging.get_logger("hw5-tester")
 if ARGS.verbose:
     LOGGER.setLevel(logging.DEBUG)
 
 PYTHON_BINARY = sys.executable
+
+# Number of seconds to wait for the receiver to exit after the sender does.
+RECEIVER_EXIT_TIMEOUT = 30
+# Most seconds cancelling an async transfer may hold up the event loop.
+ASYNC_CANCEL_LIMIT = 1.0
 SERVER_ARGS = [PYTHON_BINARY, "server.py"]
 
 if ARGS.verbose:
     SERVER_ARGS.append("-v")
 
-for AN_ARG in ("port", "loss", "delay", "buffer"):
-    SERVER_ARGS.append("--" + AN_ARG)
+for AN_ARG in ("port", "loss", "delay", "buffer", "bandwidth", "queue",
+               "jitter", "burst_enter", "burst_exit", "burst_loss", "corrupt",
+               "duplicate", "seed", "flows", "record_trace", "replay_trace"):
+    if getattr(ARGS, AN_ARG) is None:
+        continue
+    SERVER_ARGS.append("--" + AN_ARG.replace("_", "-"))
     SERVER_ARGS.append(str(getattr(ARGS, AN_ARG)))
 
+if ARGS.reorder:
+    SERVER_ARGS.append("--reorder")
+
+# When profiling, each process writes its profile to a temp file as it
+# exits, to be collected and reported on along with the statistics.
+PROFILE_PATHS = {}
+if ARGS.profile:
+    for A_PROCESS in ("wire", "receiver", "sender"):
+        PROFILE_HANDLE, PROFILE_PATHS[A_PROCESS] = tempfile.mkstemp()
+        os.close(PROFILE_HANDLE)
+    SERVER_ARGS = utils.profiling.profiled(SERVER_ARGS, PROFILE_PATHS["wire"])
+
 SERVER_PROCESS = None
 RECEIVING_PROCESS = None
 
@@ -73,9 +191,14 @@ for A_SIGNAL in (signal.SIGTERM, signal.SIGINT):
     signal.signal(A_SIGNAL, on_end)
 
 
-SERVER_PROCESS = subprocess.Popen(SERVER_ARGS)
-LOGGER.info("Starting wire process: {}".format(SERVER_PROCESS.pid))
-time.sleep(1)
+if ARGS.async_cancel:
+    ASYNC_CANCEL = utils.harness.check_async_cancel()
+    LOGGER.info("Cancelling an async transfer took %.3fs, and held up the "
+                "event loop for up to %.3fs.", ASYNC_CANCEL["cancel_time"],
+                ASYNC_CANCEL["longest_tick_gap"])
+
+SERVER_PROCESS = utils.utils.start_when_ready(SERVER_ARGS)
+LOGGER.info("Started wire process: {}".format(SERVER_PROCESS.pid))
 
 if ARGS.receive:
     DEST_FILE_PATH = ARGS.receive
@@ -84,44 +207,182 @@ else:
     DEST_FILE_PATH = TEMP_FILE_NAME
     os.close(TEMP_HANDLE)
 
+if ARGS.stale_resume:
+    # Leave what an interrupted transfer of a changed version of the file
+    # leaves: part of it, and its journal.  The changed version has every
+    # byte different, and the transfer is cut off as soon as the journal
+    # has been written.
+    STALE_HANDLE, STALE_PATH = tempfile.mkstemp()
+    with open(ARGS.file, 'rb') as INPUT_HANDLE:
+        os.write(STALE_HANDLE, INPUT_HANDLE.read().translate(bytes(range(255, -1, -1))))
+    os.close(STALE_HANDLE)
+    STALE_JOURNAL = DEST_FILE_PATH + utils.resume.JOURNAL_SUFFIX
+    STALE_RECEIVER = utils.utils.start_when_ready(
+        [PYTHON_BINARY, "receiver.py", "--port", str(ARGS.port),
+         "--file", DEST_FILE_PATH, "--resume"])
+    STALE_SENDER = subprocess.Popen(
+        [PYTHON_BINARY, "sender.py", "--port", str(ARGS.port),
+         "--file", STALE_PATH, "--resume"])
+    STALE_DEADLINE = time.time() + RECEIVER_EXIT_TIMEOUT
+    while (not os.path.exists(STALE_JOURNAL) and STALE_SENDER.poll() is None and
+           time.time() < STALE_DEADLINE):
+        time.sleep(0.01)
+    for A_PROCESS in (STALE_SENDER, STALE_RECEIVER):
+        A_PROCESS.kill()
+        A_PROCESS.wait()
+    os.remove(STALE_PATH)
+    if not os.path.exists(STALE_JOURNAL):
+        LOGGER.error("The interrupted transfer left no journal; --stale-resume "
+                     "needs a file of more than %d packets.", utils.resume.JOURNAL_PACKETS)
+        SERVER_PROCESS.kill()
+        sys.exit(1)
+
+# The sender and receiver each write the statistics describing their side
+# of the transfer to a temp file, to be collected once they exit.
+STATS_PATHS = {}
+for A_SIDE in ("sender", "receiver"):
+    STATS_HANDLE, STATS_PATHS[A_SIDE] = tempfile.mkstemp()
+    os.close(STATS_HANDLE)
+
+SERIES_ARGS = ["--series"] if ARGS.series else []
+
 RECEIVING_ARGS = [PYTHON_BINARY, "receiver.py",
                   "--port", str(ARGS.port),
-                  "--file", DEST_FILE_PATH]
+                  "--file", DEST_FILE_PATH,
+                  "--stats", STATS_PATHS["receiver"]] + SERIES_ARGS
+
+if ARGS.resume:
+    RECEIVING_ARGS.append("--resume")
+
+if ARGS.flows > 1:
+    RECEIVING_ARGS.extend(["--flows", str(ARGS.flows)])
+
+if ARGS.batch:
+    RECEIVING_ARGS.append("--batch")
+
+if ARGS.delta:
+    RECEIVING_ARGS.append("--delta")
 
 if ARGS.verbose:
     RECEIVING_ARGS.append("-v")
 
-RECEIVING_PROCESS = subprocess.Popen(RECEIVING_ARGS)
-LOGGER.info("Starting receiving process: {}".format(RECEIVING_PROCESS.pid))
-time.sleep(1)
+if ARGS.profile:
+    RECEIVING_ARGS = utils.profiling.profiled(RECEIVING_ARGS,
+                                              PROFILE_PATHS["receiver"])
+
+RECEIVING_PROCESS = utils.utils.start_when_ready(RECEIVING_ARGS)
+LOGGER.info("Started receiving process: {}".format(RECEIVING_PROCESS.pid))
 
 SENDER_ARGS = [PYTHON_BINARY, "sender.py",
                "--port", str(ARGS.port),
-               "--file", ARGS.file]
+               "--file", ARGS.file,
+               "--congestion", ARGS.congestion,
+               "--checksum", ARGS.checksum,
+               "--stats", STATS_PATHS["sender"]] + SERIES_ARGS
+
+if ARGS.resume:
+    SENDER_ARGS.append("--resume")
+
+if ARGS.delta:
+    SENDER_ARGS.append("--delta")
+
+if ARGS.flows > 1:
+    SENDER_ARGS.extend(["--flows", str(ARGS.flows)])
+
+if ARGS.batch:
+    SENDER_ARGS.append("--batch")
+
+if ARGS.compression:
+    SENDER_ARGS.extend(["--compression", ARGS.compression])
+
+if ARGS.fec:
+    SENDER_ARGS.extend(["--fec"] + [str(a_value) for a_value in ARGS.fec])
 
 if ARGS.verbose:
     SENDER_ARGS.append("-v")
 
+if ARGS.profile:
+    SENDER_ARGS = utils.profiling.profiled(SENDER_ARGS, PROFILE_PATHS["sender"])
+
 INPUT_PATH = pathlib.Path(ARGS.file)
-INPUT_LEN, INPUT_HASH = homework5.utils.file_summary(INPUT_PATH)
 START_TIME = time.time()
 
+# The CPU time of each process is the growth in that of reaped children
+# across reaping it, so they are reaped one at a time.
+CPU_TIMES = {}
+CPU_MARK = utils.profiling.children_cpu_time()
+
 LOGGER.info("Starting sending process: {}".format(SERVER_PROCESS.pid))
 SENDING_RESULT = subprocess.run(SENDER_ARGS)
 
 END_TIME = time.time()
+CPU_TIMES["sender"] = utils.profiling.children_cpu_time() - CPU_MARK
+CPU_MARK += CPU_TIMES["sender"]
 
-# Sleep the delay time, to allow the buffer to drain.
-time.sleep(ARGS.delay)
-RECEIVING_PROCESS.terminate()
+# The receiver exits by itself once the sender's FIN has been acknowledged,
+# and it has lingered long enough to be sure the FIN_ACK got through.  It is
+# only killed if that never happens.
+try:
+    RECEIVING_PROCESS.wait(timeout=RECEIVER_EXIT_TIMEOUT)
+except subprocess.TimeoutExpired:
+    LOGGER.warning("Receiving process did not exit, terminating it.")
+    RECEIVING_PROCESS.terminate()
+    RECEIVING_PROCESS.wait()
 RECEIVING_PROCESS = None
-SERVER_PROCESS.terminate()
+CPU_TIMES["receiver"] = utils.profiling.children_cpu_time() - CPU_MARK
+CPU_MARK += CPU_TIMES["receiver"]
+if ARGS.profile:
+    # Interrupted rather than terminated, so that it exits cleanly, and
+    # cProfile gets to write its profile.
+    SERVER_PROCESS.send_signal(signal.SIGINT)
+    try:
+        SERVER_PROCESS.wait(timeout=RECEIVER_EXIT_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        SERVER_PROCESS.kill()
+        SERVER_PROCESS.wait()
+else:
+    SERVER_PROCESS.terminate()
 SERVER_PROCESS = None
+CPU_TIMES["wire"] = utils.profiling.children_cpu_time() - CPU_MARK
 
-RECV_PATH = pathlib.Path(DEST_FILE_PATH)
-RECV_LEN, RECV_HASH = homework5.utils.file_summary(RECV_PATH)
+STATS = {}
+for A_SIDE, A_PATH in STATS_PATHS.items():
+    try:
+        with open(A_PATH) as STATS_HANDLE:
+            STATS[A_SIDE] = json.load(STATS_HANDLE)
+    except ValueError:
+        STATS[A_SIDE] = None  # The process never finished writing them
+    os.remove(A_PATH)
+
+if ARGS.stats:
+    with open(ARGS.stats, 'w') as STATS_HANDLE:
+        json.dump(STATS, STATS_HANDLE, indent=2)
 
-IS_SUCCESS = RECV_HASH == INPUT_HASH
+# The sender and receiver each digest the data as it streams through them,
+# and the receiver checks its digest against the sender's, so the files
+# only need to be read again if either of them did not finish.
+RECV_PATH = pathlib.Path(DEST_FILE_PATH)
+SENDER_NOTES = (STATS["sender"] or {}).get("notes", {})
+RECEIVER_NOTES = (STATS["receiver"] or {}).get("notes", {})
+if "digest" in SENDER_NOTES and RECEIVER_NOTES.get("verified") is not None:
+    INPUT_LEN, INPUT_HASH = os.path.getsize(INPUT_PATH), SENDER_NOTES["digest"]
+    RECV_LEN, RECV_HASH = os.path.getsize(RECV_PATH), RECEIVER_NOTES["digest"]
+    IS_SUCCESS = RECEIVER_NOTES["verified"] and INPUT_LEN == RECV_LEN
+else:
+    LOGGER.info("No digests were reported, so hashing the files.")
+    INPUT_LEN, INPUT_HASH = utils.utils.file_summary(INPUT_PATH)
+    RECV_LEN, RECV_HASH = utils.utils.file_summary(RECV_PATH)
+    IS_SUCCESS = RECV_HASH == INPUT_HASH
+if ARGS.stale_resume:
+    RESUMED_CHUNKS = (STATS["sender"] or {}).get("counters", {}).get("resumed_chunks", 0)
+    if RESUMED_CHUNKS:
+        LOGGER.error("Resumed %d chunks from a journal for different data.",
+                     RESUMED_CHUNKS)
+        IS_SUCCESS = False
+if ARGS.async_cancel and max(ASYNC_CANCEL.values()) > ASYNC_CANCEL_LIMIT:
+    LOGGER.error("Cancelling an async transfer blocked the event loop for "
+                 "%.1fs.", max(ASYNC_CANCEL.values()))
+    IS_SUCCESS = False
 NUM_SECONDS = END_TIME - START_TIME
 RATE = round(((RECV_LEN / NUM_SECONDS) / 1000), 2)
 TEMPLATE = "[{}] latency={}ms, packet loss={}%, buffer={}, throughput={} Kb/s"
@@ -152,4 +413,40 @@ else:
     print("\nStats")
     print("---")
     print("Time: {} secs\nRate: {} kB/s".format(round(NUM_SECONDS, 2), RATE))
+    for A_SIDE, SIDE_STATS in STATS.items():
+        if SIDE_STATS is None:
+            continue
+        print("\n{} counters".format(A_SIDE.capitalize()))
+        print("---")
+        for A_NAME, A_VALUE in sorted(SIDE_STATS["counters"].items()):
+            print("{}: {}".format(A_NAME, A_VALUE))
+        if "rtt" in SIDE_STATS["summaries"]:
+            RTT = SIDE_STATS["summaries"]["rtt"]
+            print("rtt: min {:.4f}s, mean {:.4f}s, max {:.4f}s".format(
+                RTT["min"], RTT["mean"], RTT["max"]))
+
+if ARGS.profile:
+    # The wire counts no statistics, but its profile counts the datagrams
+    # it was handed.
+    WIRE_PROFILE = utils.profiling.load(PROFILE_PATHS["wire"])
+    PACKETS = {
+        "wire": (utils.profiling.call_count(WIRE_PROFILE, "datagram_received")
+                 if WIRE_PROFILE else 0),
+        "receiver": (STATS["receiver"] or {}).get("counters", {}).get("datagrams", 0),
+        "sender": (STATS["sender"] or {}).get("counters", {}).get("transmissions", 0),
+    }
+    DURATIONS = {
+        "wire": NUM_SECONDS,
+        "receiver": (STATS["receiver"] or {}).get("duration", NUM_SECONDS),
+        "sender": (STATS["sender"] or {}).get("duration", NUM_SECONDS),
+    }
+    print("\nProfile")
+    print("---")
+    print(utils.profiling.format_report(
+        [utils.profiling.ProcessProfile(A_PROCESS, A_PATH, CPU_TIMES[A_PROCESS],
+                                        PACKETS[A_PROCESS], DURATIONS[A_PROCESS])
+         for A_PROCESS, A_PATH in PROFILE_PATHS.items()],
+        ARGS.profile_top))
+    for A_PATH in PROFILE_PATHS.values():
+        os.remove(A_PATH)
 sys.exit(0 if IS_SUCCESS else 1)
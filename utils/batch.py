@@ -0,0 +1,188 @@
+"""
+Batched UDP I/O, so that runs of packets cost one system call instead of one
+each.  On Linux, runs of equally sized packets are sent together with UDP
+generic segmentation offload (UDP_SEGMENT), which has the kernel, or the
+network card, split them back into datagrams, and datagrams coalesced by
+generic receive offload (UDP_GRO) are received together and split here.
+Where either is not supported, packets are sent and received one at a time.
+"""
+
+import collections
+import socket
+import struct
+import sys
+import typing
+
+import utils
+import utils.stream
+
+# Socket options, from linux/udp.h, for Pythons that do not define them.
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+
+# The kernel's limits on one segmented send: the number of segments, and
+# the size of the whole UDP payload.
+MAX_SEGMENTS = 64
+MAX_BATCH_BYTES = 65507
+
+# Size of the buffer coalesced datagrams are received into.
+GRO_BUFFER_SIZE = 65535
+
+# Ancillary data carrying the size of the segments of a send, and of the
+# datagrams coalesced into a receive.
+SEGMENT_SIZE = struct.Struct('=H')
+GRO_SIZE = struct.Struct('=i')
+
+
+def _is_udp_socket(sock) -> bool:
+    return (sys.platform.startswith('linux') and isinstance(sock, socket.socket) and
+            sock.type == socket.SOCK_DGRAM)
+
+
+def gso_supported(sock) -> bool:
+    """Returns whether runs of packets can be sent on the socket with
+    UDP_SEGMENT.
+    """
+    if not _is_udp_socket(sock):
+        return False
+    try:
+        sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+    except OSError:
+        return False
+    return True
+
+
+def enable_gro(sock) -> bool:
+    """Asks the kernel to coalesce datagrams received on the socket.
+
+    Return:
+        Whether it agreed.
+    """
+    if not _is_udp_socket(sock):
+        return False
+    try:
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+
+class BatchSender:
+    """Collects packets to send, and sends each run of equally sized packets
+    (the last of which may be shorter) with one system call.  Packets are
+    only sent once flush is called, or the run is full, so the caller must
+    flush before waiting for replies.  It has the send method of a socket,
+    so it can be handed to functions that only send.
+
+    Args:
+        sock -- The connected socket to send on.
+        enabled -- Whether to batch, if the socket supports it; if not, or
+                   it does not, every packet is sent as soon as it is added.
+    """
+
+    def __init__(self, sock: socket.socket, enabled: bool = True):
+        self._sock = sock
+        self.batching = enabled and gso_supported(sock)
+        self._run = []  # Packets of the current run
+        self._segment_size = 0  # Size of the packets in the current run
+        self._run_bytes = 0
+        self.calls = 0  # System calls made to send
+
+    def send(self, packet) -> int:
+        """Adds a packet to send.  The packet must not be modified until it
+        has been flushed.
+        """
+        size = len(packet)
+        if not self.batching:
+            self.calls += 1
+            return self._sock.send(packet)
+        if self._run and (size > self._segment_size or len(self._run) >= MAX_SEGMENTS or
+                          self._run_bytes + size > MAX_BATCH_BYTES or
+                          len(self._run[-1]) < self._segment_size):
+            self.flush()
+        if not self._run:
+            self._segment_size = size
+        self._run.append(packet)
+        self._run_bytes += size
+        return size
+
+    def flush(self):
+        """Sends the packets added since the last flush."""
+        if not self._run:
+            return
+        run = self._run
+        self._run = []
+        self._run_bytes = 0
+        self.calls += 1
+        if len(run) == 1:
+            self._sock.send(run[0])
+            return
+        try:
+            self._sock.sendmsg(run, [(SOL_UDP, UDP_SEGMENT,
+                                      SEGMENT_SIZE.pack(self._segment_size))])
+        except OSError:
+            # The route's device cannot segment, so stop trying.
+            self.batching = False
+            for packet in run:
+                self.calls += 1
+                self._sock.send(packet)
+
+
+class BatchReceiver:
+    """Receives packets from a socket into buffers from a pool.  If the
+    kernel coalesces datagrams, a run of them is received at once, and
+    handed out one at a time before the socket is read again.
+
+    Args:
+        sock -- The socket to receive on.
+        pool -- The pool of buffers, each large enough for a packet.
+        enabled -- Whether to ask for coalesced datagrams, if the socket
+                   supports them; if not, or it does not, every packet is
+                   received straight into its buffer.
+    """
+
+    def __init__(self, sock: socket.socket, pool: utils.stream.BufferPool,
+                 enabled: bool = True):
+        self._sock = sock
+        self._pool = pool
+        self.batching = enabled and enable_gro(sock)
+        self._buffer = bytearray(GRO_BUFFER_SIZE) if self.batching else None
+        self._pending = collections.deque()  # (start, end) of packets left in the buffer
+        self.calls = 0  # System calls made to receive
+
+    @property
+    def pending(self) -> int:
+        """The number of packets received but not yet handed out."""
+        return len(self._pending)
+
+    def receive(self) -> typing.Tuple[bytearray, int]:
+        """Returns the next packet, waiting for it as the socket's timeout
+        allows.
+
+        Return:
+            Two values, first a buffer from the pool holding the packet, and
+            second its length, which is 0 if the socket was closed.
+        """
+        if not self.batching:
+            buffer = self._pool.get()
+            self.calls += 1
+            return buffer, self._sock.recv_into(buffer)
+        if not self._pending:
+            self.calls += 1
+            length, ancillary, _, _ = self._sock.recvmsg_into(
+                [self._buffer], socket.CMSG_SPACE(GRO_SIZE.size))
+            segment_size = length
+            for level, kind, data in ancillary:
+                if level == SOL_UDP and kind == UDP_GRO:
+                    segment_size, = GRO_SIZE.unpack(data[:GRO_SIZE.size])
+            if not length:
+                return self._pool.get(), 0
+            self._pending.extend((start, min(start + segment_size, length))
+                                 for start in range(0, length, segment_size))
+        start, end = self._pending.popleft()
+        buffer = self._pool.get()
+        count = min(end - start, len(buffer))
+        with memoryview(self._buffer) as view:
+            buffer[:count] = view[start:start + count]
+        return buffer, count
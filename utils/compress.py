@@ -0,0 +1,227 @@
+"""
+Compression of the data being sent, in independently compressed blocks, so
+that compressible data takes fewer packets on the wire.
+
+The sender turns its data into a stream of frames, each holding one block
+either compressed or, if compressing it did not pay off, stored as is, and
+sends that stream in place of the data.  Blocks are compressed by a pool of
+threads ahead of the sender, so compression overlaps with sending.  The
+receiver unpacks the frames as they arrive in order.
+"""
+
+import collections
+import concurrent.futures
+import io
+import lzma
+import os
+import struct
+import typing
+import zlib
+
+import utils.stream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every frame starts with the codec the block was compressed with (0 if it is
+# stored uncompressed), the size of the block, and the size of the frame's
+# payload.
+FRAME = struct.Struct('!BII')
+STORED = 0
+
+# How many bytes of data are compressed together as one block.
+BLOCK_SIZE = 64 * 1024
+
+# A block is only sent compressed if that makes it at most this fraction of
+# its size; otherwise it is not worth decompressing.
+MIN_SAVING = 0.9
+
+# After a block fails to compress, this many following blocks, doubling on
+# each further failure, are stored without trying, so incompressible data
+# costs little CPU.
+MAX_SKIP = 8
+
+# Number of threads compressing blocks ahead of the sender.
+WORKERS = min(4, os.cpu_count() or 1)
+
+
+class Codec(typing.NamedTuple):
+    """A compression algorithm.
+
+    Args:
+        ident -- The number identifying the algorithm in frames and in the
+                 handshake.
+        name -- The name used to select the algorithm.
+        compress -- A function compressing a bytes-like object.
+        decompress -- A function reversing compress.
+    """
+    ident: int
+    name: str
+    compress: typing.Callable[[typing.Any], bytes]
+    decompress: typing.Callable[[typing.Any], bytes]
+
+
+CODECS: typing.Dict[str, Codec] = {
+    "zlib": Codec(1, "zlib", zlib.compress, zlib.decompress),
+    "lzma": Codec(2, "lzma", lzma.compress, lzma.decompress),
+}
+if zstandard is not None:
+    # Compressor objects are not safe to share between threads, so each
+    # block gets its own.
+    CODECS["zstd"] = Codec(3, "zstd",
+                           lambda data: zstandard.ZstdCompressor().compress(data),
+                           lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+CODECS_BY_ID: typing.Dict[int, Codec] = {
+    a_codec.ident: a_codec for a_codec in CODECS.values()
+}
+
+
+def get_codec(name: str) -> Codec:
+    """Returns the compression algorithm with the given name, one of the keys
+    of CODECS.
+    """
+    if name not in CODECS:
+        raise ValueError(f"Unknown or unavailable compression algorithm: {name}")
+    return CODECS[name]
+
+
+def _stored_frame(block: bytes) -> bytes:
+    return FRAME.pack(STORED, len(block), len(block)) + block
+
+
+def _compressed_frame(codec: Codec, block: bytes) -> typing.Tuple[bool, bytes]:
+    compressed = codec.compress(block)
+    if len(compressed) > len(block) * MIN_SAVING:
+        return False, _stored_frame(block)
+    return True, FRAME.pack(codec.ident, len(block), len(compressed)) + compressed
+
+
+class CompressingReader(io.RawIOBase):
+    """Wraps a readable file object, so that reading gives the stream of
+    frames holding its data instead.  The underlying reader is not closed
+    with this one.
+
+    Args:
+        reader -- The readable file object with the data to compress.
+        codec -- The compression algorithm to use.
+        block_size -- The number of bytes of data in each block.
+        workers -- The number of threads to compress blocks with.
+    """
+
+    def __init__(self, reader: typing.BinaryIO, codec: Codec,
+                 block_size: int = BLOCK_SIZE, workers: int = WORKERS):
+        super().__init__()
+        self._reader = reader
+        self._codec = codec
+        self._block_size = block_size
+        self._depth = 2 * workers  # Blocks read and compressing ahead
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._queue = collections.deque()  # (whether compression was tried, future)
+        self._pending = memoryview(b'')
+        self._eof = False
+        self._skip = 0  # Blocks left to store without trying to compress them
+        self._backoff = 0  # Blocks to skip after the next failure, halved
+        self.raw_bytes = 0
+        self.compressed_blocks = 0
+        self.stored_blocks = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self):
+        while not self._eof and len(self._queue) < self._depth:
+            block = bytearray(self._block_size)
+            with memoryview(block) as view:
+                length = utils.stream.readinto_full(self._reader, view)
+            if not length:
+                self._eof = True
+                break
+            del block[length:]
+            self.raw_bytes += length
+            if self._skip:
+                self._skip -= 1
+                future = concurrent.futures.Future()
+                future.set_result((False, _stored_frame(block)))
+                self._queue.append((False, future))
+            else:
+                self._queue.append(
+                    (True, self._executor.submit(_compressed_frame, self._codec, bytes(block))))
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            self._fill()
+            if not self._queue:
+                return 0
+            tried, future = self._queue.popleft()
+            compressed, frame = future.result()
+            if compressed:
+                self.compressed_blocks += 1
+                self._backoff = 0
+            else:
+                self.stored_blocks += 1
+                if tried:
+                    self._backoff = min(max(self._backoff * 2, 1), MAX_SKIP)
+                    self._skip = self._backoff
+            self._pending = memoryview(frame)
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        super().close()
+
+
+class DecompressingWriter:
+    """Takes the stream of frames written by a CompressingReader, in order,
+    and writes the data they hold to a destination file.  It is not seekable,
+    so a utils.stream.ChunkWriter in front of it hands it data in order.
+
+    Args:
+        dest -- The binary file object to write the data to.
+    """
+
+    def __init__(self, dest: typing.BinaryIO):
+        self._dest = dest
+        self._buffer = bytearray()
+        self.num_bytes = 0
+
+    def seekable(self) -> bool:
+        return False
+
+    @property
+    def pending(self) -> int:
+        """The number of bytes held of a frame that has not fully arrived."""
+        return len(self._buffer)
+
+    def write(self, data) -> int:
+        self._buffer += data
+        start = 0
+        while len(self._buffer) - start >= FRAME.size:
+            ident, size, length = FRAME.unpack_from(self._buffer, start)
+            end = start + FRAME.size + length
+            if end > len(self._buffer):
+                break
+            with memoryview(self._buffer) as view:
+                payload = view[start + FRAME.size:end]
+                if ident == STORED:
+                    self._dest.write(payload)
+                elif ident in CODECS_BY_ID:
+                    block = CODECS_BY_ID[ident].decompress(payload)
+                    if len(block) != size:
+                        raise ValueError("A compressed block decompressed to the wrong size.")
+                    self._dest.write(block)
+                else:
+                    raise ValueError(f"A block was compressed with an unknown algorithm: {ident}")
+                payload.release()
+            self.num_bytes += size
+            start = end
+        del self._buffer[:start]
+        return len(data)
+
+    def flush(self):
+        self._dest.flush()
@@ -0,0 +1,161 @@
+"""
+Congestion control algorithms for deciding how many packets the sender may
+have in flight, and how quickly it should put them on the wire.
+"""
+
+import typing
+
+# Multipliers applied to the estimated bandwidth (cwnd / RTT) when pacing,
+# so that the sender can still probe for more bandwidth.  Slow start paces
+# faster, since the window is expected to double every round trip.
+SLOW_START_PACING_GAIN = 2.0
+CONGESTION_AVOIDANCE_PACING_GAIN = 1.25
+
+
+class CongestionController:
+    """Base controller, with a window that never changes size.
+
+    Args:
+        initial_window -- The number of packets that may be in flight before
+                          any ACKs have been received.
+        max_window -- The largest the window is ever allowed to grow to.
+    """
+
+    def __init__(self, initial_window: int = 2, max_window: int = 1024):
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.max_window = max_window
+
+    @property
+    def window(self) -> int:
+        """The number of packets currently allowed to be in flight."""
+        return max(1, int(self.cwnd))
+
+    def in_slow_start(self) -> bool:
+        return self.cwnd < self.ssthresh
+
+    def on_ack(self, num_acked: int, now: float, rtt: float):
+        """Called whenever previously unacknowledged packets are acknowledged.
+
+        Args:
+            num_acked -- The number of packets newly acknowledged.
+            now -- The time the ACK was received.
+            rtt -- The current smoothed estimate of the round trip time.
+        """
+
+    def on_loss(self, in_flight: int, now: float):
+        """Called when packet loss is detected without a timeout."""
+
+    def on_timeout(self, in_flight: int, now: float):
+        """Called when the retransmission timer expires."""
+
+    def pacing_interval(self, rtt: float) -> float:
+        """Returns the number of seconds to wait between sending packets,
+        spreading a window worth of packets over a round trip instead of
+        sending them in a single burst.
+
+        Args:
+            rtt -- The current smoothed estimate of the round trip time.
+        """
+        if self.in_slow_start():
+            gain = SLOW_START_PACING_GAIN
+        else:
+            gain = CONGESTION_AVOIDANCE_PACING_GAIN
+        return rtt / (gain * self.cwnd)
+
+
+class Fixed(CongestionController):
+    """A window fixed at its initial size, with no pacing, which is how the
+    sender behaved before congestion control was added.
+    """
+
+    def pacing_interval(self, rtt: float) -> float:
+        return 0.0
+
+
+class Reno(CongestionController):
+    """Classic slow start, followed by additive increase / multiplicative
+    decrease (AIMD) once the window passes the slow start threshold.
+    """
+
+    def on_ack(self, num_acked: int, now: float, rtt: float):
+        for _ in range(num_acked):
+            if self.in_slow_start():
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, in_flight: int, now: float):
+        self.ssthresh = max(in_flight / 2, 2.0)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, in_flight: int, now: float):
+        self.ssthresh = max(in_flight / 2, 2.0)
+        self.cwnd = 1.0
+
+
+class Cubic(Reno):
+    """CUBIC (RFC 8312), which grows the window as a cubic function of the
+    time since the last loss, making it much less sensitive to the RTT than
+    Reno on long, fat links.
+    """
+
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_window: int = 2, max_window: int = 1024):
+        super().__init__(initial_window, max_window)
+        self._w_max = 0.0
+        self._k = 0.0
+        self._epoch_start = None
+
+    def on_ack(self, num_acked: int, now: float, rtt: float):
+        if self.in_slow_start():
+            super().on_ack(num_acked, now, rtt)
+            return
+
+        if self._epoch_start is None:
+            self._epoch_start = now
+            if self._w_max < self.cwnd:
+                self._w_max = self.cwnd
+                self._k = 0.0
+
+        # Grow towards where the cubic curve will be one RTT from now.
+        elapsed = now - self._epoch_start + rtt
+        target = self.C * (elapsed - self._k) ** 3 + self._w_max
+        if target > self.cwnd:
+            self.cwnd += num_acked * (target - self.cwnd) / self.cwnd
+        else:
+            self.cwnd += num_acked * 0.01 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def _reduce(self):
+        self._w_max = self.cwnd
+        self._k = (self._w_max * (1 - self.BETA) / self.C) ** (1 / 3)
+        self._epoch_start = None
+        self.ssthresh = max(self.cwnd * self.BETA, 2.0)
+
+    def on_loss(self, in_flight: int, now: float):
+        self._reduce()
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, in_flight: int, now: float):
+        self._reduce()
+        self.cwnd = 1.0
+
+
+CONTROLLERS: typing.Dict[str, typing.Type[CongestionController]] = {
+    "fixed": Fixed,
+    "reno": Reno,
+    "cubic": Cubic,
+}
+
+
+def get_controller(name: str, **kwargs) -> CongestionController:
+    """Returns a new congestion controller for the algorithm with the given
+    name, one of the keys of CONTROLLERS.
+    """
+    if name not in CONTROLLERS:
+        raise ValueError(f"Unknown congestion control algorithm: {name}")
+    return CONTROLLERS[name](**kwargs)
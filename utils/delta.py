@@ -0,0 +1,256 @@
+"""
+Delta transfers, in the style of rsync: the receiver describes the copy of
+the file it already has as signatures of its blocks, and the sender, which
+has the new version, sends only the data the receiver lacks, along with
+references to the blocks of the receiver's copy that it can reuse.
+
+Each block's signature is a weak checksum that can be rolled along the new
+data one byte at a time (Adler-32), and a strong hash to confirm matches.
+"""
+
+import hashlib
+import io
+import math
+import struct
+import typing
+import zlib
+
+import utils.packet
+import utils.stream
+
+# Bounds on the size of the blocks signed.  Larger files get larger blocks
+# (the square root of their size), so the signatures stay small.
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 64 * 1024
+
+# Payload of SIGNATURES pages: the block size, and then an entry for each
+# block, its weak checksum and strong hash.
+SIGNATURE_HEADER = struct.Struct('!I')
+SIGNATURE = struct.Struct('!I8s')
+
+# The delta stream is a sequence of operations: LITERAL, followed by that
+# many bytes of data, or COPY, of a run of consecutive blocks from the
+# receiver's copy, given by the first block and the number of blocks.
+OP = struct.Struct('!BII')
+LITERAL = 0
+COPY = 1
+
+# The most bytes of data sent in one LITERAL operation.
+MAX_LITERAL = 64 * 1024
+
+_MOD_ADLER = 65521
+
+Signatures = typing.Dict[int, typing.Dict[bytes, int]]
+
+
+def block_size_for(size: int) -> int:
+    """Returns the block size to sign a file of the given size with."""
+    return min(max(math.isqrt(size), MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=SIGNATURE.size - 4).digest()
+
+
+def signature_pages(basis: typing.BinaryIO, block_size: int,
+                    page_size: int) -> typing.List[bytes]:
+    """Signs every full block of the receiver's copy of the file, and splits
+    the signatures into the payloads of SIGNATURES packets.
+
+    Args:
+        basis -- The receiver's copy of the file, open for reading.
+        block_size -- The size of the blocks to sign.
+        page_size -- The largest payload a packet can carry.
+    """
+    basis.seek(0)
+    entries = []
+    block = bytearray(block_size)
+    with memoryview(block) as view:
+        while utils.stream.readinto_full(basis, view) == block_size:
+            entries.append(SIGNATURE.pack(zlib.adler32(view), strong_hash(view)))
+    return utils.packet.paginate(SIGNATURE_HEADER.pack(block_size), entries, page_size)
+
+
+def parse_signatures(pages: typing.List[bytes]) -> typing.Tuple[int, Signatures]:
+    """Unpacks the pages built by signature_pages.
+
+    Return:
+        Two values, first the block size, and second the blocks' indexes, by
+        strong hash, by weak checksum.
+    """
+    block_size = 0
+    signatures: Signatures = {}
+    index = 0
+    for page in pages:
+        block_size, = SIGNATURE_HEADER.unpack_from(page)
+        for weak, strong in SIGNATURE.iter_unpack(page[SIGNATURE_HEADER.size:]):
+            signatures.setdefault(weak, {}).setdefault(strong, index)
+            index += 1
+    return block_size, signatures
+
+
+class DeltaReader(utils.stream.IterReader):
+    """Wraps a readable file object with the new version of the data, so that
+    reading gives the delta stream against the receiver's copy instead.
+
+    Args:
+        reader -- The readable file object with the new data.
+        block_size -- The size of the blocks the receiver signed.
+        signatures -- The signatures, from parse_signatures.
+    """
+
+    def __init__(self, reader: typing.BinaryIO, block_size: int, signatures: Signatures):
+        self._reader = reader
+        self._block_size = block_size
+        self._signatures = signatures
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+        super().__init__(self._operations())
+
+    def _literal(self, data) -> typing.Iterator[bytes]:
+        for start in range(0, len(data), MAX_LITERAL):
+            piece = data[start:start + MAX_LITERAL]
+            self.literal_bytes += len(piece)
+            yield OP.pack(LITERAL, len(piece), 0) + piece
+
+    def _operations(self) -> typing.Iterator[bytes]:
+        block_size = self._block_size
+        signatures = self._signatures
+        data = bytearray()
+        eof = False
+        pos = 0  # Start of the window being matched
+        literal_start = 0  # Start of the data not yet sent or matched
+        weak = None  # Adler-32 of the window, while rolling
+        copy_start, copy_count = 0, 0  # The run of blocks being matched
+
+        while True:
+            if not eof and len(data) - pos < block_size + 1:
+                # Drop the data already dealt with, and read more.
+                del data[:literal_start]
+                pos -= literal_start
+                literal_start = 0
+                chunk = self._reader.read(max(MAX_LITERAL, block_size))
+                if chunk:
+                    data += chunk
+                    continue
+                eof = True
+            if len(data) - pos < block_size:
+                break
+
+            if weak is None:
+                weak = zlib.adler32(data[pos:pos + block_size])
+            candidates = signatures.get(weak)
+            index = None
+            if candidates is not None:
+                index = candidates.get(strong_hash(data[pos:pos + block_size]))
+            if index is not None:
+                if pos > literal_start:
+                    if copy_count:
+                        yield OP.pack(COPY, copy_start, copy_count)
+                        copy_count = 0
+                    yield from self._literal(bytes(data[literal_start:pos]))
+                if copy_count and index == copy_start + copy_count:
+                    copy_count += 1
+                else:
+                    if copy_count:
+                        yield OP.pack(COPY, copy_start, copy_count)
+                    copy_start, copy_count = index, 1
+                self.copied_bytes += block_size
+                pos += block_size
+                literal_start = pos
+                weak = None
+                continue
+
+            if pos + block_size >= len(data):
+                if eof:
+                    break
+                continue  # Read more before rolling on
+            # Roll the window on a byte at a time, dropping its first byte and
+            # adding the byte after it, until its weak checksum is that of
+            # some block, or there is a literal's worth of unmatched data.
+            low, high = weak & 0xFFFF, weak >> 16
+            limit = min(len(data) - block_size, literal_start + MAX_LITERAL)
+            while pos < limit:
+                out_byte = data[pos]
+                low = (low - out_byte + data[pos + block_size]) % _MOD_ADLER
+                high = (high - block_size * out_byte + low - 1) % _MOD_ADLER
+                pos += 1
+                if (high << 16) | low in signatures:
+                    break
+            weak = (high << 16) | low
+            if pos - literal_start >= MAX_LITERAL:
+                if copy_count:
+                    yield OP.pack(COPY, copy_start, copy_count)
+                    copy_count = 0
+                yield from self._literal(bytes(data[literal_start:pos]))
+                literal_start = pos
+
+        if copy_count:
+            yield OP.pack(COPY, copy_start, copy_count)
+        yield from self._literal(bytes(data[literal_start:]))
+
+
+class DeltaWriter:
+    """Takes the delta stream written by a DeltaReader, in order, and writes
+    the new version of the data it describes to a destination file, copying
+    the blocks it references from the receiver's copy.  It is not seekable,
+    so a utils.stream.ChunkWriter in front of it hands it data in order.
+
+    Args:
+        dest -- The binary file object to write the new data to.
+        basis -- The receiver's copy of the file, open for reading.  Its
+                 size decides the block size it is signed with.
+    """
+
+    def __init__(self, dest: typing.BinaryIO, basis: typing.BinaryIO):
+        self._dest = dest
+        self._basis = basis
+        basis.seek(0, io.SEEK_END)
+        self.block_size = block_size_for(basis.tell())
+        self._buffer = bytearray()
+        self.num_bytes = 0
+        self.copied_bytes = 0
+
+    def seekable(self) -> bool:
+        return False
+
+    @property
+    def pending(self) -> int:
+        """The number of bytes held of an operation that has not fully arrived."""
+        return len(self._buffer)
+
+    def write(self, data) -> int:
+        self._buffer += data
+        start = 0
+        while len(self._buffer) - start >= OP.size:
+            operation, first, count = OP.unpack_from(self._buffer, start)
+            if operation == COPY:
+                self._copy(first, count)
+                start += OP.size
+                continue
+            if operation != LITERAL:
+                raise ValueError(f"Unknown delta operation: {operation}")
+            end = start + OP.size + first
+            if end > len(self._buffer):
+                break
+            with memoryview(self._buffer) as view:
+                self._dest.write(view[start + OP.size:end])
+            self.num_bytes += first
+            start = end
+        del self._buffer[:start]
+        return len(data)
+
+    def _copy(self, first: int, count: int):
+        self._basis.seek(first * self.block_size)
+        remaining = count * self.block_size
+        while remaining:
+            block = self._basis.read(min(remaining, MAX_LITERAL))
+            if not block:
+                raise ValueError("A delta referenced a block past the end of the basis file.")
+            self._dest.write(block)
+            remaining -= len(block)
+        self.num_bytes += count * self.block_size
+        self.copied_bytes += count * self.block_size
+
+    def flush(self):
+        self._dest.flush()
@@ -0,0 +1,168 @@
+"""
+Sharing one socket between many connections.  A demultiplexer reads every
+datagram that arrives on the socket, and hands it to the connection its
+connection ID names, through a channel that looks to hw5.recv like a socket
+of the connection's own.
+"""
+
+import asyncio
+import collections
+import functools
+import queue
+import socket
+import time
+import typing
+
+import utils.packet
+
+# How long a connection may go without a packet arriving before it is taken
+# to be abandoned, and its channel reads as closed.
+IDLE_TIMEOUT = 60.0
+
+# The most datagrams held for a connection that has not read them yet; any
+# more are dropped, as a full socket buffer would drop them.
+MAX_QUEUED = 4096
+
+# How many finished connections are remembered, so that stray packets of
+# theirs, such as a late duplicate SYN, do not start them over.
+FINISHED_MEMORY = 1024
+
+
+class Channel:
+    """One connection's view of a shared socket.  Datagrams are queued for it
+    by the demultiplexer, and read with the blocking calls of a socket, from
+    the thread running the connection.
+
+    Args:
+        conn_id -- The ID of the connection.
+        send -- A function sending a datagram to the connection's peer.
+        idle_timeout -- How many seconds may pass without a datagram before
+                        reads return nothing, as they would on a closed
+                        socket.
+    """
+
+    def __init__(self, conn_id: int, send: typing.Callable[[bytes], None],
+                 idle_timeout: float = IDLE_TIMEOUT):
+        self.conn_id = conn_id
+        self._send = send
+        self._queue = queue.Queue(MAX_QUEUED)
+        self._timeout = None
+        self._idle_timeout = idle_timeout
+        self._last_arrival = time.monotonic()
+        self.closed = False
+
+    def deliver(self, packet: bytes):
+        """Queues a datagram for the connection, dropping it if the queue is
+        full.
+        """
+        try:
+            self._queue.put_nowait(packet)
+        except queue.Full:
+            pass
+
+    def close(self):
+        """Makes reads return nothing from now on, waking any read waiting."""
+        self.closed = True
+        try:
+            self._queue.put_nowait(b'')
+        except queue.Full:
+            pass
+
+    def settimeout(self, timeout: typing.Optional[float]):
+        self._timeout = timeout
+
+    def gettimeout(self) -> typing.Optional[float]:
+        return self._timeout
+
+    def send(self, data) -> int:
+        self._send(bytes(data))
+        return len(data)
+
+    def recv(self, size: int) -> bytes:
+        return self._next()[:size]
+
+    def recv_into(self, buffer) -> int:
+        packet = self._next()
+        count = min(len(packet), len(buffer))
+        buffer[:count] = packet[:count]
+        return count
+
+    def _next(self) -> bytes:
+        now = time.monotonic()
+        deadline = None if self._timeout is None else now + self._timeout
+        while not self.closed:
+            idle_deadline = self._last_arrival + self._idle_timeout
+            wait = idle_deadline - now
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            try:
+                packet = self._queue.get(timeout=max(wait, 0))
+            except queue.Empty:
+                now = time.monotonic()
+                if now >= idle_deadline:
+                    return b''
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout("timed out")
+                continue
+            if packet:
+                self._last_arrival = time.monotonic()
+            return packet
+        return b''
+
+
+class Demultiplexer(asyncio.DatagramProtocol):
+    """Hands every datagram arriving on a shared socket to the channel of the
+    connection it belongs to.  A valid SYN for a connection it does not know
+    offers a new channel to accept, which starts the connection if it
+    returns True; otherwise the SYN is ignored, and the sender will retry it.
+
+    Args:
+        loop -- The event loop the socket is read on.
+        accept -- A function offered the channel of each new connection.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 accept: typing.Callable[[Channel], bool]):
+        self._loop = loop
+        self._accept = accept
+        self._channels: typing.Dict[int, Channel] = {}
+        self._finished = collections.OrderedDict()  # IDs of finished connections
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        conn_id = utils.packet.peek_conn_id(data)
+        if conn_id is None or conn_id in self._finished:
+            return
+        channel = self._channels.get(conn_id)
+        if channel is None:
+            header = utils.packet.unpack_from(data, len(data))
+            if header is None or header.ptype != utils.packet.SYN:
+                return
+            channel = Channel(conn_id, functools.partial(self._send, addr))
+            if not self._accept(channel):
+                return
+            self._channels[conn_id] = channel
+        channel.deliver(data)
+
+    def _send(self, addr, data: bytes):
+        # Channels send from the threads running their connections, and the
+        # transport may only be used from the event loop's thread.
+        self._loop.call_soon_threadsafe(self._transport.sendto, data, addr)
+
+    def finish(self, channel: Channel):
+        """Closes a connection's channel, and forgets the connection."""
+        channel.close()
+        self._channels.pop(channel.conn_id, None)
+        self._finished[channel.conn_id] = True
+        while len(self._finished) > FINISHED_MEMORY:
+            self._finished.popitem(last=False)
+
+    def close(self):
+        """Closes every connection's channel, and the transport."""
+        for channel in list(self._channels.values()):
+            self.finish(channel)
+        if self._transport is not None:
+            self._transport.close()
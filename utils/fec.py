@@ -0,0 +1,243 @@
+"""
+Forward error correction: parity packets computed over blocks of data
+packets, from which the receiver can rebuild lost data packets without
+waiting for them to be retransmitted.
+
+With one parity packet per block, the parity is the XOR of the block's data
+packets, which repairs any single loss.  With more, the parity packets are a
+Cauchy Reed-Solomon code over GF(256), which repairs as many losses per block
+as there are parity packets.  Both sides fold each data packet into running
+per-block sums as it passes, so neither ever holds a block's data packets.
+"""
+
+import functools
+import struct
+import typing
+
+# Prefix of every parity packet's payload: the number of data packets in the
+# block (only the last block may be short), and the index of the parity
+# packet within the block.
+FEC_HEADER = struct.Struct('!BB')
+
+# Every data packet is coded as its length followed by its payload, padded
+# to the chunk size, so rebuilt packets get their original length back.
+LENGTH = struct.Struct('!H')
+
+# How many more bytes a parity packet's payload is than a full data packet's.
+OVERHEAD = FEC_HEADER.size + LENGTH.size
+
+# Block size plus parity count may not exceed the size of the field.
+MAX_SYMBOLS = 256
+
+# Log and anti-log tables for GF(256), with the polynomial x^8+x^4+x^3+x^2+1.
+_EXP = [0] * 512
+_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    _EXP[_power] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11D
+for _power in range(255, 512):
+    _EXP[_power] = _EXP[_power - 255]
+
+
+def _gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def _gf_inv(a: int) -> int:
+    return _EXP[255 - _LOG[a]]
+
+
+@functools.lru_cache(maxsize=None)
+def _mul_table(coefficient: int) -> bytes:
+    """Returns a translation table multiplying every byte by the coefficient,
+    so whole packets can be multiplied at C speed with bytes.translate.
+    """
+    return bytes(_gf_mul(coefficient, a_byte) for a_byte in range(256))
+
+
+def coefficient(parity_count: int, parity_index: int, data_index: int) -> int:
+    """Returns the weight of a data packet in a parity packet.  A single
+    parity packet is a plain XOR; otherwise the weights form a Cauchy matrix,
+    any square submatrix of which is invertible.
+    """
+    if parity_count == 1:
+        return 1
+    return _gf_inv(parity_index ^ (parity_count + data_index))
+
+
+def _scale(symbol: bytes, factor: int) -> bytes:
+    if factor == 1:
+        return symbol
+    return symbol.translate(_mul_table(factor))
+
+
+def _invert(matrix: typing.List[typing.List[int]]) -> typing.List[typing.List[int]]:
+    """Inverts a square matrix over GF(256) by Gauss-Jordan elimination."""
+    size = len(matrix)
+    rows = [row[:] + [int(col == index) for col in range(size)]
+            for index, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next(index for index in range(col, size) if rows[index][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = _gf_inv(rows[col][col])
+        rows[col] = [_gf_mul(scale, value) for value in rows[col]]
+        for index in range(size):
+            factor = rows[index][col]
+            if index != col and factor:
+                rows[index] = [value ^ _gf_mul(factor, pivot_value)
+                               for value, pivot_value in zip(rows[index], rows[col])]
+    return [row[size:] for row in rows]
+
+
+class Encoder:
+    """Computes the parity packets for each block of data packets, as the data
+    packets are sent for the first time.
+
+    Args:
+        block_size -- The number of data packets in each block.
+        parity_count -- The number of parity packets per block.
+        chunk_size -- The size of a full data packet's payload.
+    """
+
+    def __init__(self, block_size: int, parity_count: int, chunk_size: int):
+        self._block_size = block_size
+        self._parity_count = parity_count
+        self._symbol_size = LENGTH.size + chunk_size
+        self._count = 0
+        self._sums = [0] * parity_count
+
+    def add(self, payload: bytes) -> typing.List[bytes]:
+        """Folds the next data packet's payload into the current block.
+
+        Return:
+            The payloads of the block's parity packets, if the payload
+            completed a block, and otherwise an empty list.
+        """
+        symbol = (LENGTH.pack(len(payload)) + payload).ljust(self._symbol_size, b'\0')
+        for index in range(self._parity_count):
+            weight = coefficient(self._parity_count, index, self._count)
+            self._sums[index] ^= int.from_bytes(_scale(symbol, weight), 'big')
+        self._count += 1
+        if self._count == self._block_size:
+            return self.flush()
+        return []
+
+    def flush(self) -> typing.List[bytes]:
+        """Ends the current block early, once there is no more data.
+
+        Return:
+            The payloads of the block's parity packets, or an empty list if
+            the block is empty.
+        """
+        if not self._count:
+            return []
+        parity = [FEC_HEADER.pack(self._count, index) +
+                  a_sum.to_bytes(self._symbol_size, 'big')
+                  for index, a_sum in enumerate(self._sums)]
+        self._count = 0
+        self._sums = [0] * self._parity_count
+        return parity
+
+
+class _Block:
+    def __init__(self, parity_count: int):
+        self.received = set()  # Indexes of the data packets received
+        self.sums = [0] * parity_count  # Weighted sums of the data received
+        self.parity = {}  # Parity packets received, by index
+        self.count = None  # Number of data packets, once a parity packet says
+
+
+class Decoder:
+    """Rebuilds lost data packets from the data and parity packets received.
+
+    Args:
+        block_size -- The number of data packets in each block.
+        parity_count -- The number of parity packets per block.
+        chunk_size -- The size of a full data packet's payload.
+    """
+
+    def __init__(self, block_size: int, parity_count: int, chunk_size: int):
+        self._block_size = block_size
+        self._parity_count = parity_count
+        self._symbol_size = LENGTH.size + chunk_size
+        self._blocks: typing.Dict[int, _Block] = {}
+
+    def add_data(self, seq_num: int,
+                 payload: bytes) -> typing.List[typing.Tuple[int, bytes]]:
+        """Folds a newly received data packet into its block.
+
+        Return:
+            Any data packets of the block that can now be rebuilt, as
+            (sequence number, payload) pairs.
+        """
+        block_num, index = divmod(seq_num, self._block_size)
+        block = self._blocks.setdefault(block_num, _Block(self._parity_count))
+        symbol = (LENGTH.pack(len(payload)) + payload).ljust(self._symbol_size, b'\0')
+        for parity_index in range(self._parity_count):
+            weight = coefficient(self._parity_count, parity_index, index)
+            block.sums[parity_index] ^= int.from_bytes(_scale(symbol, weight), 'big')
+        block.received.add(index)
+        return self._recover(block_num, block)
+
+    def add_parity(self, block_num: int,
+                   payload: bytes) -> typing.List[typing.Tuple[int, bytes]]:
+        """Records a received parity packet.
+
+        Return:
+            Any data packets of the block that can now be rebuilt, as
+            (sequence number, payload) pairs.
+        """
+        count, index = FEC_HEADER.unpack_from(payload)
+        if index >= self._parity_count or len(payload) != FEC_HEADER.size + self._symbol_size:
+            return []
+        block = self._blocks.setdefault(block_num, _Block(self._parity_count))
+        block.count = count
+        block.parity[index] = int.from_bytes(payload[FEC_HEADER.size:], 'big')
+        return self._recover(block_num, block)
+
+    def discard_before(self, seq_num: int):
+        """Forgets every block that ends before the given sequence number,
+        since all of their data packets have been received.
+        """
+        for block_num in [a_num for a_num in self._blocks
+                          if (a_num + 1) * self._block_size <= seq_num]:
+            del self._blocks[block_num]
+
+    def _recover(self, block_num: int,
+                 block: _Block) -> typing.List[typing.Tuple[int, bytes]]:
+        count = block.count if block.count is not None else self._block_size
+        missing = [index for index in range(count) if index not in block.received]
+        if not missing:
+            del self._blocks[block_num]
+            return []
+        if block.count is None or len(missing) > len(block.parity):
+            return []
+
+        # The parity packets, less the weighted data received, leave the
+        # weighted sums of just the missing data; solve for it.
+        parity_indexes = sorted(block.parity)[:len(missing)]
+        matrix = [[coefficient(self._parity_count, parity_index, index)
+                   for index in missing] for parity_index in parity_indexes]
+        inverse = _invert(matrix)
+        residuals = [(block.parity[parity_index] ^ block.sums[parity_index])
+                     .to_bytes(self._symbol_size, 'big')
+                     for parity_index in parity_indexes]
+
+        recovered = []
+        for row, index in zip(inverse, missing):
+            value = 0
+            for weight, residual in zip(row, residuals):
+                if weight:
+                    value ^= int.from_bytes(_scale(residual, weight), 'big')
+            symbol = value.to_bytes(self._symbol_size, 'big')
+            length, = LENGTH.unpack_from(symbol)
+            recovered.append((block_num * self._block_size + index,
+                              symbol[LENGTH.size:LENGTH.size + length]))
+        del self._blocks[block_num]
+        return recovered
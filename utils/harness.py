@@ -0,0 +1,238 @@
+"""
+Code for running complete transfers, wire, receiver and sender, so that
+their performance can be measured, either as separate processes, as the
+scripts run them, or all in this process.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import utils.stats
+import utils.utils
+import utils.wire
+
+PYTHON_BINARY = sys.executable
+
+
+def run_transfer(src_path: str, port: int, loss: float, delay: float,
+                 buffer: int, sender_args: typing.Sequence[str] = (),
+                 server_args: typing.Sequence[str] = (),
+                 timeout: float = 300.0) -> typing.Dict[str, typing.Any]:
+    """Sends a file over a freshly started simulated network, and checks it
+    arrived intact.
+
+    Args:
+        src_path -- The path of the file to send.
+        port -- The port to run the simulated network on.
+        loss -- The percentage of packets the network drops.
+        delay -- The number of seconds the network delays each packet.
+        buffer -- The number of packets the network can hold in flight.
+        sender_args -- Extra command line arguments for sender.py.
+        server_args -- Extra command line arguments for server.py.
+        timeout -- The most seconds to let the sender run for.
+
+    Return:
+        A description of the run: whether it succeeded, the completion time
+        in seconds, the throughput in kB/s, and the statistics reported by
+        the sender (under "sender"), if it finished.
+    """
+    server_process = None
+    receiving_process = None
+    handle, dest_path = tempfile.mkstemp()
+    os.close(handle)
+    handle, stats_path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        server_process = utils.utils.start_when_ready(
+            [PYTHON_BINARY, "server.py", "--port", str(port), "--loss", str(loss),
+             "--delay", str(delay), "--buffer", str(buffer)] + list(server_args),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        receiving_process = utils.utils.start_when_ready(
+            [PYTHON_BINARY, "receiver.py", "--port", str(port), "--file", dest_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        start_time = time.time()
+        try:
+            sending_result = subprocess.run(
+                [PYTHON_BINARY, "sender.py", "--port", str(port), "--file", src_path,
+                 "--stats", stats_path] + list(sender_args),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+            completed = sending_result.returncode == 0
+        except subprocess.TimeoutExpired:
+            completed = False
+        completion_time = time.time() - start_time
+
+        try:
+            receiving_process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            receiving_process.kill()
+            receiving_process.wait()
+
+        sent_len, sent_hash = utils.utils.file_summary(src_path)
+        recv_len, recv_hash = utils.utils.file_summary(dest_path)
+        sender_stats = None
+        if completed:
+            with open(stats_path) as stats_handle:
+                sender_stats = json.load(stats_handle)
+        return {
+            "success": completed and sent_hash == recv_hash,
+            "completion_time": completion_time,
+            "throughput": recv_len / completion_time / 1000,
+            "sender": sender_stats,
+        }
+    finally:
+        for a_process in (receiving_process, server_process):
+            if a_process is not None and a_process.poll() is None:
+                a_process.terminate()
+                a_process.wait()
+        os.remove(dest_path)
+        os.remove(stats_path)
+
+
+def run_in_process(src_path: str, loss: float, delay: float, buffer: int,
+                   impairments: typing.Optional[utils.wire.Impairments] = None,
+                   send_kwargs: typing.Optional[typing.Dict[str, typing.Any]] = None,
+                   recv_kwargs: typing.Optional[typing.Dict[str, typing.Any]] = None,
+                   timeout: float = 300.0,
+                   replay_trace: typing.Optional[str] = None) -> typing.Dict[str, typing.Any]:
+    """Sends a file over a simulated network, like run_transfer, but with the
+    wire, receiver and sender all running on threads of this process, so
+    there are no processes to start and nothing competes for a fixed port.
+    With a seeded wire, or a replayed trace, runs are repeatable.
+
+    Args:
+        src_path -- The path of the file to send.
+        loss -- The percentage of packets the network drops.
+        delay -- The number of seconds the network delays each packet.
+        buffer -- The number of packets the network can hold in flight.
+        impairments -- Any other conditions for the network to simulate.
+        send_kwargs -- Extra arguments for hw5.send.
+        recv_kwargs -- Extra arguments for hw5.recv.
+        timeout -- The most seconds to let the transfer run for.
+        replay_trace -- The path of a trace recorded by the wire, whose
+                        losses and delays to replay.
+
+    Return:
+        A description of the run, as from run_transfer, with the statistics
+        reported by the receiver under "receiver" as well.
+    """
+    import hw5  # Imported here, since the rest of this module only runs scripts
+
+    replayer = utils.wire.TraceReplayer(replay_trace) if replay_trace else None
+    loop = asyncio.new_event_loop()
+    wire_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: utils.wire.CrummyWireProtocol(loop, loss, delay, buffer,
+                                              impairments or utils.wire.Impairments(),
+                                              replayer=replayer),
+        local_addr=('127.0.0.1', 0)))
+    port = transport.get_extra_info('sockname')[1]
+    wire_thread.start()
+
+    receiving_sock = utils.wire.bad_socket(port)
+    sending_sock = None
+    dest = io.BytesIO()
+    recv_stats = utils.stats.TransferStats()
+    send_stats = utils.stats.TransferStats()
+    receiving_thread = threading.Thread(
+        target=hw5.recv, args=(receiving_sock, dest),
+        kwargs=dict(recv_kwargs or {}, stats=recv_stats), daemon=True)
+    sending_thread = None
+    try:
+        receiving_thread.start()
+        # The receiver's socket sent the wire its connect datagram when it
+        # was created, ahead of anything the sender sends, so the wire
+        # already knows where to forward the sender's first packets.
+        sending_sock = utils.wire.bad_socket(port)
+        sending_thread = threading.Thread(
+            target=hw5.send, args=(sending_sock, src_path),
+            kwargs=dict(send_kwargs or {}, stats=send_stats), daemon=True)
+        start_time = time.time()
+        sending_thread.start()
+        sending_thread.join(timeout)
+        completed = not sending_thread.is_alive() and send_stats.end_time is not None
+        completion_time = time.time() - start_time
+        receiving_thread.join(30)
+
+        sent_len, sent_hash = utils.utils.file_summary(src_path)
+        received = dest.getvalue()
+        return {
+            "success": (completed and len(received) == sent_len and
+                        hashlib.sha256(received).hexdigest() == sent_hash),
+            "completion_time": completion_time,
+            "throughput": len(received) / completion_time / 1000,
+            "sender": send_stats.to_dict() if completed else None,
+            "receiver": recv_stats.to_dict() if not receiving_thread.is_alive() else None,
+        }
+    finally:
+        for a_sock in (receiving_sock, sending_sock):
+            if a_sock is not None:
+                a_sock.close()
+        loop.call_soon_threadsafe(loop.stop)
+        wire_thread.join(5)
+        transport.close()
+        loop.close()
+
+
+def check_async_cancel(wait: float = 1.0, tick: float = 0.1) -> typing.Dict[str, float]:
+    """Starts hw5.send_async towards a peer that never answers, cancels it
+    while it waits on the handshake, and measures how long the cancellation
+    and the event loop were held up by the blocked transfer.
+
+    Args:
+        wait -- The number of seconds to let the transfer wait before
+                cancelling it, and to keep the loop running after.
+        tick -- The number of seconds between ticks of a task run alongside
+                the transfer, to show the loop is still responsive.
+
+    Return:
+        The seconds cancelling took to return, under "cancel_time", and the
+        longest gap between ticks, in seconds, under "longest_tick_gap".
+    """
+    import hw5  # Imported here, since the rest of this module only runs scripts
+
+    peer_sock = socket.socket(type=socket.SOCK_DGRAM)
+    peer_sock.bind(('127.0.0.1', 0))
+    sending_sock = socket.socket(type=socket.SOCK_DGRAM)
+    sending_sock.connect(peer_sock.getsockname())
+
+    async def check() -> typing.Dict[str, float]:
+        loop = asyncio.get_running_loop()
+        ticks = [loop.time()]
+
+        async def ticker():
+            while True:
+                await asyncio.sleep(tick)
+                ticks.append(loop.time())
+
+        ticking = loop.create_task(ticker())
+        transfer = loop.create_task(hw5.send_async(sending_sock, bytes(100000)))
+        await asyncio.sleep(wait)
+        cancel_start = loop.time()
+        transfer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await transfer
+        cancel_time = loop.time() - cancel_start
+        await asyncio.sleep(wait)
+        ticking.cancel()
+        ticks.append(loop.time())
+        return {
+            "cancel_time": cancel_time,
+            "longest_tick_gap": max(b - a for a, b in zip(ticks, ticks[1:])),
+        }
+
+    try:
+        return asyncio.run(check())
+    finally:
+        sending_sock.close()
+        peer_sock.close()
@@ -1,18 +1,115 @@
 """
-Code for getting and configuring a logger for hw5.
+Code for getting and configuring a logger for hw5, and a low overhead binary
+tracer for recording per-packet events.
 """
 
 import logging
+import struct
 import sys
+import time
+import typing
 
 
 def get_logger(log_name: str) -> logging.Logger:
     """Returns a logging instance, configured so that all non-filtered messages
-    are sent to STDOUT.
+    are sent to STDOUT.  Calling this more than once for the same name returns
+    the same, already configured, logger.
     """
     logger = logging.getLogger(log_name)
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter('%(asctime)s - %(name)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    if not getattr(logger, '_hw5_configured', False):
+        handler = logging.StreamHandler(sys.stdout)
+        formatter = logging.Formatter('%(asctime)s - %(name)s: %(message)s')
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        logger._hw5_configured = True
     return logger
+
+
+# Events recorded by the Tracer.
+SEND = 0
+RETRANSMIT = 1
+ACK = 2
+FAST_RETRANSMIT = 3
+TIMEOUT = 4
+RECEIVE = 5
+DUPLICATE = 6
+CORRUPT = 7
+PARITY = 8
+RECOVER = 9
+
+EVENT_NAMES = {
+    SEND: "send",
+    RETRANSMIT: "retransmit",
+    ACK: "ack",
+    FAST_RETRANSMIT: "fast_retransmit",
+    TIMEOUT: "timeout",
+    RECEIVE: "receive",
+    DUPLICATE: "duplicate",
+    CORRUPT: "corrupt",
+    PARITY: "parity",
+    RECOVER: "recover",
+}
+
+
+class TraceEvent(typing.NamedTuple):
+    time: float
+    event: int
+    seq_num: int
+    value: int
+
+    @property
+    def name(self) -> str:
+        return EVENT_NAMES.get(self.event, str(self.event))
+
+
+class Tracer:
+    """A fixed size ring buffer of binary event records, cheap enough to
+    record every packet into, that keeps the most recent events once full.
+
+    Each record is the time, an event code (one of the constants above), a
+    sequence number, and an event specific value.
+
+    Args:
+        capacity -- The number of records to keep.
+    """
+
+    RECORD = struct.Struct('<dBII')
+
+    def __init__(self, capacity: int = 65536):
+        self._capacity = capacity
+        self._buffer = bytearray(capacity * self.RECORD.size)
+        self._count = 0
+
+    def record(self, event: int, seq_num: int, value: int = 0):
+        """Records an event, overwriting the oldest one if the buffer is full."""
+        offset = (self._count % self._capacity) * self.RECORD.size
+        self.RECORD.pack_into(self._buffer, offset, time.time(), event,
+                              seq_num & 0xFFFFFFFF, value & 0xFFFFFFFF)
+        self._count += 1
+
+    def __len__(self) -> int:
+        return min(self._count, self._capacity)
+
+    def to_bytes(self) -> bytes:
+        """Returns the records held, oldest first."""
+        if self._count <= self._capacity:
+            return bytes(self._buffer[:self._count * self.RECORD.size])
+        split = (self._count % self._capacity) * self.RECORD.size
+        return bytes(self._buffer[split:] + self._buffer[:split])
+
+    def events(self) -> typing.List[TraceEvent]:
+        """Returns the records held, oldest first, decoded."""
+        return [TraceEvent(*a_record)
+                for a_record in self.RECORD.iter_unpack(self.to_bytes())]
+
+    def dump(self, path: str):
+        """Writes the records held, oldest first, to the given path."""
+        with open(path, 'wb') as handle:
+            handle.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str) -> typing.List[TraceEvent]:
+        """Reads and decodes the records written by dump."""
+        with open(path, 'rb') as handle:
+            return [TraceEvent(*a_record)
+                    for a_record in cls.RECORD.iter_unpack(handle.read())]
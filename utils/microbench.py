@@ -0,0 +1,218 @@
+"""
+Microbenchmarks of the protocol's hot paths, each run in isolation on fixed,
+seeded data, so that changes to them can be measured in seconds and
+compared against stored results.
+
+Each benchmark is a function that does its setup, and returns a function
+doing one round of the work, along with the number of items (packets, ACKs
+or bytes) each round handles.
+"""
+
+import io
+import random
+import tempfile
+import timeit
+import typing
+
+import hw5
+import utils
+import utils.fec
+import utils.harness
+import utils.packet
+import utils.stream
+import utils.wire
+
+# The number of packets most benchmarks handle per round.
+PACKETS = 256
+
+# The packets after the cumulative ACK point the ACK benchmarks' receiver
+# holds: every other one of the next 64.
+HELD = set(range(1, 65, 2))
+
+Benchmark = typing.Callable[[], typing.Tuple[typing.Callable[[], None], int]]
+
+BENCHMARKS: typing.Dict[str, Benchmark] = {}
+
+
+def benchmark(name: str):
+    """Registers the decorated function as the benchmark with the given name."""
+    def register(function: Benchmark) -> Benchmark:
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def _random_bytes(size: int, seed: int = 0) -> bytes:
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def _data_packets(checksum: utils.packet.Checksum) -> typing.List[bytes]:
+    data = _random_bytes(PACKETS * hw5.CHUNK_SIZE)
+    packets = []
+    for seq_num in range(PACKETS):
+        chunk = data[seq_num * hw5.CHUNK_SIZE:(seq_num + 1) * hw5.CHUNK_SIZE]
+        packets.append(utils.packet.build(utils.packet.DATA, seq_num, chunk, checksum))
+    return packets
+
+
+class _NullSink:
+    """A destination that discards what is written, and cannot seek."""
+
+    def seekable(self) -> bool:
+        return False
+
+    def write(self, data) -> int:
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+@benchmark("packetize")
+def packetize():
+    """Reading chunks of data into packet buffers, and building their headers."""
+    data = _random_bytes(PACKETS * hw5.CHUNK_SIZE)
+    buffer = bytearray(utils.MAX_PACKET)
+    checksum = utils.packet.DEFAULT_CHECKSUM
+
+    def run():
+        reader = io.BytesIO(data)
+        for seq_num in range(PACKETS):
+            hw5.read_packet(reader, buffer, seq_num, checksum)
+    return run, PACKETS
+
+
+def _verify(name: str):
+    def setup():
+        packets = _data_packets(utils.packet.CHECKSUMS[name])
+
+        def run():
+            for packet in packets:
+                utils.packet.unpack_from(packet, len(packet))
+        return run, PACKETS
+    return setup
+
+
+for _name in utils.packet.CHECKSUMS:
+    benchmark("verify." + _name)(_verify(_name))
+
+
+@benchmark("ack.make")
+def ack_make():
+    """Building SACK ACKs, with every other packet after the cumulative point held."""
+    checksum = utils.packet.DEFAULT_CHECKSUM
+
+    def run():
+        for expected_seq in range(PACKETS):
+            hw5.make_ack(expected_seq % 2, HELD, checksum)
+    return run, PACKETS
+
+
+@benchmark("ack.parse")
+def ack_parse():
+    """Verifying and unpacking SACK ACKs."""
+    checksum = utils.packet.DEFAULT_CHECKSUM
+    acks = [hw5.make_ack(expected_seq % 2, HELD, checksum) for expected_seq in range(PACKETS)]
+
+    def run():
+        for ack in acks:
+            hw5.parse_ack(utils.packet.unpack_from(ack, len(ack)), ack)
+    return run, PACKETS
+
+
+def _reassemble(order: typing.List[int]):
+    def setup():
+        pool = utils.stream.BufferPool(utils.MAX_PACKET)
+        packets = _data_packets(utils.packet.DEFAULT_CHECKSUM)
+
+        def run():
+            writer = utils.stream.ChunkWriter(_NullSink(), hw5.CHUNK_SIZE, pool)
+            for seq_num in order:
+                buffer = pool.get()
+                buffer[:len(packets[seq_num])] = packets[seq_num]
+                writer.write(seq_num, buffer, utils.packet.HEADER.size, len(packets[seq_num]))
+            writer.close()
+        return run, PACKETS
+    return setup
+
+
+benchmark("reassemble.in_order")(_reassemble(list(range(PACKETS))))
+# Every pair of packets swapped, as a little reordering on the wire would.
+benchmark("reassemble.reordered")(_reassemble(
+    [seq_num ^ 1 for seq_num in range(PACKETS)]))
+
+
+def _fec_encode(parity_count: int):
+    def setup():
+        encoder = utils.fec.Encoder(8, parity_count, hw5.FEC_CHUNK_SIZE)
+        chunks = [_random_bytes(hw5.FEC_CHUNK_SIZE, seed) for seed in range(8)]
+
+        def run():
+            for _ in range(PACKETS // 8):
+                for chunk in chunks:
+                    encoder.add(chunk)
+        return run, PACKETS
+    return setup
+
+
+benchmark("fec.xor")(_fec_encode(1))
+benchmark("fec.rs2")(_fec_encode(2))
+
+
+@benchmark("loopback")
+def loopback():
+    """A whole transfer of 1 MB through an in-process wire, without loss."""
+    # The file is deleted once the benchmark is done with it, and drops it.
+    source = tempfile.NamedTemporaryFile()
+    source.write(_random_bytes(1000000))
+    source.flush()
+
+    def run():
+        result = utils.harness.run_in_process(source.name, 0.0, 0.0, 1000,
+                                              utils.wire.Impairments(seed=0))
+        if not result["success"]:
+            raise RuntimeError("The loopback transfer failed.")
+    return run, 1000000
+
+
+def run_benchmark(name: str, repeat: int = 5,
+                  min_time: float = 0.2) -> typing.Dict[str, float]:
+    """Runs a benchmark, enough rounds at a time to take at least min_time
+    seconds, and takes the best of repeat such measurements, which is the
+    one least disturbed by everything else on the machine.
+
+    Return:
+        The best time per item, in nanoseconds, and the items per second it
+        amounts to.
+    """
+    run, items = BENCHMARKS[name]()
+    timer = timeit.Timer(run)
+    rounds = 1
+    while timer.timeit(rounds) < min_time and rounds < 1 << 20:
+        rounds *= 2
+    best = min(timer.repeat(repeat, rounds)) / rounds / items
+    return {"ns_per_item": best * 1e9, "items_per_second": 1 / best}
+
+
+def compare(results: typing.Dict[str, typing.Dict[str, float]],
+            baseline: typing.Dict[str, typing.Dict[str, float]],
+            tolerance: float) -> typing.List[typing.Tuple[str, float, bool]]:
+    """Compares results against stored ones.
+
+    Args:
+        results -- The results of this run, by benchmark name.
+        baseline -- Earlier results, by benchmark name.
+        tolerance -- How much slower, as a fraction, a benchmark may get
+                     before it counts as a regression.
+
+    Return:
+        For each benchmark in both, its name, the ratio of its time now to
+        its time before, and whether that is a regression.
+    """
+    comparisons = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["ns_per_item"] / baseline[name]["ns_per_item"]
+        comparisons.append((name, ratio, ratio > 1 + tolerance))
+    return comparisons
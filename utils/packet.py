@@ -0,0 +1,267 @@
+"""
+The wire format of packets exchanged by the sender and receiver, and the
+checksum algorithms used to detect packets corrupted in transit.
+"""
+
+import struct
+import typing
+import zlib
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+# Version of the wire format; packets with any other version are dropped.
+VERSION = 9
+
+# Packet types.
+DATA = 0
+ACK = 1
+FIN = 2
+SYN = 3
+SYN_ACK = 4
+FIN_ACK = 5
+PARITY = 6
+RESUME_REQUEST = 7
+RESUME = 8
+SIGNATURE_REQUEST = 9
+SIGNATURES = 10
+
+# Optional protocol features, offered by the sender in its SYN as a bitmask,
+# of which the receiver accepts the ones it supports.
+FEATURE_SACK = 1 << 0
+FEATURE_FEC = 1 << 1
+FEATURE_RESUME = 1 << 2
+FEATURE_DELTA = 1 << 3
+SUPPORTED_FEATURES = FEATURE_SACK | FEATURE_FEC | FEATURE_RESUME | FEATURE_DELTA
+
+# Every packet starts with a fixed size header: the format version, packet
+# type, flags, checksum algorithm, connection ID, sequence number and payload
+# length, followed by the checksum itself.  The connection ID is chosen by
+# the sender, and echoed by the receiver, so that packets of many
+# connections can share one socket.  The checksum is computed over the rest of
+# the header and the payload, so it is placed last to let both be fed to the
+# checksum function straight from the packet buffer.
+HEADER = struct.Struct('!BBBBIIHI')
+CHECKSUM_OFFSET = HEADER.size - 4
+CHECKSUM_FIELD = struct.Struct('!I')
+CONN_ID_OFFSET = 4
+CONN_ID_FIELD = struct.Struct('!I')
+
+# Payload of SYN and SYN_ACK packets: the connection parameters proposed by
+# the sender, and then those accepted by the receiver.
+PARAMS = struct.Struct('!HHBIBBBIQ')
+
+# Payload of FIN packets: the sender's retransmission timeout, in
+# milliseconds, which tells the receiver how long to linger after the
+# connection closes in case its FIN_ACK is lost, and the SHA-256 digest of
+# all the data sent, for the receiver to check what it wrote against.
+FIN_PAYLOAD = struct.Struct('!I32s')
+
+# Flags of FIN_ACK packets.  FLAG_DIGEST_MISMATCH is set if the data the
+# receiver wrote does not match the digest in the FIN.
+FLAG_DIGEST_MISMATCH = 1 << 0
+
+# Some replies from the receiver are too large for one packet, so are split
+# into pages.  RESUME_REQUEST and SIGNATURE_REQUEST packets ask for the page
+# of the receiver's resume state or file signatures their sequence number
+# gives, and RESUME and SIGNATURES packets answer with that page.  Every page
+# starts with the number of pages, followed by a header repeated on every
+# page, and the page's share of the reply's fixed size entries.
+PAGE = struct.Struct('!I')
+
+# PARITY packets carry forward error correction data for the block of data
+# packets their sequence number identifies; their payload is described in
+# utils.fec.
+
+
+class Header(typing.NamedTuple):
+    version: int
+    ptype: int
+    flags: int
+    checksum_id: int
+    conn_id: int
+    seq_num: int
+    length: int
+    checksum: int
+
+
+class Params(typing.NamedTuple):
+    """The parameters of a connection, negotiated during the handshake.
+
+    Args:
+        chunk_size -- The number of bytes of data in each full data packet.
+        initial_window -- The number of packets the sender may have in
+                          flight before receiving any ACKs.
+        checksum_id -- The checksum algorithm protecting data packets, ACKs
+                       and the FIN.
+        features -- A bitmask of the FEATURE_* flags in use.
+        fec_block -- With FEATURE_FEC, the number of data packets in each
+                     block protected by parity packets.
+        fec_parity -- With FEATURE_FEC, the number of parity packets sent
+                      for each block.
+        compression -- The algorithm the data is compressed with, one of the
+                       idents in utils.compress.CODECS, or 0 if it is not.
+        resume_id -- With FEATURE_RESUME, the sender's identifier for the
+                     data, from utils.resume.source_id.
+        offset -- The position in the destination file to write the data
+                  at, for a connection carrying one range of a file sent
+                  over several connections in parallel.
+    """
+    chunk_size: int
+    initial_window: int
+    checksum_id: int
+    features: int
+    fec_block: int = 0
+    fec_parity: int = 0
+    compression: int = 0
+    resume_id: int = 0
+    offset: int = 0
+
+    def pack(self) -> bytes:
+        return PARAMS.pack(*self)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset: int = HEADER.size) -> 'Params':
+        return cls(*PARAMS.unpack_from(buffer, offset))
+
+
+class Checksum(typing.NamedTuple):
+    """A checksum algorithm.
+
+    Args:
+        ident -- The number identifying the algorithm in packet headers.
+        name -- The name used to select the algorithm.
+        compute -- A function taking a bytes-like object and the running
+                   value of the checksum, and returning the updated value.
+        initial -- The value the checksum starts from.
+    """
+    ident: int
+    name: str
+    compute: typing.Callable[[typing.Any, int], int]
+    initial: int = 0
+
+
+def _byte_sum(data, value: int) -> int:
+    return (value + sum(data)) & 0xFFFFFFFF
+
+
+CHECKSUMS: typing.Dict[str, Checksum] = {
+    "sum": Checksum(0, "sum", _byte_sum),
+    "crc32": Checksum(1, "crc32", zlib.crc32),
+    "adler32": Checksum(2, "adler32", zlib.adler32, 1),
+}
+if crc32c is not None:
+    CHECKSUMS["crc32c"] = Checksum(3, "crc32c", crc32c.crc32c)
+
+CHECKSUMS_BY_ID: typing.Dict[int, Checksum] = {
+    a_checksum.ident: a_checksum for a_checksum in CHECKSUMS.values()
+}
+
+# The algorithm every implementation supports.  It protects the handshake,
+# since the algorithm used for the rest of the connection is not yet agreed,
+# and is what the receiver falls back to if it lacks the one proposed.
+DEFAULT_CHECKSUM = CHECKSUMS["crc32"]
+
+
+def get_checksum(name: str) -> Checksum:
+    """Returns the checksum algorithm with the given name, one of the keys of
+    CHECKSUMS.
+    """
+    if name not in CHECKSUMS:
+        raise ValueError(f"Unknown or unavailable checksum algorithm: {name}")
+    return CHECKSUMS[name]
+
+
+def pack_into(buffer: bytearray, ptype: int, seq_num: int, length: int,
+              checksum: Checksum, flags: int = 0, conn_id: int = 0) -> int:
+    """Fills in the header of a packet whose payload has already been
+    written into the buffer, right after where the header goes.
+
+    Args:
+        buffer -- The buffer holding the packet.
+        ptype -- The type of the packet, for example DATA.
+        seq_num -- The sequence number of the packet.
+        length -- The length of the payload.
+        checksum -- The checksum algorithm to protect the packet with.
+        flags -- Type specific flags.
+        conn_id -- The ID of the connection the packet belongs to.
+
+    Return:
+        The total length of the packet.
+    """
+    HEADER.pack_into(buffer, 0, VERSION, ptype, flags, checksum.ident,
+                     conn_id, seq_num, length, 0)
+    end = HEADER.size + length
+    with memoryview(buffer) as view:
+        value = checksum.compute(view[:CHECKSUM_OFFSET], checksum.initial)
+        value = checksum.compute(view[HEADER.size:end], value)
+    CHECKSUM_FIELD.pack_into(buffer, CHECKSUM_OFFSET, value)
+    return end
+
+
+def build(ptype: int, seq_num: int, payload: bytes, checksum: Checksum,
+          flags: int = 0, conn_id: int = 0) -> bytes:
+    """Returns a complete packet, with the given payload."""
+    buffer = bytearray(HEADER.size + len(payload))
+    buffer[HEADER.size:] = payload
+    pack_into(buffer, ptype, seq_num, len(payload), checksum, flags, conn_id)
+    return bytes(buffer)
+
+
+def paginate(header: bytes, entries: typing.List[bytes],
+             page_size: int) -> typing.List[bytes]:
+    """Splits a reply into the payloads of as many pages as it takes.
+
+    Args:
+        header -- The part of the reply repeated on every page.
+        entries -- The rest of the reply, as equally sized entries.
+        page_size -- The largest payload a packet can carry.
+
+    Return:
+        The payloads, at least one, in page order.
+    """
+    groups = [[]]
+    if entries:
+        per_page = (page_size - PAGE.size - len(header)) // len(entries[0])
+        groups = [entries[start:start + per_page]
+                  for start in range(0, len(entries), per_page)]
+    return [PAGE.pack(len(groups)) + header + b''.join(group) for group in groups]
+
+
+def unpack_from(buffer, length: int) -> typing.Optional[Header]:
+    """Parses and verifies the header of a received packet.
+
+    Args:
+        buffer -- The buffer holding the packet.
+        length -- The number of bytes received into the buffer.
+
+    Return:
+        The packet's header, or None if the packet is truncated, of an
+        unknown version, or fails its checksum, and so should be dropped.
+    """
+    if length < HEADER.size:
+        return None
+    header = Header(*HEADER.unpack_from(buffer))
+    if header.version != VERSION or HEADER.size + header.length != length:
+        return None
+    checksum = CHECKSUMS_BY_ID.get(header.checksum_id)
+    if checksum is None:
+        return None
+    with memoryview(buffer) as view:
+        value = checksum.compute(view[:CHECKSUM_OFFSET], checksum.initial)
+        value = checksum.compute(view[HEADER.size:length], value)
+    if value != header.checksum:
+        return None
+    return header
+
+
+def peek_conn_id(packet) -> typing.Optional[int]:
+    """Returns the connection ID of a received packet without verifying the
+    packet, so it can be handed to its connection, which verifies it, or
+    None if the packet is too short to have one.
+    """
+    if len(packet) < HEADER.size:
+        return None
+    return CONN_ID_FIELD.unpack_from(packet, CONN_ID_OFFSET)[0]
@@ -0,0 +1,168 @@
+"""
+Profiling the processes of a transfer, the wire, receiver and sender, with
+cProfile, and reporting where each of them spent its time.
+
+Run as a module, it runs a script under cProfile as "python -m cProfile"
+does, but timing functions by the CPU time of the thread running them
+rather than by the wall clock, so that time spent blocked waiting for
+packets does not bury the functions doing the work:
+
+    python -m utils.profiling -o PROFILE_PATH SCRIPT [ARGS...]
+"""
+
+import argparse
+import cProfile
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import typing
+
+
+class ProcessProfile(typing.NamedTuple):
+    """What was measured of one profiled process.
+
+    Args:
+        name -- The name of the process, such as "sender".
+        path -- The path cProfile wrote the process's profile to.
+        cpu_time -- The user and system CPU seconds the process used.
+        packets -- The number of packets the process handled.
+        duration -- The number of seconds over which it handled them.
+    """
+    name: str
+    path: str
+    cpu_time: float
+    packets: int
+    duration: float
+
+
+def profiled(args: typing.List[str], path: str) -> typing.List[str]:
+    """Returns the command line running the given Python script command line
+    under cProfile, writing the profile to the given path once the script
+    exits.
+    """
+    return [args[0], "-m", "utils.profiling", "-o", path] + args[1:]
+
+
+def run(path: str, script: str, args: typing.List[str]):
+    """Runs a script as the main module, under cProfile, and writes the
+    profile to the given path when the script exits, however it exits.
+    Threads the script starts, such as those of parallel flows or of the
+    compression pool, are profiled too, each timed by its own CPU time, and
+    their profiles merged into the one written.
+    """
+    sys.argv = [script] + args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    with open(script, 'rb') as handle:
+        code = compile(handle.read(), script, 'exec')
+    globs = {"__file__": script, "__name__": "__main__",
+             "__package__": None, "__cached__": None}
+    profiler = cProfile.Profile(time.thread_time)
+    thread_profilers = []
+
+    def profile_thread(*_):
+        # Called once, as each new thread starts, to give it a profiler of
+        # its own in place of this hook.
+        sys.setprofile(None)
+        thread_profiler = cProfile.Profile(time.thread_time)
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            return  # From Python 3.12, the first profiler sees every thread
+        thread_profilers.append(thread_profiler)
+
+    threading.setprofile(profile_thread)
+    try:
+        profiler.runctx(code, globs, None)
+    finally:
+        threading.setprofile(None)
+        stats = pstats.Stats(profiler)
+        for a_profiler in list(thread_profilers):
+            stats.add(a_profiler)
+        stats.dump_stats(path)
+
+
+def children_cpu_time() -> float:
+    """Returns the CPU seconds used by every child process reaped so far, so
+    the time of a single child is the difference across reaping it.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def load(path: str) -> typing.Optional[pstats.Stats]:
+    """Reads a profile, or returns None if the process never wrote it."""
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return None
+    return pstats.Stats(path)
+
+
+def call_count(stats: pstats.Stats, function_name: str) -> int:
+    """Returns how many times functions with the given name were called."""
+    return sum(a_value[1] for a_key, a_value in stats.stats.items()
+               if a_key[2] == function_name)
+
+
+def hot_functions(profiles: typing.Dict[str, pstats.Stats],
+                  top: int) -> typing.List[typing.Tuple[str, str, int, float, float]]:
+    """Merges the profiles of several processes into one list of the
+    functions that took the most time themselves, across all of them.
+
+    Args:
+        profiles -- The profile of each process, by its name.
+        top -- The number of functions to list.
+
+    Return:
+        For each function, the process it ran in, its location, its number
+        of calls, the seconds spent in it alone, and the seconds spent in it
+        and the functions it called.
+    """
+    rows = []
+    for name, stats in profiles.items():
+        for (filename, line, function), (_, calls, own_time, total_time, _) \
+                in stats.stats.items():
+            location = "{}:{}({})".format(os.path.basename(filename), line, function)
+            rows.append((name, location, calls, own_time, total_time))
+    rows.sort(key=lambda a_row: a_row[3], reverse=True)
+    return rows[:top]
+
+
+def format_report(processes: typing.List[ProcessProfile], top: int = 20) -> str:
+    """Formats a report of each process's CPU time and packet rate, and the
+    functions they spent the most time in.
+    """
+    lines = ["{:<10} {:>10} {:>10} {:>12} {:>14}".format(
+        "process", "cpu (s)", "wall (s)", "packets", "packets/s")]
+    for a_process in processes:
+        rate = a_process.packets / a_process.duration if a_process.duration else 0.0
+        lines.append("{:<10} {:>10.2f} {:>10.2f} {:>12} {:>14.0f}".format(
+            a_process.name, a_process.cpu_time, a_process.duration,
+            a_process.packets, rate))
+
+    profiles = {}
+    for a_process in processes:
+        stats = load(a_process.path)
+        if stats is None:
+            lines.append("No profile was written by the {}.".format(a_process.name))
+        else:
+            profiles[a_process.name] = stats
+    lines.append("")
+    lines.append("{:<10} {:>10} {:>10} {:>10}  {}".format(
+        "process", "calls", "own (s)", "total (s)", "function"))
+    for name, location, calls, own_time, total_time in hot_functions(profiles, top):
+        lines.append("{:<10} {:>10} {:>10.3f} {:>10.3f}  {}".format(
+            name, calls, own_time, total_time, location))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    PARSER.add_argument('-o', '--output', required=True,
+                        help="The path to write the profile to.")
+    PARSER.add_argument('script', help="The script to run.")
+    PARSER.add_argument('args', nargs=argparse.REMAINDER,
+                        help="The arguments to run the script with.")
+    ARGS = PARSER.parse_args()
+    run(ARGS.output, ARGS.script, ARGS.args)
@@ -0,0 +1,129 @@
+"""
+Support for resuming interrupted transfers: the journal the receiver keeps
+next to a partially received file, recording which chunks of it have been
+written, and the packets that tell a restarted sender which chunks it can
+skip.
+"""
+
+import os
+import struct
+import typing
+import zlib
+
+import utils.packet
+
+# The journal for an output file is kept alongside it, with this suffix.
+JOURNAL_SUFFIX = ".resume"
+
+# How many data packets the receiver takes between updates of its journal.
+JOURNAL_PACKETS = 256
+
+# Payload of RESUME pages: the receiver's cumulative point (every chunk
+# before it has been received), and then the sequence numbers of the chunks
+# after it that the receiver holds.
+RESUME_HEADER = struct.Struct('!I')
+SEQ = struct.Struct('!I')
+
+# The journal file: the sender's identifier for the data, the chunk size, the
+# cumulative point and the number of held chunks, followed by the held
+# chunks' sequence numbers.
+JOURNAL = struct.Struct('!IHII')
+
+
+class Journal(typing.NamedTuple):
+    """What a receiver has written of a transfer.
+
+    Args:
+        resume_id -- The sender's identifier for the data being sent.
+        chunk_size -- The number of bytes of data in each chunk.
+        expected_seq -- The first chunk not received; every chunk before it
+                        has been.
+        held -- The sequence numbers of chunks after expected_seq that have
+                been received.
+    """
+    resume_id: int
+    chunk_size: int
+    expected_seq: int
+    held: typing.List[int]
+
+    def save(self, path: str):
+        """Writes the journal to the given path, replacing any journal there
+        in one step, so a crash never leaves half a journal.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as handle:
+            handle.write(JOURNAL.pack(self.resume_id, self.chunk_size,
+                                      self.expected_seq, len(self.held)))
+            handle.write(b''.join(SEQ.pack(seq_num) for seq_num in self.held))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> typing.Optional['Journal']:
+        """Reads the journal at the given path.
+
+        Return:
+            The journal, or None if there is none, or it cannot be read.
+        """
+        try:
+            with open(path, 'rb') as handle:
+                data = handle.read()
+        except OSError:
+            return None
+        if len(data) < JOURNAL.size:
+            return None
+        resume_id, chunk_size, expected_seq, count = JOURNAL.unpack_from(data)
+        if len(data) != JOURNAL.size + count * SEQ.size:
+            return None
+        held = [seq_num for seq_num, in SEQ.iter_unpack(data[JOURNAL.size:])]
+        return cls(resume_id, chunk_size, expected_seq, held)
+
+
+def source_id(source) -> int:
+    """Returns an identifier for the data in the given source, which is the
+    same every time the same data is sent, so the receiver can tell whether
+    its journal is for the same data.
+
+    Args:
+        source -- The data being sent, as given to hw5.send.
+
+    Return:
+        The identifier, or 0 if the source is a stream whose data cannot be
+        identified before it has been read, and so cannot be resumed.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return zlib.crc32(source) or 1
+    if isinstance(source, (str, os.PathLike)):
+        info = os.stat(source)
+        description = "{}:{}:{}".format(os.path.abspath(source), info.st_size,
+                                        info.st_mtime_ns)
+        return zlib.crc32(description.encode()) or 1
+    return 0
+
+
+def resume_pages(expected_seq: int, held: typing.Sequence[int],
+                 page_size: int) -> typing.List[bytes]:
+    """Splits the receiver's state into the payloads of RESUME packets.
+
+    Args:
+        expected_seq -- The first chunk not received.
+        held -- The sequence numbers of received chunks after expected_seq.
+        page_size -- The largest payload a packet can carry.
+    """
+    return utils.packet.paginate(RESUME_HEADER.pack(expected_seq),
+                                 [SEQ.pack(seq_num) for seq_num in sorted(held)],
+                                 page_size)
+
+
+def parse_resume(pages: typing.List[bytes]) -> typing.Tuple[int, typing.Set[int]]:
+    """Unpacks the pages built by resume_pages.
+
+    Return:
+        Two values, first the receiver's cumulative point, and second the
+        set of chunks after it that the receiver holds.
+    """
+    expected_seq = 0
+    held = set()
+    for page in pages:
+        expected_seq, = RESUME_HEADER.unpack_from(page)
+        held.update(seq_num for seq_num, in SEQ.iter_unpack(page[RESUME_HEADER.size:]))
+    return expected_seq, held
@@ -0,0 +1,117 @@
+"""
+Statistics describing a transfer, collected by the sender and receiver as
+they run, so they can be inspected, aggregated or saved as JSON afterwards.
+"""
+
+import json
+import time
+import typing
+
+
+class TransferStats:
+    """Counters, summaries of sampled values, and optionally the full time
+    series of those samples, for one side of one transfer.
+
+    Args:
+        record_series -- Whether to keep every sample with the time it was
+                         taken, instead of only a summary of them.
+    """
+
+    def __init__(self, record_series: bool = False):
+        self.record_series = record_series
+        self.start_time = time.time()
+        self.end_time = None
+        self.counters: typing.Dict[str, int] = {}
+        self.summaries: typing.Dict[str, typing.Dict[str, float]] = {}
+        self.series: typing.Dict[str, typing.List[typing.Tuple[float, float]]] = {}
+        self.notes: typing.Dict[str, typing.Any] = {}
+
+    def count(self, name: str, amount: int = 1):
+        """Adds to the named counter."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def sample(self, name: str, value: float):
+        """Records a sample of a value that changes over the transfer, such as
+        the RTT or the congestion window.
+        """
+        summary = self.summaries.get(name)
+        if summary is None:
+            self.summaries[name] = dict(count=1, min=value, max=value,
+                                        total=value, last=value)
+        else:
+            summary["count"] += 1
+            summary["total"] += value
+            summary["last"] = value
+            if value < summary["min"]:
+                summary["min"] = value
+            if value > summary["max"]:
+                summary["max"] = value
+        if self.record_series:
+            self.series.setdefault(name, []).append(
+                (time.time() - self.start_time, value))
+
+    def note(self, name: str, value: typing.Any):
+        """Records a fact about the transfer that is not a number to count or
+        sample, such as the digest of the data.
+        """
+        self.notes[name] = value
+
+    def merge(self, other: 'TransferStats'):
+        """Adds the counters, samples and time series of another transfer,
+        such as one of several run in parallel, into these statistics.
+        Notes are left for the caller to combine.
+        """
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+        for name, theirs in other.summaries.items():
+            summary = self.summaries.get(name)
+            if summary is None:
+                self.summaries[name] = dict(theirs)
+                continue
+            summary["count"] += theirs["count"]
+            summary["total"] += theirs["total"]
+            summary["last"] = theirs["last"]
+            summary["min"] = min(summary["min"], theirs["min"])
+            summary["max"] = max(summary["max"], theirs["max"])
+        if self.record_series:
+            shift = other.start_time - self.start_time
+            for name, points in other.series.items():
+                series = self.series.setdefault(name, [])
+                series.extend((when + shift, value) for when, value in points)
+                series.sort()
+        if other.end_time is not None:
+            self.end_time = max(self.end_time or other.end_time, other.end_time)
+
+    def finish(self):
+        """Marks the end of the transfer."""
+        self.end_time = time.time()
+
+    @property
+    def duration(self) -> float:
+        """The number of seconds the transfer took, or has taken so far."""
+        return (self.end_time or time.time()) - self.start_time
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """Returns the statistics as a dictionary of plain values, suitable
+        for serializing as JSON.
+        """
+        summaries = {}
+        for name, summary in self.summaries.items():
+            summaries[name] = dict(count=summary["count"], min=summary["min"],
+                                   max=summary["max"], last=summary["last"],
+                                   mean=summary["total"] / summary["count"])
+        result = {
+            "duration": self.duration,
+            "counters": dict(self.counters),
+            "summaries": summaries,
+            "notes": dict(self.notes),
+        }
+        if self.record_series:
+            result["series"] = {name: [list(a_point) for a_point in points]
+                                for name, points in self.series.items()}
+        return result
+
+    def dump(self, path: str):
+        """Writes the statistics to the given path as JSON."""
+        with open(path, 'w') as handle:
+            json.dump(self.to_dict(), handle)
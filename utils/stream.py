@@ -0,0 +1,391 @@
+"""
+Helpers for reading the data to send, and writing the data received, as
+streams, so that it never has to be held in memory all at once.
+"""
+
+import contextlib
+import io
+import os
+import typing
+
+# How many bytes of received data are collected before they are written out.
+WRITE_BATCH_SIZE = 256 * 1024
+
+Source = typing.Union[bytes, bytearray, memoryview, str, os.PathLike,
+                      typing.BinaryIO, typing.Iterable[bytes]]
+
+
+class IterReader(io.RawIOBase):
+    """Adapts an iterable of bytes objects, of any sizes, to a readable file
+    object, so it can be read from with readinto.
+
+    Args:
+        chunks -- The iterable of bytes objects to read from.
+    """
+
+    def __init__(self, chunks: typing.Iterable[bytes]):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            try:
+                self._pending = memoryview(next(self._chunks)).cast('B')
+            except StopIteration:
+                return 0
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+class HashingReader(io.RawIOBase):
+    """Wraps a readable file object, hashing everything read through it, so
+    the data is digested as it streams past instead of in a separate pass.
+    The underlying reader is not closed with this one.
+
+    Args:
+        reader -- The readable file object to read from.
+        hasher -- A hashlib object to update with the data read.
+    """
+
+    def __init__(self, reader: typing.BinaryIO, hasher):
+        super().__init__()
+        self._reader = reader
+        self.hasher = hasher
+        self.num_bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        with memoryview(buffer) as view:
+            count = readinto_full(self._reader, view)
+            self.hasher.update(view[:count])
+        self.num_bytes += count
+        return count
+
+
+class HashingWriter:
+    """Wraps a writable file object, hashing everything written through it.
+    It is not seekable, so a ChunkWriter in front of it writes in order.
+
+    Args:
+        dest -- The binary file object to write to.
+        hasher -- A hashlib object to update with the data written.
+    """
+
+    def __init__(self, dest: typing.BinaryIO, hasher):
+        self._dest = dest
+        self.hasher = hasher
+
+    def seekable(self) -> bool:
+        return False
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        return self._dest.write(data)
+
+    def flush(self):
+        self._dest.flush()
+
+
+class FileRange(io.RawIOBase):
+    """A readable file object over a range of a file, read with its own file
+    descriptor, so several ranges of the same file can be read at once from
+    different threads.
+
+    Args:
+        path -- The path of the file.
+        offset -- The position in the file where the range starts.
+        length -- The number of bytes in the range.
+    """
+
+    def __init__(self, path: typing.Union[str, os.PathLike], offset: int, length: int):
+        super().__init__()
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self._position = offset
+        self._end = offset + length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), self._end - self._position)
+        if count <= 0:
+            return 0
+        with memoryview(buffer) as view:
+            if hasattr(os, 'preadv'):
+                count = os.preadv(self._fd, [view[:count]], self._position)
+            else:
+                os.lseek(self._fd, self._position, os.SEEK_SET)
+                data = os.read(self._fd, count)
+                count = len(data)
+                view[:count] = data
+        self._position += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+def open_source(source: Source) -> typing.ContextManager:
+    """Returns a context manager giving a readable file object for the given
+    source of data.  Paths are opened (and closed once the context exits),
+    file objects are used as is, and in-memory bytes or iterables of bytes
+    are wrapped.
+
+    Args:
+        source -- The data to read; a bytes-like object, a path, a binary
+                  file object, or an iterable of bytes objects.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb', buffering=0)
+    if hasattr(source, 'readinto') or hasattr(source, 'read'):
+        return contextlib.nullcontext(source)
+    return IterReader(source)
+
+
+def readinto_full(reader: typing.BinaryIO, view: memoryview) -> int:
+    """Reads from the reader into the view until the view is full or the
+    reader is exhausted, since a single readinto may return short on pipes
+    and sockets.
+
+    Args:
+        reader -- A readable file object.
+        view -- A writable memoryview to fill.
+
+    Return:
+        The number of bytes read; less than the size of the view only once
+        the end of the reader has been reached.
+    """
+    filled = 0
+    while filled < len(view):
+        if hasattr(reader, 'readinto'):
+            count = reader.readinto(view[filled:])
+        else:
+            data = reader.read(len(view) - filled)
+            count = len(data)
+            view[filled:filled + count] = data
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+def skip(reader: typing.BinaryIO, count: int):
+    """Advances the reader past the next count bytes, seeking if it can, and
+    reading and discarding them otherwise.
+    """
+    if getattr(reader, 'seekable', lambda: False)():
+        reader.seek(count, io.SEEK_CUR)
+        return
+    scratch = bytearray(min(count, WRITE_BATCH_SIZE))
+    with memoryview(scratch) as view:
+        while count > 0:
+            read = readinto_full(reader, view[:min(count, len(view))])
+            if not read:
+                break
+            count -= read
+
+
+class BufferPool:
+    """A free list of equally sized bytearrays, so that buffers can be
+    reused instead of allocating new ones for every packet.
+
+    Args:
+        size -- The size, in bytes, of each buffer in the pool.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._free = []
+
+    def get(self) -> bytearray:
+        """Returns a free buffer, allocating a new one if none are free."""
+        if self._free:
+            return self._free.pop()
+        return bytearray(self._size)
+
+    def put(self, buffer: bytearray):
+        """Returns a buffer to the pool, so later calls to get can reuse it."""
+        self._free.append(buffer)
+
+
+class ChunkWriter:
+    """Writes fixed size chunks of data, which may arrive in any order, to a
+    destination file, coalescing runs of consecutive chunks into large
+    writes.
+
+    If the destination is seekable, each chunk is written directly at its
+    offset in the file (with pwrite when the destination has a file
+    descriptor), so chunks never need to be held waiting for earlier ones.
+    Otherwise, out-of-order chunks are held until the chunks before them
+    arrive, and the data is written in order.
+
+    If given a hasher, the data is also hashed in order as it is written;
+    chunks that arrive early are copied until the chunks before them have
+    been hashed.
+
+    Args:
+        dest -- The binary file object to write to.
+        chunk_size -- The size of every chunk except possibly the last.
+        pool -- The pool the buffers passed to write are returned to once
+                their data has been consumed.
+        hasher -- A hashlib object to update with the data, if given.
+    """
+
+    def __init__(self, dest: typing.BinaryIO, chunk_size: int, pool: BufferPool,
+                 hasher=None):
+        self._dest = dest
+        self._chunk_size = chunk_size
+        self._pool = pool
+        self.hasher = hasher
+        self._hash_seq = 0  # The next chunk to be hashed
+        self._unhashed = {}  # Copies of chunks written ahead of the hash, by sequence number
+        self._resumed_end = 0  # Chunks before this were written by an earlier transfer
+        self._resumed = set()  # As were these chunks after it
+        self._batch = bytearray()
+        self._batch_seq = 0  # Sequence number of the first chunk in the batch
+        self._batch_end = 0  # Sequence number after the last chunk in the batch
+        self._pending = {}  # Out-of-order (buffer, start, end), by sequence number
+        self.num_bytes = 0
+
+        self._seekable = dest.seekable()
+        self._fileno = None
+        if self._seekable:
+            dest.flush()
+            self._start = dest.tell()
+            self._end = self._start
+            try:
+                if hasattr(os, 'pwrite'):
+                    self._fileno = dest.fileno()
+            except (OSError, io.UnsupportedOperation):
+                pass
+
+    def write(self, seq_num: int, buffer: bytearray, start: int, end: int):
+        """Writes a chunk of data.  Each chunk must be written only once.
+
+        Args:
+            seq_num -- The index of the chunk in the data.
+            buffer -- A buffer from the pool, holding the chunk's data; it is
+                      returned to the pool once the data has been consumed.
+            start -- The offset of the chunk's data in the buffer.
+            end -- The offset of the end of the chunk's data in the buffer.
+        """
+        self.num_bytes += end - start
+        if self.hasher is not None:
+            with memoryview(buffer) as view:
+                if seq_num == self._hash_seq:
+                    self.hasher.update(view[start:end])
+                    self._hash_seq += 1
+                else:
+                    self._unhashed[seq_num] = bytes(view[start:end])
+            self._catch_up_hash()
+        if not self._seekable and seq_num != self._batch_end:
+            self._pending[seq_num] = (buffer, start, end)
+            return
+
+        if seq_num != self._batch_end or len(self._batch) >= WRITE_BATCH_SIZE:
+            self.flush()
+            self._batch_seq = seq_num
+            self._batch_end = seq_num
+        with memoryview(buffer) as view:
+            self._batch += view[start:end]
+        self._pool.put(buffer)
+        self._batch_end += 1
+
+        while self._batch_end in self._pending:
+            buffer, start, end = self._pending.pop(self._batch_end)
+            if len(self._batch) >= WRITE_BATCH_SIZE:
+                self.flush()
+                self._batch_seq = self._batch_end
+            with memoryview(buffer) as view:
+                self._batch += view[start:end]
+            self._pool.put(buffer)
+            self._batch_end += 1
+
+    @property
+    def buffered(self) -> int:
+        """The number of bytes in the current batch, written to the writer
+        but not yet to the destination.
+        """
+        return len(self._batch)
+
+    def resume(self, resumed_end: int, resumed: typing.Iterable[int]):
+        """Records the chunks an earlier, interrupted transfer already wrote
+        to the destination, so they are hashed, when their turn comes, by
+        reading them back.
+
+        Args:
+            resumed_end -- Every chunk before this one was written.
+            resumed -- The chunks after resumed_end that were written.
+        """
+        self._resumed_end = resumed_end
+        self._resumed = set(resumed)
+
+    def _catch_up_hash(self):
+        while True:
+            if self._hash_seq in self._unhashed:
+                self.hasher.update(self._unhashed.pop(self._hash_seq))
+                self._hash_seq += 1
+            elif self._hash_seq < self._resumed_end or self._hash_seq in self._resumed:
+                # Read back as long a run of earlier chunks as there is.
+                count = max(self._resumed_end - self._hash_seq, 1)
+                offset = self._start + self._hash_seq * self._chunk_size
+                remaining = count * self._chunk_size
+                while remaining:
+                    if self._fileno is not None:
+                        data = os.pread(self._fileno, min(remaining, WRITE_BATCH_SIZE), offset)
+                    else:
+                        self._dest.seek(offset)
+                        data = self._dest.read(min(remaining, WRITE_BATCH_SIZE))
+                    if not data:
+                        break
+                    self.hasher.update(data)
+                    offset += len(data)
+                    remaining -= len(data)
+                self._resumed.discard(self._hash_seq)
+                self._hash_seq += count
+            else:
+                return
+
+    def flush(self):
+        """Writes out the current batch of consecutive chunks."""
+        if not self._batch:
+            return
+        if not self._seekable:
+            self._dest.write(self._batch)
+        else:
+            offset = self._start + self._batch_seq * self._chunk_size
+            if self._fileno is not None:
+                written = 0
+                while written < len(self._batch):
+                    with memoryview(self._batch) as view:
+                        written += os.pwrite(self._fileno, view[written:],
+                                             offset + written)
+            else:
+                self._dest.seek(offset)
+                self._dest.write(self._batch)
+            self._end = max(self._end, offset + len(self._batch))
+        self._batch.clear()
+        self._batch_seq = self._batch_end
+
+    def close(self):
+        """Writes out any remaining data, and leaves the destination's
+        position at the end of the data written.
+        """
+        self.flush()
+        if self.hasher is not None:
+            self._catch_up_hash()  # In case the chunks at the end were resumed
+        if self._seekable:
+            self._dest.seek(self._end)
+        self._dest.flush()
@@ -1,13 +1,23 @@
 """
 Shared utilities for testing implementations of HW5.
 """
+import math
+import mmap
+import os
 import pathlib
+import select
+import subprocess
 import typing
 import hashlib
 
+# How many bytes of a file are hashed at a time, when it cannot be mapped.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
 def file_summary(path: pathlib.Path) -> typing.Tuple[int, str]:
     """Reads a file off disk, and returns the size of the file and the sha256
-    hash of it.
+    hash of it.  The file is mapped into memory, or read a chunk at a time if
+    it cannot be, so it is never held in memory all at once.
 
     Args:
         path -- A path to a file that should be summarized.
@@ -16,10 +26,92 @@ def file_summary(path: pathlib.Path) -> typing.Tuple[int, str]:
         Two values, first the size of the file, in bytes, and second, the
         sha256 hex digest of the contents of the file.
     """
-    with open(path, 'rb') as handle:
-        data: bytes = handle.read()
-        data_len: int = len(data)
-        hasher = hashlib.sha256()
-        hasher.update(data)
-        hash_hex: str = hasher.hexdigest()
-    return data_len, hash_hex
+    hasher = hashlib.sha256()
+    data_len = 0
+    with open(path, 'rb', buffering=0) as handle:
+        try:
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+                data_len = len(mapped)
+        except (OSError, ValueError):
+            # Empty files, pipes and the like cannot be mapped.
+            chunk = bytearray(HASH_CHUNK_SIZE)
+            with memoryview(chunk) as view:
+                while True:
+                    count = handle.readinto(view)
+                    if not count:
+                        break
+                    hasher.update(view[:count])
+                    data_len += count
+    return data_len, hasher.hexdigest()
+
+
+def signal_ready(ready_fd: typing.Optional[int]):
+    """Tells the process that launched this one that it is ready, by writing
+    to, and then closing, a pipe inherited from it.
+
+    Args:
+        ready_fd -- The file descriptor of the pipe, or None if the launching
+                    process is not waiting for a signal.
+    """
+    if ready_fd is None:
+        return
+    os.write(ready_fd, b'ready\n')
+    os.close(ready_fd)
+
+
+def wait_ready(read_fd: int, timeout: float) -> bool:
+    """Waits for a launched process to call signal_ready, and then closes the
+    read end of the pipe.
+
+    Args:
+        read_fd -- The read end of the pipe passed to the launched process.
+        timeout -- The most seconds to wait.
+
+    Return:
+        Whether the process signalled it was ready in time; False if it timed
+        out or exited first.
+    """
+    try:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        return bool(readable) and os.read(read_fd, 16).startswith(b'ready')
+    finally:
+        os.close(read_fd)
+
+
+def start_when_ready(args: typing.List[str], timeout: float = 10.0,
+                     **popen_kwargs) -> subprocess.Popen:
+    """Launches a process that accepts a --ready-fd argument, and waits for it
+    to signal that it is ready.
+
+    Args:
+        args -- The command line of the process, without --ready-fd.
+        timeout -- The most seconds to wait for the process to be ready.
+        popen_kwargs -- Extra arguments for subprocess.Popen.
+
+    Return:
+        The running process.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        process = subprocess.Popen(args + ["--ready-fd", str(write_fd)],
+                                   pass_fds=(write_fd,), **popen_kwargs)
+    finally:
+        os.close(write_fd)
+    if not wait_ready(read_fd, timeout):
+        process.kill()
+        raise RuntimeError("Process did not become ready: {}".format(args))
+    return process
+
+
+def percentile(values: typing.Sequence[float], pct: float) -> float:
+    """Returns the given percentile of the values, using the nearest-rank
+    method.
+
+    Args:
+        values -- A non-empty sequence of numbers.
+        pct -- The percentile, between 0 and 100.
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
@@ -3,11 +3,16 @@ Implementation of an async based lossy wire, that simulates network
 conditions between two communicating sockets.
 """
 import asyncio
+import collections
+import heapq
+import json
+import logging
 import random
 import socket
 import binascii
 import hashlib
 import struct
+import typing
 import utils.logging
 
 
@@ -26,65 +31,320 @@ def data_rep(data: bytes) -> str:
     return sha1er.hexdigest()
 
 
+class Impairments(typing.NamedTuple):
+    """Network conditions the wire simulates, beyond uniform loss, a constant
+    delay and a limit on the number of datagrams in flight.
+
+    Args:
+        bandwidth -- The link's bandwidth in each direction, in bytes per
+                     second; datagrams queue to be serialized onto the link at
+                     this rate.  Zero means unlimited.
+        queue_bytes -- The most bytes that may be waiting to be serialized
+                       onto the link in each direction; datagrams that do not
+                       fit are dropped.  Zero means unlimited.
+        jitter -- Up to this many extra seconds, chosen uniformly at random,
+                  are added to each datagram's delay.
+        reorder -- Whether jitter may make datagrams overtake each other.  If
+                   not, a datagram is never forwarded before the ones that
+                   arrived ahead of it.
+        burst_enter -- Probability, per datagram, of the Gilbert-Elliott loss
+                       model moving from its good state to its bad state; each
+                       direction has a model of its own.  Zero disables burst
+                       loss, leaving only uniform loss.
+        burst_exit -- Probability, per datagram, of moving from the bad state
+                      back to the good state.
+        burst_loss -- Probability of losing a datagram in the bad state; in
+                      the good state, the wire's normal loss rate applies.
+        corrupt -- Probability of flipping a random bit in a datagram.
+        duplicate -- Probability of forwarding a datagram twice.
+        seed -- Seed for the wire's random decisions, to make runs
+                reproducible.  None seeds from the system.
+    """
+    bandwidth: float = 0.0
+    queue_bytes: int = 0
+    jitter: float = 0.0
+    reorder: bool = False
+    burst_enter: float = 0.0
+    burst_exit: float = 1.0
+    burst_loss: float = 1.0
+    corrupt: float = 0.0
+    duplicate: float = 0.0
+    seed: typing.Optional[int] = None
+
+
+class Decision(typing.NamedTuple):
+    """The fate the wire chose for one datagram, as recorded in a trace.
+    Datagrams dropped because the wire's buffer or the link's queue was full
+    are not recorded, since that follows from how fast the peers send rather
+    than from chance.
+
+    Args:
+        peer -- The index of the peer that sent the datagram, numbering peers
+                in the order they first contacted the wire.
+        time -- The number of seconds after the first recorded datagram that
+                this one arrived.
+        size -- The size of the datagram, in bytes.
+        lost -- Whether the datagram was dropped.
+        corrupt_bit -- The index of the bit flipped in the datagram, or None.
+        delays -- The number of seconds each copy of the datagram forwarded
+                  was delayed by, before any wait for the link; empty if it
+                  was lost, and two long if it was duplicated.
+    """
+    peer: int
+    time: float
+    size: int
+    lost: bool
+    corrupt_bit: typing.Optional[int]
+    delays: typing.Tuple[float, ...]
+
+
+class TraceRecorder:
+    """Writes the decisions of a wire to a trace file, one JSON object per
+    line, so that they can be replayed with TraceReplayer.
+
+    Args:
+        path -- The path to write the trace to.
+    """
+
+    def __init__(self, path: str):
+        self._handle = open(path, 'w')
+        self._start = None
+
+    def record(self, decision: Decision, now: float):
+        """Writes a decision made at the given time of the wire's loop."""
+        if self._start is None:
+            self._start = now
+        decision = decision._replace(time=round(now - self._start, 6))
+        self._handle.write(json.dumps(decision._asdict()) + "\n")
+
+    def close(self):
+        self._handle.close()
+
+
+class TraceReplayer:
+    """Hands out the decisions of a recorded trace, in the order each peer's
+    datagrams were recorded, so that the n-th datagram a peer sends meets the
+    fate the n-th did when the trace was recorded, whatever build of the
+    sender and receiver sends it.  Traces may also be written by hand or
+    converted from elsewhere; only the peer, lost, corrupt_bit and delays of
+    each decision are needed.
+
+    Args:
+        path -- The path of the trace to replay.
+    """
+
+    def __init__(self, path: str):
+        self._decisions: typing.Dict[int, typing.Deque[Decision]] = {}
+        with open(path) as handle:
+            for a_line in handle:
+                if not a_line.strip():
+                    continue
+                fields = json.loads(a_line)
+                decision = Decision(int(fields["peer"]), float(fields.get("time", 0.0)),
+                                    int(fields.get("size", 0)), bool(fields["lost"]),
+                                    fields.get("corrupt_bit"),
+                                    tuple(float(a_delay) for a_delay in fields["delays"]))
+                self._decisions.setdefault(decision.peer, collections.deque()).append(decision)
+
+    def next(self, peer: int) -> typing.Optional[Decision]:
+        """Returns the next decision for a datagram from the given peer, or
+        None if the trace has run out of them.
+        """
+        decisions = self._decisions.get(peer)
+        return decisions.popleft() if decisions else None
+
+
+class _Direction:
+    def __init__(self):
+        self.in_burst = False  # Whether the Gilbert-Elliott model is in its bad state
+        self.link_free_at = 0.0  # When the link finishes serializing queued datagrams
+        self.last_release = 0.0  # Release time of the last datagram queued
+
+
 class CrummyWireProtocol(asyncio.DatagramProtocol):
 
-    def __init__(self, loop, loss: float, delay: float, buffer_size: int):
+    def __init__(self, loop, loss: float, delay: float, buffer_size: int,
+                 impairments: Impairments = Impairments(),
+                 recorder: typing.Optional[TraceRecorder] = None,
+                 replayer: typing.Optional[TraceReplayer] = None):
         self._loop = loop
         self._loss = loss
         self._delay = delay
         self._buffer_size = buffer_size
+        self._impairments = impairments
+        self._random = random.Random(impairments.seed)
+        # The link is full duplex: each direction, by the peer sending in
+        # it, has a bandwidth, queue and burst loss state of its own.
+        self._directions: typing.Dict[int, _Direction] = \
+            collections.defaultdict(_Direction)
+        # Datagrams in flight, as a heap of (release time, arrival count,
+        # data, sender address), so jitter can reorder them.  The arrival
+        # count breaks ties, keeping datagrams released together in order.
         self._wirebuffer = []
-        self._peer_addrs = set()
+        self._arrivals = 0
+        self._drain_handle = None
+        # Peers, numbered in the order they first contacted the wire, which
+        # is how traces tell the directions datagrams travel in apart.
+        self._peer_addrs = {}
+        self._recorder = recorder
+        self._replayer = replayer
+        self._trace_exhausted = set()  # Peers whose replayed decisions ran out
         self._transport = None
-        self._logger = homework5.logging.get_logger("hw5-wire")
+        self._logger = utils.logging.get_logger("hw5-wire")
 
     def connection_made(self, transport):
         self._transport = transport
 
+    def is_lost(self, peer: int) -> bool:
+        """Decides whether the next datagram from the given peer is lost,
+        following the Gilbert-Elliott model of its direction if burst loss
+        is enabled, and uniform loss otherwise.
+        """
+        impairments = self._impairments
+        loss = self._loss
+        if impairments.burst_enter > 0:
+            direction = self._directions[peer]
+            if direction.in_burst:
+                direction.in_burst = self._random.random() >= impairments.burst_exit
+            else:
+                direction.in_burst = self._random.random() < impairments.burst_enter
+            if direction.in_burst:
+                loss = impairments.burst_loss
+        return loss > 0 and self._random.random() < loss
+
+    def decide(self, peer: int, data: bytes) -> Decision:
+        """Chooses the fate of a datagram at random, following the wire's
+        loss rate, delay and impairments.
+        """
+        impairments = self._impairments
+        if self.is_lost(peer):
+            return Decision(peer, 0.0, len(data), True, None, ())
+        corrupt_bit = None
+        # An empty datagram has no bit to flip.
+        if impairments.corrupt > 0 and data and self._random.random() < impairments.corrupt:
+            corrupt_bit = self._random.randrange(len(data) * 8)
+        copies = 1
+        if impairments.duplicate > 0 and self._random.random() < impairments.duplicate:
+            copies = 2
+        delays = []
+        for _ in range(copies):
+            delay = self._delay
+            if impairments.jitter:
+                delay += self._random.uniform(0, impairments.jitter)
+            delays.append(delay)
+        return Decision(peer, 0.0, len(data), False, corrupt_bit, tuple(delays))
+
+    def _next_decision(self, peer: int, data: bytes, now: float) -> Decision:
+        decision = None
+        if self._replayer is not None:
+            decision = self._replayer.next(peer)
+            if decision is None and peer not in self._trace_exhausted:
+                self._trace_exhausted.add(peer)
+                self._logger.warning("Replayed trace has no more decisions for "
+                                     "peer %d, deciding at random", peer)
+        if decision is None:
+            decision = self.decide(peer, data)
+        if self._recorder is not None:
+            self._recorder.record(decision._replace(size=len(data)), now)
+        return decision
+
     def datagram_received(self, data, addr):
-        self._logger.info(" --> Received %d bytes from %s - %s", len(data),
-                          addr, data_rep(data))
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(" --> Received %d bytes from %s - %s", len(data),
+                              addr, data_rep(data))
 
-        self._peer_addrs.add(addr)
+        peer = self._peer_addrs.setdefault(addr, len(self._peer_addrs))
         if data == b'connect':
             return
 
-        # First, see if the buffer is full.  If it is, then just drop
-        # the packet and pretend nothing happened.
-        if len(self._wirebuffer) == self._buffer_size:
+        impairments = self._impairments
+        direction = self._directions[peer]
+        now = self._loop.time()
+
+        # First, see if the buffer is full, either because too many datagrams
+        # are in flight, or because too many bytes are waiting for the link.
+        # If it is, then just drop the packet and pretend nothing happened.
+        if len(self._wirebuffer) >= self._buffer_size:
             self._logger.debug(" !-> Dropping, buffer is full")
             return
+        link_free_at = max(direction.link_free_at, now)
+        if impairments.bandwidth and impairments.queue_bytes:
+            queued_bytes = (link_free_at - now) * impairments.bandwidth
+            if queued_bytes + len(data) > impairments.queue_bytes:
+                self._logger.debug(" !-> Dropping, link queue is full")
+                return
 
         # Second, see if we should drop the packet.  If so, then we just
         # discard it as if nothing ever happened.
-        if self._loss > 0 and random.random() < self._loss:
+        decision = self._next_decision(peer, data, now)
+        if decision.lost:
             self._logger.debug(" !-> Dropping to simulate a lossy connection")
             return
 
-        self._logger.debug(" --> Added %d bytes to send in %f seconds",
-                           len(data), self._delay)
+        if decision.corrupt_bit is not None and data:
+            self._logger.debug(" !-> Flipping a bit to simulate corruption")
+            data = bytearray(data)
+            # A replayed trace may have been recorded with larger datagrams.
+            bit = decision.corrupt_bit % (len(data) * 8)
+            data[bit >> 3] ^= 1 << (bit & 7)
+            data = bytes(data)
+
+        # The datagram leaves once the link has serialized it, and everything
+        # queued ahead of it.
+        if impairments.bandwidth:
+            link_free_at += len(data) / impairments.bandwidth
+            direction.link_free_at = link_free_at
+
+        if len(decision.delays) > 1:
+            self._logger.debug(" !-> Duplicating datagram")
+
+        for delay in decision.delays:
+            release = link_free_at + delay
+            if not impairments.reorder:
+                release = max(release, direction.last_release)
+            direction.last_release = max(release, direction.last_release)
+
+            self._logger.debug(" --> Added %d bytes to send in %f seconds",
+                               len(data), release - now)
 
-        # And now, schedule the data to actually be sent in the future.
-        self._wirebuffer.append(data)
-        self._loop.call_later(self._delay, self.send_to_peer_addrs, (data, addr))
+            # And now, queue the data to actually be sent in the future.  A
+            # single timer drains the queue, armed for the earliest datagram.
+            self._arrivals += 1
+            heapq.heappush(self._wirebuffer, (release, self._arrivals, data, addr))
+        self._arm_drain()
+
+    def _arm_drain(self):
+        release = self._wirebuffer[0][0] if self._wirebuffer else None
+        if self._drain_handle is not None:
+            if release is not None and self._drain_handle.when() <= release:
+                return
+            self._drain_handle.cancel()
+            self._drain_handle = None
+        if release is not None:
+            self._drain_handle = self._loop.call_at(release, self.drain)
+
+    def drain(self):
+        """Forwards every queued datagram that is due, and re-arms the drain
+        timer for the next one, if any.
+        """
+        self._drain_handle = None
+        now = self._loop.time()
+        while self._wirebuffer and self._wirebuffer[0][0] <= now:
+            _, _, data, sender_addr = heapq.heappop(self._wirebuffer)
+            self.send_to_peer_addrs((data, sender_addr))
+        self._arm_drain()
 
     def send_to_peer_addrs(self, package):
         data, sender_addr = package
 
-        if data not in self._wirebuffer:
-            self._logger.error(" !!! Was scheduled to send data that is not "
-                               "in the write buffer")
-            return
-
         for a_peer_addr in self._peer_addrs:
             if a_peer_addr == sender_addr:
                 continue
-            self._logger.debug(" <-- Sending %d bytes to %s - %s", len(data),
-                               a_peer_addr, data_rep(data))
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(" <-- Sending %d bytes to %s - %s", len(data),
+                                   a_peer_addr, data_rep(data))
             self._transport.sendto(data, addr=a_peer_addr)
 
-        self._wirebuffer.remove(data)
-
 
 def bad_socket(port: int) -> socket.socket:
     """Establishes a connection to the server, that simulates a crummy
@@ -102,11 +362,15 @@ def bad_socket(port: int) -> socket.socket:
     return lossy_socket
 
 
-def create_server(port: int, loss: float, delay: float, buff_size: int) -> tuple:
+def create_server(port: int, loss: float, delay: float, buff_size: int,
+                  impairments: Impairments = Impairments(),
+                  recorder: typing.Optional[TraceRecorder] = None,
+                  replayer: typing.Optional[TraceReplayer] = None) -> tuple:
 
     loop = asyncio.get_event_loop()
     listen = loop.create_datagram_endpoint(
-        lambda: CrummyWireProtocol(loop, loss, delay, buff_size),
+        lambda: CrummyWireProtocol(loop, loss, delay, buff_size, impairments,
+                                   recorder, replayer),
         local_addr=('127.0.0.1', port))
     transport, _ = loop.run_until_complete(listen)
     return transport, loop